@@ -0,0 +1,360 @@
+"""
+Benchmarks of hydat processing and download hot paths on synthetic Daymet and PRISM data.
+
+Run from the repository root:
+
+    python -m benchmarks.run --size small --output results.json
+
+Each measurement runs in a fresh process and reports wall time, peak resident set size, and bytes processed as
+JSON. Downloads are served by local HTTP (range requests) and FTP (requires pyftpdlib) stand-ins. Benchmarks whose
+dependencies are missing (e.g. GDAL for raster writing) are reported as skipped.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+import multiprocessing
+import numpy as np
+import benchmarks.synthetic as synthetic
+import benchmarks.servers as servers
+
+# grid sizes of the synthetic data; Daymet North America is 8075 x 7814 and PRISM 4km is 621 x 1405
+SIZES = {'small': {'ny': 100, 'nx': 120, 'years': 2, 'prism_rows': 156, 'prism_cols': 351, 'raster_rows': 1024,
+                   'raster_cols': 1024, 'bands': 4},
+         'medium': {'ny': 500, 'nx': 600, 'years': 2, 'prism_rows': 621, 'prism_cols': 1405, 'raster_rows': 4096,
+                    'raster_cols': 4096, 'bands': 8},
+         'large': {'ny': 1500, 'nx': 1500, 'years': 3, 'prism_rows': 3105, 'prism_cols': 7025,
+                   'raster_rows': 10000, 'raster_cols': 10000, 'bands': 12}}
+FIRST_YEAR = 2001
+PRISM_VAR = 'ppt'
+
+
+def dailySWEAccumulation(config, data, out_dir):
+    import hydat.daymet as daymet
+    years = _years(config)
+    return (lambda: _check(daymet.dailySWEAccumulation(years[0], years[-1], out_dir, data['swe'],
+                                                       chunk_days=config['chunk_days']))), data['swe_bytes']
+
+
+def montlyAverageDayl(config, data, out_dir):
+    import hydat.daymet as daymet
+    years = _years(config)
+    return (lambda: _check(daymet.montlyAverageDayl(years[0], years[-1], out_dir, data['dayl'],
+                                                    tile_size=config['tile_size']))), data['dayl_bytes']
+
+
+def monthlySWEAccumulation(config, data, out_dir):
+    import hydat.daymet as daymet
+    years = _years(config)
+    return (lambda: _check(daymet.monthlySWEAccumulation(years[0], years[-1], out_dir, data['swe'],
+                                                         tile_size=config['tile_size']))), data['swe_bytes']
+
+
+def copyNetCDF(config, data, out_dir):
+    import hydat.gis as gis
+    fn = data['swe'].replace('%year%', str(FIRST_YEAR))
+    return (lambda: gis.copyNetCDF(fn, os.path.join(out_dir, 'copy.nc'))), os.path.getsize(fn)
+
+
+def monthlyGridsToNumpy(config, data, out_dir):
+    import hydat.utils as utils
+    years = _years(config)
+    return (lambda: utils.monthlyGridsToNumpy(os.path.join(out_dir, 'stack.npy'), years[0], years[-1],
+                                              data['prism'], PRISM_VAR, resume=False)), data['prism_bytes']
+
+
+def monthlyGridsToNumpyArchives(config, data, out_dir):
+    import hydat.utils as utils
+    import gdal  # grids in archives are read through GDAL's /vsizip/
+    years = _years(config)
+    return (lambda: utils.monthlyGridsToNumpy(os.path.join(out_dir, 'stack.npy'), years[0], years[-1],
+                                              data['prism'], PRISM_VAR, resume=False, archives=True)), \
+        data['prism_bytes']
+
+
+def writeArrayAsRaster(config, data, out_dir):
+    import hydat.gis as gis
+    array = _raster(config)
+    return (lambda: gis.writeArrayAsRaster(os.path.join(out_dir, 'array.tif'), array, array.shape[1],
+                                           array.shape[2], (0.0, 1.0, 0.0, 0.0, 0.0, -1.0), '')), array.nbytes
+
+
+def indexRaster(config, data, out_dir):
+    import hydat.gis as gis
+    array = _raster(config)[:1]
+    src = os.path.join(out_dir, 'src.tif')
+    gis.writeArrayAsRaster(src, array, array.shape[1], array.shape[2], (0.0, 1.0, 0.0, 0.0, 0.0, -1.0), '')
+    nbytes = array.nbytes
+    del array
+    return (lambda: gis.indexRaster(src, os.path.join(out_dir, 'index.tif'))), nbytes
+
+
+def downloadDaymet(config, data, out_dir):
+    import hydat.daymet as daymet
+    daymet.THREDDS_URL = data['http_url'] + 'thredds/'
+
+    def run():
+        for year in _years(config):
+            daymet.downloadDaymet(os.path.join(out_dir, str(year) + '.nc4'), year, 'swe',
+                                  segments=config['segments'])
+    return run, data['swe_bytes']
+
+
+def downloadDaymetBatch(config, data, out_dir):
+    import hydat.daymet as daymet
+    daymet.THREDDS_URL = data['http_url'] + 'thredds/'
+    return (lambda: _checkRecords(daymet.downloadDaymetBatch(out_dir, _years(config), ['swe', 'dayl'],
+                                                             max_workers=config['connections'],
+                                                             max_per_host=config['connections']))), \
+        data['swe_bytes'] + data['dayl_bytes']
+
+
+def prismWebServices(config, data, out_dir):
+    import hydat.prism as prism
+
+    def run():
+        for year in _years(config):
+            for month in range(1, 13):
+                downloader = prism.PRISMDownloader()
+                downloader.url_base = data['http_url'] + 'prism/'
+                downloader.downloadWebServices(os.path.join(out_dir, str(year) + str(month).zfill(2) + '.zip'),
+                                               PRISM_VAR, year=year, month=month, extract_dir=out_dir)
+    return run, data['prism_zip_bytes']
+
+
+def prismFTP(config, data, out_dir):
+    import hydat.prism as prism
+    jobs = [(PRISM_VAR, year, month, out_dir) for year in _years(config) for month in range(1, 13)]
+
+    def run():
+        with prism.PRISMFTPPool(config['connections'], host='127.0.0.1', port=data['ftp_port']) as pool:
+            _checkRecords(pool.downloadMonthly(jobs))
+    return run, data['prism_zip_bytes']
+
+
+# benchmark name: (function, data it needs)
+BENCHMARKS = {'dailySWEAccumulation': (dailySWEAccumulation, ['swe']),
+              'montlyAverageDayl': (montlyAverageDayl, ['dayl']),
+              'monthlySWEAccumulation': (monthlySWEAccumulation, ['swe']),
+              'copyNetCDF': (copyNetCDF, ['swe']),
+              'monthlyGridsToNumpy': (monthlyGridsToNumpy, ['prism']),
+              'monthlyGridsToNumpyArchives': (monthlyGridsToNumpyArchives, ['prism']),
+              'writeArrayAsRaster': (writeArrayAsRaster, []),
+              'indexRaster': (indexRaster, []),
+              'downloadDaymet': (downloadDaymet, ['swe', 'http']),
+              'downloadDaymetBatch': (downloadDaymetBatch, ['swe', 'dayl', 'http']),
+              'prismWebServices': (prismWebServices, ['prism', 'http']),
+              'prismFTP': (prismFTP, ['prism', 'ftp'])}
+
+
+def _years(config):
+    return list(range(FIRST_YEAR, FIRST_YEAR + config['years']))
+
+
+def _raster(config):
+    rng = np.random.default_rng(0)
+    array = rng.random((config['bands'], config['raster_rows'], config['raster_cols']), dtype=np.float32)
+    array[:, :, :config['raster_cols'] // 5] = synthetic.NO_DATA_VALUE
+    return array
+
+
+def _check(results):
+    for year, result in results.items():
+        if isinstance(result, Exception):
+            raise RuntimeError(str(year) + ": " + str(result))
+
+
+def _checkRecords(results):
+    records = results.values() if isinstance(results, dict) else results
+    for record in records:
+        error = record if isinstance(record, Exception) else (record.get('error') if isinstance(record, dict) else None)
+        if error is not None:
+            raise RuntimeError(str(error))
+
+
+def peakRSS():
+    """
+    Peak resident set size of this process and its finished children
+
+    Returns:
+        bytes, or None where the resource module is not available
+
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    scale = 1 if sys.platform == 'darwin' else 1024  # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    return scale * max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                       resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def measure(name, config, data, out_dir):
+    """
+    Run one benchmark and measure it; meant to run in a fresh process so peak RSS belongs to this benchmark alone
+    Args:
+        name: benchmark name, a key of BENCHMARKS
+        config: size configuration
+        data: description of the prepared data
+        out_dir: empty directory for outputs
+
+    Returns:
+        result dictionary
+
+    """
+    result = {'name': name, 'status': 'ok', 'wall_time_s': None, 'peak_rss_bytes': None, 'bytes_processed': None,
+              'throughput_bytes_per_s': None, 'error': None}
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            run, nbytes = BENCHMARKS[name][0](config, data, out_dir)
+            start = time.perf_counter()
+            run()
+            wall = time.perf_counter() - start
+    except ImportError as e:
+        result['status'] = 'skipped'
+        result['error'] = str(e)
+        return result
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = type(e).__name__ + ': ' + str(e)
+        return result
+    result.update({'wall_time_s': wall, 'peak_rss_bytes': peakRSS(), 'bytes_processed': int(nbytes),
+                   'throughput_bytes_per_s': nbytes / wall if wall > 0 else None})
+    return result
+
+
+def prepareData(work_dir, config, needs):
+    """
+    Generate the synthetic data and start the servers the selected benchmarks need
+    Args:
+        work_dir: directory to write the data to; existing files are reused
+        config: size configuration
+        needs: set of data names (swe, dayl, prism, http, ftp)
+
+    Returns:
+        tuple of the data description and a list of functions that stop the servers
+
+    """
+    data = {}
+    stops = []
+    years = _years(config)
+    root = os.path.join(work_dir, 'serve')
+    size_dir = os.path.join(work_dir, str(config['ny']) + 'x' + str(config['nx']))
+    for variable in ['swe', 'dayl']:
+        if variable in needs:
+            data[variable], data[variable + '_bytes'] = synthetic.makeDaymetYears(
+                os.path.join(size_dir, 'daymet'), variable, years, config['ny'], config['nx'])
+            for year in years:
+                servers.publish(data[variable].replace('%year%', str(year)), root,
+                                'thredds/fileServer/ornldaac/1328/' + str(year) + '/daymet_v3_' + variable + '_' +
+                                str(year) + '_na.nc4')
+    if 'prism' in needs:
+        import hydat.utils as utils
+        data['prism'] = os.path.join(work_dir, str(config['prism_rows']) + 'x' + str(config['prism_cols']), 'prism')
+        data['prism_bytes'] = synthetic.makePRISMYears(data['prism'], PRISM_VAR, years, config['prism_rows'],
+                                                       config['prism_cols'], archives=True)
+        data['prism_zip_bytes'] = 0
+        for year in years:
+            for month in range(1, 13):
+                zip_fn = os.path.join(data['prism'], str(year), utils.getPRISMArchiveName(year, month, PRISM_VAR))
+                data['prism_zip_bytes'] += os.path.getsize(zip_fn)
+                servers.publish(zip_fn, root, 'prism/4km/' + PRISM_VAR + '/' + str(year) + str(month).zfill(2))
+                servers.publish(zip_fn, root, 'monthly/' + PRISM_VAR + '/' + str(year) + '/' +
+                                os.path.basename(zip_fn))
+    if 'http' in needs:
+        server, data['http_url'] = servers.serveHTTP(root)
+        stops.append(server.shutdown)
+    if 'ftp' in needs:
+        try:
+            server, data['ftp_port'] = servers.serveFTP(root)
+            stops.append(server.close_all)
+        except ImportError:
+            data['ftp_port'] = None
+    return data, stops
+
+
+def runBenchmarks(names, config, work_dir, repeat=1):
+    """
+    Run benchmarks, each measurement in a fresh process
+    Args:
+        names: benchmark names
+        config: size configuration
+        work_dir: directory for data and outputs
+        repeat: number of measurements of each benchmark (default: 1)
+
+    Returns:
+        list of result dictionaries
+
+    """
+    needs = set(need for name in names for need in BENCHMARKS[name][1])
+    data, stops = prepareData(work_dir, config, needs)
+    context = multiprocessing.get_context('spawn')
+    results = []
+    try:
+        for name in names:
+            if 'ftp' in BENCHMARKS[name][1] and data.get('ftp_port') is None:
+                results.append({'name': name, 'status': 'skipped', 'error': 'pyftpdlib is not installed',
+                                'repeat': 0})
+                continue
+            for i in range(repeat):
+                out_dir = os.path.join(work_dir, 'out', name + '_' + str(i))
+                if os.path.exists(out_dir):
+                    shutil.rmtree(out_dir)
+                os.makedirs(out_dir)
+                with context.Pool(1) as pool:
+                    result = pool.apply(measure, (name, config, data, out_dir))
+                result['repeat'] = i
+                results.append(result)
+                shutil.rmtree(out_dir)
+                print(name, i, result['status'], result['wall_time_s'], file=sys.stderr)
+                if result['status'] == 'skipped':
+                    break
+    finally:
+        for stop in stops:
+            stop()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark hydat on synthetic data')
+    parser.add_argument('--size', choices=sorted(SIZES), default='small', help='size of the synthetic data')
+    parser.add_argument('--years', type=int, help='number of years of data (default depends on size)')
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS), help='benchmarks to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=1, help='measurements of each benchmark')
+    parser.add_argument('--chunk-days', type=int, default=32, help='chunk_days of dailySWEAccumulation')
+    parser.add_argument('--tile-size', type=int, default=None, help='tile_size of the monthly Daymet functions')
+    parser.add_argument('--connections', type=int, default=4, help='concurrent downloads')
+    parser.add_argument('--segments', type=int, default=1, help='byte range segments of downloadDaymet')
+    parser.add_argument('--work-dir', help='directory for data and outputs; kept between runs (default: temporary)')
+    parser.add_argument('--output', help='JSON file to write results to (default: standard output)')
+    args = parser.parse_args(argv)
+    config = dict(SIZES[args.size])
+    if args.years is not None:
+        config['years'] = args.years
+    config.update({'chunk_days': args.chunk_days, 'tile_size': args.tile_size, 'connections': args.connections,
+                   'segments': args.segments})
+    work_dir = args.work_dir if args.work_dir is not None else tempfile.mkdtemp(prefix='hydat_bench_')
+    try:
+        results = runBenchmarks(args.only or list(BENCHMARKS), config, work_dir, args.repeat)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'size': args.size, 'config': config,
+              'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+              'cpus': os.cpu_count(), 'results': results}
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+import os
+import re
+import logging
+import shutil
+import threading
+import http.server
+
+
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves files below the server root with support for HEAD and single byte range requests, like the Daymet THREDDS
+    file server. Query strings are ignored, so subset URLs are answered with the file at their path.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        fn = self.resolve()
+        if fn is None:
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(os.path.getsize(fn)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+    def do_GET(self):
+        fn = self.resolve()
+        if fn is None:
+            return
+        size = os.path.getsize(fn)
+        start, end = 0, size - 1
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */' + str(size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes ' + str(start) + '-' + str(end) + '/' + str(size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        with open(fn, 'rb') as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                block = f.read(min(remaining, 1024 ** 2))
+                if not block:
+                    break
+                self.wfile.write(block)
+                remaining -= len(block)
+
+    def resolve(self):
+        path = os.path.normpath(self.path.split('?')[0].lstrip('/'))
+        fn = os.path.join(self.server.root, path)
+        if path.startswith('..') or not os.path.isfile(fn):
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+        return fn
+
+
+def serveHTTP(root, host='127.0.0.1', port=0):
+    """
+    Serve a directory over HTTP from a background thread
+    Args:
+        root: directory to serve
+        host: address to bind (default: 127.0.0.1)
+        port: port to bind (default: 0, any free port)
+
+    Returns:
+        tuple of the server (call shutdown() to stop it) and its base URL ending in '/'
+
+    """
+    server = http.server.ThreadingHTTPServer((host, port), RangeRequestHandler)
+    server.daemon_threads = True
+    server.root = os.path.abspath(root)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://' + host + ':' + str(server.server_address[1]) + '/'
+
+
+def serveFTP(root, host='127.0.0.1', port=0):
+    """
+    Serve a directory over anonymous FTP from a background thread. Requires pyftpdlib.
+    Args:
+        root: directory to serve
+        host: address to bind (default: 127.0.0.1)
+        port: port to bind (default: 0, any free port)
+
+    Returns:
+        tuple of the server (call close_all() to stop it) and the port it listens on
+
+    """
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+    logger = logging.getLogger('pyftpdlib')
+    if not logger.handlers:  # otherwise pyftpdlib logs every transfer to stderr
+        logger.addHandler(logging.NullHandler())
+    logger.setLevel(logging.WARNING)
+    authorizer = DummyAuthorizer()
+    authorizer.add_anonymous(os.path.abspath(root))
+    handler = type('BenchmarkFTPHandler', (FTPHandler,), {'authorizer': authorizer})
+    server = ThreadedFTPServer((host, port), handler)
+    server.max_cons = 64
+    threading.Thread(target=server.serve_forever, kwargs={'handle_exit': False}, daemon=True).start()
+    return server, server.address[1]
+
+
+def publish(src, root, path):
+    """
+    Place a file in a served directory
+    Args:
+        src: filename of the file
+        root: served directory
+        path: path of the file below root
+
+    Returns:
+        filename of the placed file
+
+    """
+    dst = os.path.join(root, path)
+    if not os.path.exists(os.path.dirname(dst)):
+        os.makedirs(os.path.dirname(dst))
+    if not os.path.exists(dst):
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+    return dst
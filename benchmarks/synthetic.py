@@ -0,0 +1,171 @@
+import os
+import zipfile
+import netCDF4 as nc
+import numpy as np
+
+NO_DATA_VALUE = -9999.0
+# value ranges of synthetic Daymet variables
+DAYMET_RANGES = {'swe': (0.0, 500.0), 'dayl': (30000.0, 55000.0), 'prcp': (0.0, 40.0), 'tmin': (-20.0, 15.0),
+                 'tmax': (-5.0, 35.0), 'srad': (50.0, 600.0), 'vp': (100.0, 2000.0)}
+PRISM_HEADER = """BYTEORDER      I
+LAYOUT         BIL
+NROWS          %rows%
+NCOLS          %cols%
+NBANDS         1
+NBITS          32
+BANDROWBYTES         %rowbytes%
+TOTALROWBYTES        %rowbytes%
+PIXELTYPE      FLOAT
+ULXMAP         -125
+ULYMAP         49.9166666666664
+XDIM           0.0416666666667
+YDIM           0.0416666666667
+NODATA         -9999
+"""
+
+
+def makeDaymetFile(fn, variable, year, ny, nx, ndays=365, nodata_fraction=0.2, seed=0):
+    """
+    Write a NetCDF file with the layout of a Daymet v3 daily file
+    Args:
+        fn: output filename
+        variable: Daymet variable (swe, dayl, prcp, tmin, tmax, srad, vp)
+        year: year of the data
+        ny: number of rows
+        nx: number of columns
+        ndays: number of days (default: 365)
+        nodata_fraction: fraction of columns, starting at the west edge, set to no data (default: 0.2)
+        seed: random seed (default: 0)
+
+    Returns:
+        size of the file in bytes
+
+    """
+    rng = np.random.default_rng(seed + year)
+    low, high = DAYMET_RANGES[variable]
+    with nc.Dataset(fn, 'w') as ds:
+        ds.setncatts({'start_year': year, 'source': 'hydat benchmark synthetic data', 'Version_data': 'Daymet v3'})
+        ds.createDimension('time', None)
+        ds.createDimension('y', ny)
+        ds.createDimension('x', nx)
+        ds.createDimension('nv', 2)
+        x = ds.createVariable('x', 'f4', ('x',))
+        x.setncatts({'units': 'm', 'standard_name': 'projection_x_coordinate'})
+        x[:] = -1000000.0 + 1000.0 * np.arange(nx)
+        y = ds.createVariable('y', 'f4', ('y',))
+        y.setncatts({'units': 'm', 'standard_name': 'projection_y_coordinate'})
+        y[:] = 1000000.0 - 1000.0 * np.arange(ny)
+        lat = ds.createVariable('lat', 'f4', ('y', 'x'))
+        lat[:] = np.linspace(50.0, 40.0, ny)[:, np.newaxis].repeat(nx, axis=1)
+        lon = ds.createVariable('lon', 'f4', ('y', 'x'))
+        lon[:] = np.linspace(-120.0, -105.0, nx)[np.newaxis, :].repeat(ny, axis=0)
+        crs = ds.createVariable('lambert_conformal_conic', 'i2')
+        crs.setncatts({'grid_mapping_name': 'lambert_conformal_conic', 'longitude_of_central_meridian': -100.0,
+                       'latitude_of_projection_origin': 42.5, 'standard_parallel': [25.0, 60.0]})
+        time = ds.createVariable('time', 'f4', ('time',))
+        time.setncatts({'units': 'days since 1980-01-01 00:00:00 UTC', 'calendar': 'standard',
+                        'bounds': 'time_bnds'})
+        start = (np.datetime64(str(year) + '-01-01') - np.datetime64('1980-01-01')).astype(int)
+        time[:] = start + 0.5 + np.arange(ndays)
+        bounds = ds.createVariable('time_bnds', 'f4', ('time', 'nv'))
+        bounds[:] = np.stack([start + np.arange(ndays), start + 1 + np.arange(ndays)], axis=1)
+        yearday = ds.createVariable('yearday', 'i2', ('time',))
+        yearday[:] = np.arange(1, ndays + 1)
+        var = ds.createVariable(variable, 'f4', ('time', 'y', 'x'), fill_value=NO_DATA_VALUE,
+                                chunksizes=(1, min(ny, 1000), min(nx, 1000)))
+        var.setncatts({'missing_value': NO_DATA_VALUE, 'grid_mapping': 'lambert_conformal_conic',
+                       'coordinates': 'lat lon'})
+        nodata_cols = int(nx * nodata_fraction)
+        season = np.sin(np.arange(ndays) * 2 * np.pi / 365.0)
+        for day in range(ndays):
+            grid = (low + (high - low) * (0.5 + 0.5 * season[day]) *
+                    rng.random((ny, nx), dtype=np.float32)).astype(np.float32)
+            grid[:, :nodata_cols] = NO_DATA_VALUE
+            var[day, :, :] = grid
+    return os.path.getsize(fn)
+
+
+def makeDaymetYears(data_dir, variable, years, ny, nx, seed=0):
+    """
+    Write synthetic Daymet files named like Daymet downloads (daymet_v3_<variable>_<year>_na.nc4)
+    Args:
+        data_dir: directory to write the files to
+        variable: Daymet variable
+        years: iterable of years
+        ny: number of rows
+        nx: number of columns
+        seed: random seed (default: 0)
+
+    Returns:
+        filename pattern with %year% in place of the year, and the total size of the files in bytes
+
+    """
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+    fn_base = os.path.join(data_dir, 'daymet_v3_' + variable + '_%year%_na.nc4')
+    nbytes = 0
+    for year in years:
+        fn = fn_base.replace('%year%', str(year))
+        if not os.path.exists(fn):
+            makeDaymetFile(fn, variable, year, ny, nx, seed=seed)
+        nbytes += os.path.getsize(fn)
+    return fn_base, nbytes
+
+
+def makePRISMGrid(fn, rows, cols, seed=0):
+    """
+    Write a float32 BIL grid with the .hdr sidecar of a PRISM monthly grid
+    Args:
+        fn: output .bil filename
+        rows: number of rows
+        cols: number of columns
+        seed: random seed (default: 0)
+
+    Returns:
+        list of the files written (.bil and .hdr)
+
+    """
+    rng = np.random.default_rng(seed)
+    grid = (rng.random((rows, cols), dtype=np.float32) * 200.0).astype('<f4')
+    grid[:, :cols // 5] = NO_DATA_VALUE
+    grid.tofile(fn)
+    hdr_fn = os.path.splitext(fn)[0] + '.hdr'
+    with open(hdr_fn, 'w') as f:
+        f.write(PRISM_HEADER.replace('%rows%', str(rows)).replace('%cols%', str(cols))
+                .replace('%rowbytes%', str(cols * 4)))
+    return [fn, hdr_fn]
+
+
+def makePRISMYears(data_dir, variable, years, rows, cols, archives=False, seed=0):
+    """
+    Write synthetic monthly PRISM grids into data_dir/<year>, laid out as downloadMonthlyPRISM_FTP leaves them
+    Args:
+        data_dir: directory to write the grids to
+        variable: PRISM variable (ppt, tmin, tmax, tmean)
+        years: iterable of years
+        rows: number of rows
+        cols: number of columns
+        archives: also write each month (or each historical year) into its zip archive (default: False)
+        seed: random seed (default: 0)
+
+    Returns:
+        total size of the .bil files in bytes
+
+    """
+    import hydat.utils as utils
+    nbytes = 0
+    for year in years:
+        year_dir = os.path.join(data_dir, str(year))
+        if not os.path.exists(year_dir):
+            os.makedirs(year_dir)
+        for month in range(1, 13):
+            fn = os.path.join(year_dir, utils.getPRISMFilename(year, month, variable))
+            if not os.path.exists(fn):
+                written = makePRISMGrid(fn, rows, cols, seed=seed + year * 12 + month)
+                if archives:
+                    zip_fn = os.path.join(year_dir, utils.getPRISMArchiveName(year, month, variable))
+                    with zipfile.ZipFile(zip_fn, 'a', zipfile.ZIP_DEFLATED) as z:
+                        for member in written:
+                            z.write(member, os.path.basename(member))
+            nbytes += os.path.getsize(fn)
+    return nbytes
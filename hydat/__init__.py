@@ -1,3 +1,11 @@
-import hydat.prism
-import hydat.daymet
-import hydat.gis
\ No newline at end of file
+import importlib
+
+# submodules are imported on first access (hydat.daymet, hydat.gis, ...) so importing hydat stays cheap
+SUBMODULES = ['aggregate', 'bil', 'cache', 'cli', 'climatology', 'dataset', 'daymet', 'download', 'gis',
+              'incremental', 'instrument', 'lazy', 'ncss', 'points', 'prism', 'reproject', 'runner', 'utils', 'zonal']
+
+
+def __getattr__(name):
+    if name in SUBMODULES:
+        return importlib.import_module('hydat.' + name)
+    raise AttributeError("module 'hydat' has no attribute '" + name + "'")
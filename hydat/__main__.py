@@ -0,0 +1,4 @@
+import sys
+import hydat.cli
+
+sys.exit(hydat.cli.main())
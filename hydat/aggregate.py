@@ -0,0 +1,321 @@
+import os
+import numpy as np
+import netCDF4 as nc
+import hydat.gis as gis
+import hydat.daymet as daymet
+import hydat.incremental as incremental
+import hydat.instrument as instrument
+
+STATISTICS = ['sum', 'mean', 'min', 'max', 'delta', 'diffsum', 'accum']
+PERIODS = {'month': list(range(1, 13)), 'season': [1, 3, 6, 9, 12]}  # first month of each period
+
+
+def getPeriodStarts(year, ndays=365, period='month'):
+    """
+    Find the first day of each period of a year of daily Daymet data. Daymet years always have 365 days; on leap
+    years December 31 is dropped, so February has 29 days and December has 30.
+    Args:
+        year: year of the data
+        ndays: number of days in the data (default: 365)
+        period: 'month', 'season' (Jan-Feb, Mar-May, Jun-Aug, Sep-Nov, Dec), or a list of the first month of each
+            period; the first period always starts on January 1 (default: 'month')
+
+    Returns:
+        array of zero based day indices
+
+    """
+    if isinstance(period, str):
+        if period not in PERIODS:
+            raise ValueError("'" + period + "' is an invalid period. Must be one of " + str(list(PERIODS.keys())) +
+                             " or a list of months")
+        period = PERIODS[period]
+    months = sorted(set([1] + list(period)))
+    if months[0] < 1 or months[-1] > 12:
+        raise ValueError("period months must be between 1 and 12")
+    month_start = np.concatenate(([0], daymet.getMonthEndList(year)[:-1]))
+    return np.minimum(month_start[np.array(months) - 1], ndays - 1)
+
+
+def reducePeriods(data, starts, stats, prev=None):
+    """
+    Compute statistics of each period of a block of daily data in one vectorized pass
+    Args:
+        data: (time, y, x) float array with no data as nan
+        starts: first day index of each period
+        stats: statistics to compute; any of sum, mean, min, max, delta (last minus first day of the period),
+            diffsum (sum of day to day changes, including the change from the day before the period), and accum
+            (sum of day to day increases)
+        prev: (y, x) array of the day before data begins, used for day to day changes; if None the change on the
+            first day is zero (default: None)
+
+    Returns:
+        dictionary of {statistic: (period, y, x) float64 array with no data as nan}
+
+    """
+    for stat in stats:
+        if stat not in STATISTICS:
+            raise ValueError("'" + stat + "' is an invalid statistic. Must be one of " + str(STATISTICS))
+    starts = np.asarray(starts)
+    ends = np.append(starts[1:], data.shape[0])
+    out = {}
+    if 'sum' in stats or 'mean' in stats:
+        valid = ~np.isnan(data)
+        count = np.add.reduceat(valid, starts, axis=0, dtype=np.int32)
+        total = np.add.reduceat(np.where(valid, data, 0.0), starts, axis=0, dtype=np.float64)
+        total[count == 0] = np.nan
+        if 'sum' in stats:
+            out['sum'] = total
+        if 'mean' in stats:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                out['mean'] = total / count
+    if 'min' in stats:
+        out['min'] = np.fmin.reduceat(data, starts, axis=0).astype(np.float64)
+    if 'max' in stats:
+        out['max'] = np.fmax.reduceat(data, starts, axis=0).astype(np.float64)
+    if 'delta' in stats:
+        out['delta'] = data[ends - 1].astype(np.float64) - data[starts]
+    if 'diffsum' in stats or 'accum' in stats:
+        if prev is None:
+            prev = data[0]
+        diff = np.diff(data, axis=0, prepend=prev[np.newaxis, :, :]).astype(np.float64)
+        if 'diffsum' in stats:
+            out['diffsum'] = np.add.reduceat(diff, starts, axis=0)
+        if 'accum' in stats:
+            out['accum'] = np.add.reduceat(np.maximum(diff, 0.0), starts, axis=0)
+    return out
+
+
+def readDays(var, days=slice(None), rows=slice(None), cols=slice(None)):
+    """
+    Read daily data with no data as nan
+    Args:
+        var: (time, y, x) NetCDF variable
+        days: time index or slice (default: all)
+        rows: row slice (default: all)
+        cols: column slice (default: all)
+
+    Returns:
+        float array
+
+    """
+    data = var[days, rows, cols]
+    data = np.ma.filled(data.astype(np.result_type(data.dtype, np.float32)), np.nan)
+    data[data == daymet.NO_DATA_VALUE] = np.nan
+    return data
+
+
+def aggregateDaily(fn_in, varname, stats, year, period='month', tile_size=None, fn_prev=None):
+    """
+    Compute period statistics of a year of daily Daymet data, reading each tile of the daily data once. The
+    statistics of the whole grid are returned in memory; use aggregateTiles and writeTiles to write them to a file a
+    tile at a time instead.
+    Args:
+        fn_in: filename of daily Daymet data, or a year of a hydat.dataset.MultiYearDataset
+        varname: variable to summarize
+        stats: statistics to compute, see reducePeriods
+        year: year of the data
+        period: period definition, see getPeriodStarts (default: 'month')
+        tile_size: process the grid in tiles of this many rows and columns (default: None)
+        fn_prev: filename or MultiYearDataset year of the previous year of daily data, whose last day starts the day
+            to day changes (default: None)
+
+    Returns:
+        dictionary of {statistic: (period, y, x) float64 array with no data as nan}
+
+    """
+    shape = gridShape(fn_in, varname)
+    nperiods = len(getPeriodStarts(year, shape[0], period))
+    out = {stat: np.full((nperiods, shape[1], shape[2]), np.nan) for stat in stats}
+    for rows, cols, block in aggregateTiles(fn_in, varname, stats, year, period, tile_size, fn_prev):
+        for stat in stats:
+            out[stat][:, rows, cols] = block[stat]
+    return out
+
+
+def aggregateTiles(fn_in, varname, stats, year, period='month', tile_size=None, fn_prev=None):
+    """
+    Compute period statistics of a year of daily Daymet data one tile at a time, reading each tile of the daily data
+    once, so only one tile of daily data and its statistics are held in memory
+    Args:
+        fn_in: filename of daily Daymet data, or a year of a hydat.dataset.MultiYearDataset
+        varname: variable to summarize
+        stats: statistics to compute, see reducePeriods
+        year: year of the data
+        period: period definition, see getPeriodStarts (default: 'month')
+        tile_size: process the grid in tiles of this many rows and columns (default: None)
+        fn_prev: filename or MultiYearDataset year of the previous year of daily data, whose last day starts the day
+            to day changes (default: None)
+
+    Returns:
+        generator of (rows, cols, {statistic: (period, rows, cols) float64 array with no data as nan}) for each tile
+
+    """
+    opened = []
+    try:
+        var = _openVariable(fn_in, varname, opened)
+        shape = var.shape
+        starts = getPeriodStarts(year, shape[0], period)
+        var_prev = None
+        if fn_prev is not None and ('diffsum' in stats or 'accum' in stats):
+            var_prev = _openVariable(fn_prev, varname, opened)
+        instrument.count('files_processed')
+        for rows, cols in daymet.getTiles(shape[1], shape[2], tile_size):
+            prev = None
+            if var_prev is not None:
+                prev = readDays(var_prev, -1, rows, cols)
+            block = readDays(var, slice(None), rows, cols)
+            instrument.count('cells_processed', block.size)
+            yield rows, cols, reducePeriods(block, starts, stats, prev)
+    finally:
+        for ds in opened:
+            ds.close()
+
+
+def gridShape(src, varname):
+    """
+    Args:
+        src: filename of daily Daymet data, or a year of a hydat.dataset.MultiYearDataset
+        varname: variable to read
+
+    Returns:
+        (time, y, x) shape of the variable
+
+    """
+    opened = []
+    try:
+        return tuple(_openVariable(src, varname, opened).shape)
+    finally:
+        for ds in opened:
+            ds.close()
+
+
+def _openVariable(src, varname, opened):
+    # a filename is opened and appended to opened; anything else is sliced like a (time, y, x) variable
+    if not isinstance(src, str):
+        return src
+    ds = nc.Dataset(src)
+    opened.append(ds)
+    return ds[varname]
+
+
+def createStatistics(fn_template, fn_out, names, nperiods, storage=None):
+    """
+    Create a NetCDF file for period statistics, to be written with writeTiles
+    Args:
+        fn_template: filename of the daily dataset used as a template
+        fn_out: output filename
+        names: dictionary of {statistic: output variable name}
+        nperiods: number of periods
+        storage: dictionary of NetCDF chunking and compression options (default: None)
+
+    Returns:
+
+    """
+    gis.createPeriodNetCDF(fn_template, fn_out, list(names.values()),
+                           exclude_vars=[name for name in daymet.VARIABLES.values()], ntime=nperiods,
+                           **(storage or {}))
+
+
+def writeTiles(fn_out, tiles, names):
+    """
+    Write period statistics into the (time, y, x) variables of an existing NetCDF file a tile at a time
+    Args:
+        fn_out: filename of a file created by createStatistics, or any file with the output variables
+        tiles: iterable of (rows, cols, {statistic: (period, rows, cols) array with no data as nan}), e.g. from
+            aggregateTiles
+        names: dictionary of {statistic: output variable name}
+
+    Returns:
+
+    """
+    with nc.Dataset(fn_out, 'r+') as ds_out:
+        for rows, cols, stats in tiles:
+            for stat, values in stats.items():
+                ds_out[names[stat]][:, rows, cols] = np.where(np.isnan(values), daymet.NO_DATA_VALUE, values)
+
+
+def writeStatistics(fn_template, fn_out, stats, names, storage=None):
+    """
+    Write period statistics to a new NetCDF file
+    Args:
+        fn_template: filename of the daily dataset used as a template
+        fn_out: output filename
+        stats: dictionary of {statistic: (period, y, x) array with no data as nan}
+        names: dictionary of {statistic: output variable name}
+        storage: dictionary of NetCDF chunking and compression options (default: None)
+
+    Returns:
+
+    """
+    createStatistics(fn_template, fn_out, {stat: names[stat] for stat in stats}, list(stats.values())[0].shape[0],
+                     storage)
+    writeTiles(fn_out, [(slice(None), slice(None), stats)], names)
+
+
+def periodStatistics(year_start, year_end, output_dir, fn_base, varname, stats, period='month', tile_size=None,
+                     workers=1, storage=None, incremental=False, dry_run=False):
+    """
+    Compute any set of period statistics for a range of years with one read of the daily data per year. Each year is
+    written to <varname>_<period>_<year>.nc in output_dir with one variable per statistic named <varname>_<statistic>.
+    Args:
+        year_start: first year to process
+        year_end: last year to process
+        output_dir: directory to save output files
+        fn_base: filename of daily Daymet data with %year% in place of the year, or a hydat.dataset.MultiYearDataset
+            of varname to read the years from through its block cache
+        varname: variable to summarize
+        stats: statistics to compute, see reducePeriods
+        period: 'month', 'season', or a list of the first month of each period (default: 'month')
+        tile_size: process the grid in tiles of this many rows and columns (default: None)
+        workers: number of processes to spread years across; None uses all cores (default: 1)
+        storage: dictionary of NetCDF chunking and compression options for the output file (default: None)
+        incremental: only process years whose output is missing or whose inputs or parameters changed since it was
+            built, as recorded in hydat_manifest.json in output_dir (default: False)
+        dry_run: only return the list of years that would be processed incrementally (default: False)
+
+    Returns:
+        dictionary of {year: output filename or exception}
+
+    """
+    def inputs(year):
+        fns = [_yearFilename(fn_base, year)]
+        if year > year_start and ('diffsum' in stats or 'accum' in stats):
+            fns.append(_yearFilename(fn_base, year - 1))
+        return fns
+
+    return _runIncremental(_periodStatisticsYear, range(year_start, year_end+1),
+                           lambda year: _outputName(output_dir, varname, period, year), inputs,
+                           params={'varname': varname, 'stats': list(stats), 'period': period, 'storage': storage},
+                           args=(year_start, output_dir, fn_base, varname, list(stats), period, tile_size, storage),
+                           workers=workers, dry_run=dry_run, rebuild_stale=incremental)
+
+
+def _runIncremental(func, years, output, inputs, rebuild_stale=False, dry_run=False, **kwargs):
+    # periodStatistics takes an incremental flag, which hides the incremental module inside it
+    return incremental.runIncremental(func, years, output, inputs, dry_run=dry_run,
+                                      force=not (rebuild_stale or dry_run), **kwargs)
+
+
+def _outputName(output_dir, varname, period, year):
+    period_name = period if isinstance(period, str) else 'period'
+    return os.path.join(output_dir, varname + "_" + period_name + "_" + str(year) + ".nc")
+
+
+def _yearFilename(fn_base, year):
+    if isinstance(fn_base, str):
+        return fn_base.replace("%year%", str(year))
+    return fn_base.filename(year)
+
+
+def _periodStatisticsYear(year, year_start, output_dir, fn_base, varname, stats, period, tile_size, storage):
+    fn_in = _yearFilename(fn_base, year)
+    fn_prev = _yearFilename(fn_base, year - 1) if year > year_start else None
+    fn_out = _outputName(output_dir, varname, period, year)
+    src = fn_in
+    if not isinstance(fn_base, str):
+        src = fn_base.year(year)
+        fn_prev = fn_base.year(year - 1) if year > year_start and year - 1 in fn_base.years else None
+    names = {stat: varname + "_" + stat for stat in stats}
+    createStatistics(fn_in, fn_out, names, len(getPeriodStarts(year, gridShape(src, varname)[0], period)), storage)
+    writeTiles(fn_out, aggregateTiles(src, varname, stats, year, period, tile_size, fn_prev), names)
+    return fn_out
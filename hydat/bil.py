@@ -0,0 +1,86 @@
+import os
+import numpy as np
+
+PIXEL_TYPES = {'FLOAT': 'f', 'SIGNEDINT': 'i', 'UNSIGNEDINT': 'u'}
+
+
+def readHeader(fn):
+    """
+    Parse the ESRI .hdr sidecar of a BIL raster
+    Args:
+        fn: filename of the .bil raster or its .hdr
+
+    Returns:
+        dictionary of upper case header keys with integer values for the layout fields, and the NumPy dtype of the
+        cells under 'DTYPE'
+
+    """
+    hdr_fn = os.path.splitext(fn)[0] + '.hdr'
+    header = {}
+    with open(hdr_fn) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2:
+                header[parts[0].upper()] = parts[1]
+    if header.get('LAYOUT', 'BIL').upper() != 'BIL':
+        raise ValueError("only BIL layout is supported, " + hdr_fn + " is " + header['LAYOUT'])
+    for key in ['NROWS', 'NCOLS']:
+        header[key] = int(header[key])
+    header['NBANDS'] = int(header.get('NBANDS', 1))
+    header['NBITS'] = int(header.get('NBITS', 8))
+    header['SKIPBYTES'] = int(header.get('SKIPBYTES', 0))
+    nbytes = header['NBITS'] // 8
+    header['BANDROWBYTES'] = int(header.get('BANDROWBYTES', header['NCOLS'] * nbytes))
+    header['TOTALROWBYTES'] = int(header.get('TOTALROWBYTES', header['BANDROWBYTES'] * header['NBANDS']))
+    byteorder = '>' if header.get('BYTEORDER', 'I').upper() in ['M', 'MSBFIRST'] else '<'
+    kind = PIXEL_TYPES[header.get('PIXELTYPE', 'UNSIGNEDINT').upper()]
+    header['DTYPE'] = np.dtype(byteorder + kind + str(nbytes))
+    if 'NODATA' in header:
+        header['NODATA'] = float(header['NODATA'])
+    return header
+
+
+def openBIL(fn, band=1, header=None):
+    """
+    Memory map one band of a BIL raster without copying it
+    Args:
+        fn: filename of the .bil raster
+        band: band number starting from 1 (default: 1)
+        header: header returned by readHeader (default: None, read from the .hdr sidecar)
+
+    Returns:
+        read only (rows, columns) array view of the file
+
+    """
+    if header is None:
+        header = readHeader(fn)
+    if band < 1 or band > header['NBANDS']:
+        raise ValueError("band must be between 1 and " + str(header['NBANDS']))
+    raw = np.memmap(fn, dtype=np.uint8, mode='r')
+    return np.ndarray((header['NROWS'], header['NCOLS']), dtype=header['DTYPE'], buffer=raw,
+                      offset=header['SKIPBYTES'] + (band - 1) * header['BANDROWBYTES'],
+                      strides=(header['TOTALROWBYTES'], header['DTYPE'].itemsize))
+
+
+def readGrid(fn, band=1):
+    """
+    Read one band of a raster, memory mapping BIL files with a .hdr sidecar and opening anything else (including
+    /vsizip/ paths) with GDAL
+    Args:
+        fn: raster filename
+        band: band number starting from 1 (default: 1)
+
+    Returns:
+        (rows, columns) array; a read only view of the file for BIL rasters
+
+    """
+    if fn.lower().endswith('.bil') and not fn.startswith('/vsi') and \
+            os.path.exists(os.path.splitext(fn)[0] + '.hdr'):
+        return openBIL(fn, band)
+    import gdal  # only needed for formats the native reader does not handle
+    ds = gdal.Open(fn)
+    if ds is None:
+        raise IOError("could not open " + fn)
+    grid = ds.GetRasterBand(band).ReadAsArray()
+    ds = None
+    return grid
@@ -0,0 +1,214 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import urllib.parse
+try:
+    import fcntl
+except ImportError:  # not available on Windows, cache writes are still atomic but eviction is not serialized
+    fcntl = None
+
+LINKED_SUFFIX = '.linked'  # marks cached files placed as symbolic links
+
+
+def normalizeURL(url):
+    """
+    Normalize a URL so equivalent requests share a cache key
+    Args:
+        url: URL to normalize
+
+    Returns:
+        normalized URL (string); scheme and host are lower case, repeated slashes in the path are collapsed and query
+        parameters are sorted
+
+    """
+    parts = urllib.parse.urlsplit(url.strip())
+    path = parts.path
+    while '//' in path:
+        path = path.replace('//', '/')
+    query = urllib.parse.urlencode(sorted(urllib.parse.parse_qsl(parts.query, keep_blank_values=True)))
+    return urllib.parse.urlunsplit((parts.scheme.lower(), parts.netloc.lower(), path, query, ''))
+
+
+class DownloadCache:
+    """
+    Content cache for downloaded files shared between projects and worker processes. Files are stored under a key
+    derived from the normalized request URL, written atomically, and evicted least recently used first once the cache
+    grows beyond max_bytes.
+    """
+    def __init__(self, cache_dir, max_bytes=50 * 1024 ** 3, link='hard'):
+        """
+        Args:
+            cache_dir: directory holding the cache
+            max_bytes: maximum total size of cached files in bytes (default: 50 GB)
+            link: how hits are placed at the target path; 'hard' (hard link), 'symbolic' (symbolic link), or 'copy';
+                hard and symbolic links fall back to copying when the file system does not support them. Hard links
+                and copies keep their data when the cached file is evicted; files placed as symbolic links are
+                marked and never evicted, unless evict is called with linked=True (default: 'hard')
+
+        """
+        if link not in ['hard', 'symbolic', 'copy']:
+            raise ValueError("link must be one of 'hard', 'symbolic', or 'copy'")
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self.link = link
+        self.objects = os.path.join(self.cache_dir, 'objects')
+        if not os.path.exists(self.objects):
+            os.makedirs(self.objects, exist_ok=True)
+
+    def key(self, url):
+        return hashlib.sha256(normalizeURL(url).encode('utf-8')).hexdigest()
+
+    def path(self, url):
+        key = self.key(url)
+        return os.path.join(self.objects, key[:2], key)
+
+    def contains(self, url):
+        return os.path.isfile(self.path(url))
+
+    def fetch(self, url, fn, download):
+        """
+        Place the file for url at fn, downloading it into the cache first if it is not already cached
+        Args:
+            url: URL of the file
+            fn: target filename; an existing file is replaced
+            download: function called as download(url, filename) that saves url to filename
+
+        Returns:
+            True if the file was served from the cache, False if it was downloaded
+
+        """
+        cached = self.path(url)
+        hit = self.touch(cached)
+        if not hit:
+            self.put(url, download, evict=False)
+        try:
+            self.place(cached, fn)
+        except FileNotFoundError:  # evicted by another process after it was checked or downloaded
+            hit = False
+            self.put(url, download, evict=False)
+            self.place(cached, fn)
+        if not hit:
+            self.evict(keep=cached)
+        return hit
+
+    def put(self, url, download, evict=True):
+        """
+        Download url into the cache. The file is downloaded to a temporary name inside the cache and renamed into
+        place, so concurrent readers never see a partial file.
+        Args:
+            url: URL of the file
+            download: function called as download(url, filename) that saves url to filename
+            evict: evict least recently used files afterwards, never the new file (default: True)
+
+        Returns:
+            path to the cached file
+
+        """
+        cached = self.path(url)
+        if not os.path.exists(os.path.dirname(cached)):
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(cached), suffix='.tmp')
+        os.close(fd)
+        os.remove(tmp)  # downloaders may refuse to write to an existing file
+        try:
+            download(url, tmp)
+            os.replace(tmp, cached)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        if evict:
+            self.evict(keep=cached)
+        return cached
+
+    def place(self, cached, fn):
+        if os.path.lexists(fn):
+            os.remove(fn)
+        if self.link == 'hard':
+            try:
+                os.link(cached, fn)
+                return
+            except OSError:
+                pass
+        elif self.link == 'symbolic':
+            open(cached + LINKED_SUFFIX, 'w').close()  # evicting the file would leave the link dangling
+            try:
+                os.symlink(cached, fn)
+                return
+            except OSError:
+                os.remove(cached + LINKED_SUFFIX)
+        shutil.copy2(cached, fn)
+
+    def touch(self, cached):
+        """
+        Mark a cached file as recently used
+        Args:
+            cached: path to the cached file
+
+        Returns:
+            True if the file exists in the cache
+
+        """
+        try:
+            os.utime(cached, None)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def size(self):
+        return sum(entry[2] for entry in self.entries())
+
+    def entries(self):
+        """
+        List cached files
+
+        Returns:
+            list of (path, last use time, size in bytes) tuples
+
+        """
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.objects):
+            for name in filenames:
+                if '.tmp' in name or name.endswith(LINKED_SUFFIX):  # download in progress, or marker
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:  # evicted by another process
+                    continue
+                entries.append((path, stat.st_mtime, stat.st_size))
+        return entries
+
+    def evict(self, max_bytes=None, keep=None, linked=False):
+        """
+        Remove least recently used files until the cache is no larger than max_bytes
+        Args:
+            max_bytes: size limit in bytes (default: the cache limit)
+            keep: path of a cached file that is not removed, e.g. one that was just downloaded (default: None)
+            linked: also remove files placed as symbolic links, leaving those links dangling (default: False)
+
+        Returns:
+            number of bytes removed
+
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        with open(os.path.join(self.cache_dir, '.lock'), 'w') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = sorted(self.entries(), key=lambda entry: entry[1])
+            total = sum(entry[2] for entry in entries)
+            removed = 0
+            for path, used, size in entries:
+                if total - removed <= max_bytes:
+                    break
+                if path == keep or (not linked and os.path.exists(path + LINKED_SUFFIX)):
+                    continue
+                try:
+                    os.remove(path)  # hard links and copies at target paths keep their data
+                    removed += size
+                except FileNotFoundError:
+                    pass
+                if os.path.exists(path + LINKED_SUFFIX):
+                    os.remove(path + LINKED_SUFFIX)
+        return removed
@@ -0,0 +1,223 @@
+import sys
+import json
+import time
+import logging
+import inspect
+import argparse
+import importlib
+import hydat.instrument as instrument
+
+# job spec task name: (module, function); functions are imported only when a job uses them
+TASKS = {'downloadDaymet': ('hydat.daymet', 'downloadDaymet'),
+         'downloadDaymetBatch': ('hydat.daymet', 'downloadDaymetBatch'),
+         'downloadDaymetTiled': ('hydat.ncss', 'downloadDaymetTiled'),
+         'downloadPRISM': ('hydat.cli', 'downloadPRISM'),
+         'downloadMonthlyPRISM_FTP': ('hydat.utils', 'downloadMonthlyPRISM_FTP'),
+         'dailySWEAccumulation': ('hydat.daymet', 'dailySWEAccumulation'),
+         'montlyAverageDayl': ('hydat.daymet', 'montlyAverageDayl'),
+         'monthlySWEAccumulation': ('hydat.daymet', 'monthlySWEAccumulation'),
+         'monthlySWEMax': ('hydat.daymet', 'monthlySWEMax'),
+         'monthlyWaterInput': ('hydat.daymet', 'monthlyWaterInput'),
+         'periodStatistics': ('hydat.aggregate', 'periodStatistics'),
+         'monthlyGridsToNumpy': ('hydat.utils', 'monthlyGridsToNumpy')}
+
+
+def downloadPRISM(fn, var, res='4km', year=None, month=None, day=None, normals=False, overwrite=True, extract=True,
+                  extract_dir=None, remove_zip=True):
+    """
+    Download a PRISM grid through the PRISM web service; see PRISMDownloader.downloadWebServices
+
+    Returns:
+        fn
+
+    """
+    import hydat.prism
+    hydat.prism.PRISMDownloader().downloadWebServices(fn, var, res, year, month, day, normals, overwrite, extract,
+                                                      extract_dir, remove_zip)
+    return fn
+
+
+def loadSpec(fn):
+    """
+    Read a job spec
+    Args:
+        fn: JSON or YAML (.yaml, .yml; requires PyYAML) filename
+
+    Returns:
+        list of jobs, each a dictionary with a task, a name, and the keyword arguments of the task; values under
+        'defaults' in the spec are used for arguments a job does not set and the task accepts, and years may be
+        given as {start: <first year>, end: <last year>}
+
+    """
+    with open(fn) as f:
+        if fn.lower().endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError("reading YAML job specs requires PyYAML (pip install pyyaml)")
+            spec = yaml.safe_load(f)
+        else:
+            spec = json.load(f)
+    if isinstance(spec, list):
+        spec = {'jobs': spec}
+    if not isinstance(spec, dict) or not isinstance(spec.get('jobs'), list):
+        raise ValueError(fn + ": a job spec must be a list of jobs or a mapping with a 'jobs' list")
+    defaults = spec.get('defaults', {})
+    jobs = []
+    for i, job in enumerate(spec['jobs']):
+        if not isinstance(job, dict) or job.get('task') not in TASKS:
+            raise ValueError(fn + ": job " + str(i + 1) + " must have a task, one of " + ', '.join(sorted(TASKS)))
+        kwargs = {key: value for key, value in job.items() if key not in ['task', 'name']}
+        jobs.append({'task': job['task'], 'name': job.get('name', job['task'] + '_' + str(i + 1)),
+                     'kwargs': kwargs, 'defaults': defaults})
+    return jobs
+
+
+def resolveJob(job):
+    """
+    Import the function of a job and bind its arguments
+    Args:
+        job: job dictionary from loadSpec
+
+    Returns:
+        tuple of the function and its keyword arguments
+
+    """
+    module, name = TASKS[job['task']]
+    func = getattr(importlib.import_module(module), name)
+    parameters = inspect.signature(func).parameters
+    kwargs = {key: value for key, value in job['defaults'].items() if key in parameters}
+    kwargs.update(job['kwargs'])
+    if isinstance(kwargs.get('years'), dict):  # {start, end} year range
+        kwargs['years'] = list(range(kwargs['years']['start'], kwargs['years']['end'] + 1))
+    try:
+        inspect.signature(func).bind(**kwargs)
+    except TypeError as e:
+        raise ValueError(job['name'] + ": " + str(e))
+    return func, kwargs
+
+
+def jobFailures(result):
+    """
+    Find failures in the return value of a task
+    Args:
+        result: value returned by a task function
+
+    Returns:
+        list of failure descriptions
+
+    """
+    failures = []
+    if isinstance(result, dict):
+        for key, value in result.items():
+            if isinstance(value, Exception):
+                failures.append(str(key) + ': ' + repr(value))
+    elif isinstance(result, list):
+        for record in result:
+            if isinstance(record, dict) and record.get('status') == 'failed':
+                failures.append(str(record.get('url')) + ': ' + str(record.get('error')))
+    return failures
+
+
+def runJobs(jobs, keep_going=False):
+    """
+    Run jobs in order
+    Args:
+        jobs: jobs from loadSpec
+        keep_going: run the remaining jobs after a job fails (default: False)
+
+    Returns:
+        list of {name, task, status, seconds, failures} dictionaries
+
+    """
+    resolved = [resolveJob(job) for job in jobs]  # check every job before running any
+    summary = []
+    for job, (func, kwargs) in zip(jobs, resolved):
+        start = time.perf_counter()
+        instrument.event('job', job=job['name'], task=job['task'])
+        try:
+            with instrument.stage(job['task'], job=job['name']):
+                failures = jobFailures(func(**kwargs))
+        except Exception as e:
+            failures = [repr(e)]
+        summary.append({'name': job['name'], 'task': job['task'], 'status': 'failed' if failures else 'ok',
+                        'seconds': time.perf_counter() - start, 'failures': failures})
+        if failures and not keep_going:
+            break
+    return summary
+
+
+class _Fanout(instrument.Instrumentation):
+    def __init__(self, receivers):
+        self.receivers = receivers
+
+    def event(self, name, fields):
+        for receiver in self.receivers:
+            receiver.event(name, fields)
+
+    def count(self, name, value):
+        for receiver in self.receivers:
+            receiver.count(name, value)
+
+    def timing(self, name, seconds, fields, counts):
+        for receiver in self.receivers:
+            receiver.timing(name, seconds, fields, counts)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='hydat', description='Download and process hydrologic data')
+    parser.add_argument('--log-level', default='WARNING', help='logging level; INFO logs progress (default: WARNING)')
+    commands = parser.add_subparsers(dest='command')
+    run = commands.add_parser('run', help='run the jobs of a JSON or YAML job spec')
+    run.add_argument('spec', help='job spec filename')
+    run.add_argument('--check', action='store_true', help='only validate the spec')
+    run.add_argument('--keep-going', action='store_true', help='run the remaining jobs after a job fails')
+    run.add_argument('--summary', help='JSON file to write the job summary and recorded metrics to')
+    commands.add_parser('tasks', help='list the tasks a job spec can use')
+    url = commands.add_parser('url', help='print the URL of a Daymet file')
+    url.add_argument('year', type=int)
+    url.add_argument('variable')
+    url.add_argument('--timestep', default='day')
+    url.add_argument('--region', default='na')
+    url.add_argument('--extent', type=float, nargs=4, metavar=('N', 'S', 'E', 'W'))
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    if args.command == 'tasks':
+        for task in sorted(TASKS):
+            print(task, '(' + '.'.join(TASKS[task]) + ')')
+        return 0
+    if args.command == 'url':
+        import hydat.daymet
+        print(hydat.daymet.buildDaymetURL(args.year, args.variable, args.timestep, args.region, args.extent))
+        return 0
+    if args.command != 'run':
+        parser.print_help()
+        return 2
+    jobs = loadSpec(args.spec)
+    if args.check:
+        for job in jobs:
+            resolveJob(job)
+            print(job['name'], job['task'], 'ok')
+        return 0
+    recorder = instrument.Recorder()
+    receivers = [recorder]
+    if logging.getLogger('hydat').isEnabledFor(logging.INFO):
+        receivers.append(instrument.LogInstrumentation())
+    previous = instrument.setInstrumentation(_Fanout(receivers))
+    try:
+        summary = runJobs(jobs, args.keep_going)
+    finally:
+        instrument.setInstrumentation(previous)
+    for job in summary:
+        print(job['name'], job['status'], '%.1f s' % job['seconds'])
+        for failure in job['failures']:
+            print('  ' + failure)
+    if args.summary is not None:
+        with open(args.summary, 'w') as f:
+            json.dump({'jobs': summary, 'metrics': recorder.summary()}, f, indent=1)
+    return 1 if any(job['status'] == 'failed' for job in summary) or len(summary) < len(jobs) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,303 @@
+import os
+import concurrent.futures
+import numpy as np
+import netCDF4 as nc
+import hydat.gis as gis
+import hydat.daymet as daymet
+import hydat.aggregate as aggregate
+import hydat.instrument as instrument
+
+
+class Climatology:
+    """
+    Per-pixel count, mean, and sum of squared deviations from the mean of period (e.g. monthly) values, updated one
+    year at a time with Welford's algorithm. Values that are nan or equal to the no data value are skipped, so every
+    pixel and period keeps its own count. Partial states over different years merge exactly (Chan et al.), and
+    states of disjoint spatial blocks are placed into the full grid.
+    """
+    def __init__(self, shape):
+        """
+        Args:
+            shape: shape of one year of values, e.g. (12, pixels) or (12, rows, columns)
+
+        """
+        self.count = np.zeros(shape, dtype=np.int32)
+        self.mean = np.zeros(shape, dtype=np.float64)
+        self.m2 = np.zeros(shape, dtype=np.float64)
+
+    def update(self, values, nodata=daymet.NO_DATA_VALUE):
+        """
+        Add one year of values
+        Args:
+            values: array with the shape of the climatology
+            nodata: no data value (default: -9999)
+
+        Returns:
+
+        """
+        values = np.asarray(values, dtype=np.float64)
+        valid = ~np.isnan(values)
+        if nodata is not None:
+            valid &= values != nodata
+        self.count += valid
+        delta = np.where(valid, values - self.mean, 0.0)
+        self.mean += np.divide(delta, self.count, out=np.zeros_like(delta), where=self.count > 0)
+        self.m2 += delta * np.where(valid, values - self.mean, 0.0)
+
+    def merge(self, other):
+        """
+        Combine with the state of other years of the same pixels
+        Args:
+            other: Climatology
+
+        Returns:
+
+        """
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        weight = np.divide(other.count, count, out=np.zeros(count.shape), where=count > 0)
+        self.mean += delta * weight
+        self.m2 += other.m2 + delta ** 2 * self.count * weight
+        self.count = count
+
+    def place(self, other, index):
+        """
+        Copy the state of a spatial block into this climatology
+        Args:
+            other: Climatology of the block
+            index: index of the block in this climatology, e.g. (slice(None), rows, cols)
+
+        Returns:
+
+        """
+        self.count[index] = other.count
+        self.mean[index] = other.mean
+        self.m2[index] = other.m2
+
+    def normals(self, min_count=1):
+        """
+        Args:
+            min_count: minimum number of values for a normal (default: 1)
+
+        Returns:
+            mean of each pixel and period, nan where fewer than min_count values were added
+
+        """
+        return np.where(self.count >= max(min_count, 1), self.mean, np.nan)
+
+    def std(self, ddof=1):
+        """
+        Args:
+            ddof: delta degrees of freedom; 1 for the sample standard deviation (default: 1)
+
+        Returns:
+            standard deviation of each pixel and period, nan where there are no more than ddof values
+
+        """
+        var = np.divide(self.m2, self.count - ddof, out=np.full(self.m2.shape, np.nan), where=self.count > ddof)
+        return np.sqrt(var)
+
+    def anomalies(self, values, standardize=False, nodata=daymet.NO_DATA_VALUE, ddof=1):
+        """
+        Departures of one year of values from the normals
+        Args:
+            values: array with the shape of the climatology
+            standardize: divide by the standard deviation (z-scores) (default: False)
+            nodata: no data value of values (default: -9999)
+            ddof: delta degrees of freedom of the standard deviation (default: 1)
+
+        Returns:
+            float64 array with nan where values or normals are missing
+
+        """
+        values = np.asarray(values, dtype=np.float64)
+        if nodata is not None:
+            values = np.where(values == nodata, np.nan, values)
+        anomalies = values - self.normals()
+        if standardize:
+            std = self.std(ddof)
+            anomalies = np.divide(anomalies, std, out=np.full(anomalies.shape, np.nan), where=std > 0)
+        return anomalies
+
+    def save(self, fn):
+        np.savez(fn, count=self.count, mean=self.mean, m2=self.m2)
+
+    @classmethod
+    def load(cls, fn):
+        with np.load(fn) as data:
+            clim = cls(data['count'].shape)
+            clim.count[:] = data['count']
+            clim.mean[:] = data['mean']
+            clim.m2[:] = data['m2']
+        return clim
+
+
+def stackClimatology(stack_fn, start_year, years=None, block_rows=262144, workers=1, nodata=-9999.0):
+    """
+    Compute monthly climatologies of each pixel of a monthlyGridsToNumpy stack in one pass over the years. The stack is
+    memory mapped and processed in blocks of pixels, which can be spread across processes.
+    Args:
+        stack_fn: .npy stack of (pixels, months) written by hydat.utils.monthlyGridsToNumpy
+        start_year: first year of the stack
+        years: years to include (default: None, all years in the stack)
+        block_rows: number of pixels per block (default: 262144)
+        workers: number of processes to spread blocks across; None uses all cores (default: 1)
+        nodata: no data value of the stack (default: -9999)
+
+    Returns:
+        Climatology of shape (12, pixels)
+
+    """
+    stack = np.load(stack_fn, mmap_mode='r')
+    npix, ncol = stack.shape
+    del stack
+    if years is None:
+        years = range(start_year, start_year + ncol // 12)
+    columns = [(year - start_year) * 12 for year in years]
+    if any(column < 0 or column + 12 > ncol for column in columns):
+        raise ValueError("years must be within " + str(start_year) + "-" + str(start_year + ncol // 12 - 1))
+    blocks = [slice(start, min(start + block_rows, npix)) for start in range(0, npix, block_rows)]
+    clim = Climatology((12, npix))
+    for rows, part in _mapBlocks(_stackBlock, blocks, (stack_fn, columns, nodata), workers):
+        clim.place(part, (slice(None), rows))
+    return clim
+
+
+def _stackBlock(rows, stack_fn, columns, nodata):
+    stack = np.load(stack_fn, mmap_mode='r')
+    part = Climatology((12, rows.stop - rows.start))
+    for column in columns:
+        part.update(stack[rows, column:column + 12].T, nodata)
+        instrument.count('cells_processed', 12 * (rows.stop - rows.start))
+    return part
+
+
+def netcdfClimatology(fn_base, varname, years, tile_size=None, workers=1):
+    """
+    Compute period climatologies of each pixel of yearly (period, y, x) NetCDF outputs, e.g. monthlyWaterInput or
+    periodStatistics files, in one pass over the years. Tiles of the grid can be spread across processes.
+    Args:
+        fn_base: filename of the yearly files with %year% in place of the year
+        varname: variable to summarize
+        years: iterable of years
+        tile_size: process the grid in tiles of this many rows and columns (integer or tuple) (default: None)
+        workers: number of processes to spread tiles across; None uses all cores (default: 1)
+
+    Returns:
+        Climatology of shape (periods, y, x)
+
+    """
+    fns = [fn_base.replace("%year%", str(year)) for year in years]
+    with nc.Dataset(fns[0]) as ds:
+        shape = ds[varname].shape
+    clim = Climatology(shape)
+    tiles = daymet.getTiles(shape[1], shape[2], tile_size)
+    for (rows, cols), part in _mapBlocks(_netcdfTile, tiles, (fns, varname), workers):
+        clim.place(part, (slice(None), rows, cols))
+    return clim
+
+
+def _netcdfTile(tile, fns, varname):
+    rows, cols = tile
+    part = None
+    for fn in fns:
+        with nc.Dataset(fn) as ds:
+            values = aggregate.readDays(ds[varname], slice(None), rows, cols)
+        if part is None:
+            part = Climatology(values.shape)
+        part.update(values, None)
+        instrument.count('cells_processed', values.size)
+    return part
+
+
+def _mapBlocks(func, blocks, args, workers):
+    if workers is None:
+        workers = os.cpu_count()
+    if workers == 1 or len(blocks) <= 1:
+        for block in blocks:
+            yield block, func(block, *args)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(blocks))) as executor:
+            futures = {executor.submit(func, block, *args): i for i, block in enumerate(blocks)}
+            for future in concurrent.futures.as_completed(futures):
+                yield blocks[futures[future]], future.result()
+
+
+def writeClimatologyNetCDF(fn_template, fn_out, clim, varname, ddof=1, storage=None):
+    """
+    Write normals, standard deviations, and counts to NetCDF (<varname>_mean, <varname>_std, <varname>_count)
+    Args:
+        fn_template: a yearly (period, y, x) or daily Daymet file on the same grid, used as a template
+        fn_out: output filename
+        clim: Climatology of shape (periods, y, x)
+        varname: name of the summarized variable
+        ddof: delta degrees of freedom of the standard deviation (default: 1)
+        storage: dictionary of NetCDF chunking and compression options (default: None)
+
+    Returns:
+
+    """
+    _writeGrids(fn_template, fn_out, {varname + '_mean': clim.normals(), varname + '_std': clim.std(ddof),
+                                      varname + '_count': clim.count}, [varname], storage)
+
+
+def writeAnomaliesNetCDF(fn_in, fn_out, clim, varname, standardize=False, ddof=1, storage=None):
+    """
+    Write the anomalies of one yearly (period, y, x) file to NetCDF as <varname>_anomaly
+    Args:
+        fn_in: yearly file
+        fn_out: output filename
+        clim: Climatology of shape (periods, y, x)
+        varname: variable of fn_in
+        standardize: write z-scores instead of departures (default: False)
+        ddof: delta degrees of freedom of the standard deviation (default: 1)
+        storage: dictionary of NetCDF chunking and compression options (default: None)
+
+    Returns:
+
+    """
+    with nc.Dataset(fn_in) as ds:
+        values = aggregate.readDays(ds[varname])
+    _writeGrids(fn_in, fn_out, {varname + '_anomaly': clim.anomalies(values, standardize, None, ddof)}, [varname],
+                storage)
+
+
+def _writeGrids(fn_template, fn_out, grids, exclude_vars, storage):
+    gis.createPeriodNetCDF(fn_template, fn_out, list(grids), ntime=list(grids.values())[0].shape[0],
+                           exclude_vars=list(daymet.VARIABLES.values()) + exclude_vars, **(storage or {}))
+    with nc.Dataset(fn_out, 'r+') as ds_out:
+        for name, values in grids.items():
+            ds_out[name][:] = np.where(np.isnan(values), daymet.NO_DATA_VALUE, values)
+        instrument.count('cells_written', sum(values.size for values in grids.values()))
+
+
+def writePeriodRaster(fn_out, values, rows, cols, geot, srs, pixels=None, nodata=-9999.0, compress=None):
+    """
+    Write period grids (e.g. normals or anomalies of a stack) as a multi-band GeoTIFF, one band per period, without
+    building the full (periods, rows, cols) array
+    Args:
+        fn_out: output filename
+        values: (periods, pixels) or (periods, rows, cols) array with nan as no data
+        rows: number of rows of the grid
+        cols: number of columns of the grid
+        geot: affine geotransformation of the grid, e.g. from a PRISM grid
+        srs: spatial reference of the grid
+        pixels: flat grid index of each pixel of values, from <stack>_pixels.npy of a compact stack (default: None)
+        nodata: no data value of the output (default: -9999)
+        compress: compression of the output; see hydat.gis.getCreationOptions (default: None)
+
+    Returns:
+
+    """
+    def bands():
+        for period in range(values.shape[0]):
+            if pixels is None:
+                grid = np.array(values[period], dtype=np.float32).reshape((rows, cols))
+            else:
+                grid = np.full(rows * cols, np.nan, dtype=np.float32)
+                grid[pixels] = values[period]
+                grid = grid.reshape((rows, cols))
+            yield grid
+
+    gis.writeBlocksAsRaster(fn_out, bands(), values.shape[0], rows, cols, geot, srs, nodata=nodata, nan=nodata,
+                            compress=compress)
@@ -0,0 +1,324 @@
+import threading
+import collections
+import numpy as np
+import netCDF4 as nc
+import hydat.daymet as daymet
+import hydat.instrument as instrument
+
+
+class FilePool:
+    """
+    Open NetCDF datasets shared by readers, keeping at most max_open files open and closing the least recently used
+    """
+    def __init__(self, max_open=16):
+        """
+        Args:
+            max_open: maximum number of open files (default: 16)
+
+        """
+        self.max_open = max_open
+        self.lock = threading.RLock()
+        self.files = collections.OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get(self, fn):
+        """
+        Args:
+            fn: NetCDF filename
+
+        Returns:
+            open netCDF4.Dataset; only use it while holding the pool's lock
+
+        """
+        with self.lock:
+            if fn in self.files:
+                self.files.move_to_end(fn)
+                return self.files[fn]
+            while len(self.files) >= self.max_open:
+                self.files.popitem(last=False)[1].close()
+            ds = nc.Dataset(fn)
+            self.files[fn] = ds
+            return ds
+
+    def close(self):
+        with self.lock:
+            while self.files:
+                self.files.popitem()[1].close()
+
+
+class BlockCache:
+    """
+    Least recently used cache of decoded arrays, bounded by their total size in bytes
+    """
+    def __init__(self, max_bytes=256 * 1024 ** 2):
+        """
+        Args:
+            max_bytes: maximum total size of the cached arrays (default: 256 MiB)
+
+        """
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.blocks = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            block = self.blocks.get(key)
+            if block is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.blocks.move_to_end(key)
+            return block
+
+    def put(self, key, block):
+        if block.nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.blocks:
+                return
+            self.blocks[key] = block
+            self.nbytes += block.nbytes
+            while self.nbytes > self.max_bytes:
+                self.nbytes -= self.blocks.popitem(last=False)[1].nbytes
+
+    def clear(self):
+        with self.lock:
+            self.blocks.clear()
+            self.nbytes = 0
+
+    def info(self):
+        """
+        Returns:
+            dictionary of hits, misses, cached blocks, and cached bytes
+
+        """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'blocks': len(self.blocks), 'bytes': self.nbytes}
+
+
+class MultiYearDataset:
+    """
+    A range of yearly (time, y, x) NetCDF files, e.g. daily Daymet data or yearly outputs, read as one virtual
+    (time, y, x) array. Slicing reads only the blocks of the files it needs; blocks are decoded to float with no data
+    as nan (like hydat.aggregate.readDays) and kept in a least recently used cache bounded in bytes, so blocks read
+    again are not read from disk. Files are opened through a FilePool.
+
+    Datasets can be passed to worker processes; each process reopens the files and starts with an empty cache.
+    """
+    def __init__(self, fn_base, varname, years, cache_bytes=256 * 1024 ** 2, block_shape=None, pool=None):
+        """
+        Args:
+            fn_base: filename of the yearly files with %year% in place of the year
+            varname: variable to read
+            years: iterable of consecutive or non consecutive years, in time order
+            cache_bytes: maximum size of the block cache (default: 256 MiB)
+            block_shape: (time, y, x) shape of the blocks read and cached (default: None, the chunk shape of each
+                file, or (32, 256, 256) for contiguous files)
+            pool: FilePool to open files with, shared with other datasets (default: None, a pool of 16 files)
+
+        """
+        self.fn_base = fn_base
+        self.varname = varname
+        self.years = list(years)
+        self.cache_bytes = cache_bytes
+        self.block_shape = block_shape
+        self.pool = pool if pool is not None else FilePool()
+        self.cache = BlockCache(cache_bytes)
+        if not self.years:
+            raise ValueError("years must not be empty")
+        self.lengths = []
+        self.blocks = []
+        shape = None
+        dtype = None
+        for year in self.years:
+            with self.pool.lock:
+                var = self.pool.get(self.filename(year))[varname]
+                if shape is not None and var.shape[1:] != shape:
+                    raise ValueError(self.filename(year) + " has a different grid than " +
+                                     self.filename(self.years[0]))
+                shape = var.shape[1:]
+                dtype = np.result_type(var.dtype, np.float32)
+                self.lengths.append(var.shape[0])
+                self.blocks.append(self._blockShape(var))
+        self.offsets = np.concatenate([[0], np.cumsum(self.lengths)]).astype(int)
+        self.shape = (int(self.offsets[-1]),) + tuple(shape)
+        self.dtype = dtype
+        self.ndim = 3
+
+    def __getstate__(self):
+        return {'fn_base': self.fn_base, 'varname': self.varname, 'years': self.years,
+                'cache_bytes': self.cache_bytes, 'block_shape': self.block_shape}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def close(self):
+        self.pool.close()
+        self.cache.clear()
+
+    def filename(self, year):
+        return self.fn_base.replace("%year%", str(year))
+
+    def timeSlice(self, year):
+        """
+        Args:
+            year: year of the dataset
+
+        Returns:
+            slice of the time steps of year in the virtual array
+
+        """
+        i = self.years.index(year)
+        return slice(int(self.offsets[i]), int(self.offsets[i + 1]))
+
+    def year(self, year):
+        """
+        Args:
+            year: year of the dataset
+
+        Returns:
+            YearView of the time steps of year, which can be passed to the aggregation functions in place of a file
+
+        """
+        return YearView(self, year)
+
+    def cacheInfo(self):
+        return self.cache.info()
+
+    def _blockShape(self, var):
+        if self.block_shape is not None:
+            return tuple(self.block_shape)
+        chunking = var.chunking()
+        if chunking == 'contiguous' or chunking is None:
+            return (32, 256, 256)
+        return tuple(chunking)
+
+    def __getitem__(self, key):
+        key, squeeze = _normalizeKey(key, self.shape)
+        (start, stop, step), rows, cols = key
+        out = np.full([len(range(*k)) for k in key], np.nan, dtype=self.dtype)
+        for i in range(len(self.years)):
+            begin, end = self.offsets[i], self.offsets[i + 1]
+            first = max(0, -(-(begin - start) // step))  # first output step in file i
+            last = min(out.shape[0], -(-(end - start) // step))
+            if first >= last:
+                continue
+            local = (start + first * step - begin, start + (last - 1) * step - begin + 1, step)
+            self._readFile(i, (local, rows, cols), out, first)
+        instrument.count('cells_read', out.size)
+        return np.squeeze(out, axis=squeeze) if squeeze else out
+
+    def _readFile(self, i, key, out, offset):
+        block_shape = self.blocks[i]
+        nblocks = [self.lengths[i], self.shape[1], self.shape[2]]
+        for bt, local_t, out_t in _axisBlocks(key[0], block_shape[0], offset):
+            for by, local_y, out_y in _axisBlocks(key[1], block_shape[1]):
+                for bx, local_x, out_x in _axisBlocks(key[2], block_shape[2]):
+                    block = self._block(i, (bt, by, bx), block_shape, nblocks)
+                    out[out_t, out_y, out_x] = block[local_t, local_y, local_x]
+
+    def _block(self, i, index, block_shape, size):
+        key = (i,) + index
+        block = self.cache.get(key)
+        if block is not None:
+            instrument.count('cache_hits')
+            return block
+        instrument.count('cache_misses')
+        window = tuple(slice(b * n, min((b + 1) * n, s)) for b, n, s in zip(index, block_shape, size))
+        with self.pool.lock:
+            data = self.pool.get(self.filename(self.years[i]))[self.varname][window]
+        block = np.ma.filled(data.astype(self.dtype), np.nan)
+        block[block == daymet.NO_DATA_VALUE] = np.nan
+        self.cache.put(key, block)
+        return block
+
+
+class YearView:
+    """
+    The time steps of one year of a MultiYearDataset, sliced like the (time, y, x) variable of the yearly file
+    """
+    def __init__(self, dataset, year):
+        self.dataset = dataset
+        self.time = dataset.timeSlice(year)
+        self.shape = (self.time.stop - self.time.start,) + dataset.shape[1:]
+        self.dtype = dataset.dtype
+        self.ndim = 3
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        days = key[0]
+        if isinstance(days, slice):
+            start, stop, step = days.indices(self.shape[0])
+            if step < 0:
+                raise IndexError("negative steps are not supported")
+            days = slice(self.time.start + start, self.time.start + max(start, stop), step)
+        else:
+            days = int(days)
+            if days < 0:
+                days += self.shape[0]
+            if not 0 <= days < self.shape[0]:
+                raise IndexError("index " + str(key[0]) + " is out of bounds for " + str(self.shape[0]) + " days")
+            days += self.time.start
+        return self.dataset[(days,) + key[1:]]
+
+
+def _normalizeKey(key, shape):
+    # (start, stop, step) of each axis and the axes indexed by an integer
+    if not isinstance(key, tuple):
+        key = (key,)
+    if len(key) > len(shape):
+        raise IndexError("too many indices for a " + str(len(shape)) + " dimensional dataset")
+    key = key + (slice(None),) * (len(shape) - len(key))
+    ranges = []
+    squeeze = []
+    for axis, (k, n) in enumerate(zip(key, shape)):
+        if isinstance(k, slice):
+            start, stop, step = k.indices(n)
+            if step < 0:
+                raise IndexError("negative steps are not supported")
+            ranges.append((start, max(start, stop), step))
+        else:
+            index = int(k)
+            if index < 0:
+                index += n
+            if not 0 <= index < n:
+                raise IndexError("index " + str(k) + " is out of bounds for axis " + str(axis) + " with size " +
+                                 str(n))
+            ranges.append((index, index + 1, 1))
+            squeeze.append(axis)
+    return ranges, tuple(squeeze)
+
+
+def _axisBlocks(key, size, offset=0):
+    # yield the block number, the slice within the block, and the slice of the output for each block a range touches
+    start, stop, step = key
+    if start >= stop:
+        return
+    n = len(range(start, stop, step))
+    for block in range(start // size, (stop - 1) // size + 1):
+        first = max(0, -(-(block * size - start) // step))
+        last = min(n, -(-((block + 1) * size - start) // step))
+        if first < last:
+            local = slice(start + first * step - block * size, start + (last - 1) * step - block * size + 1, step)
+            yield block, local, slice(offset + first, offset + last)
@@ -1,20 +1,41 @@
-import wget
 import os
-import netCDF4 as nc
-import numpy as np
-import hydat.gis as gis
-
+import json
+import time
+import itertools
+import threading
+import concurrent.futures
+import urllib.parse
+import hydat.incremental as incremental
+import hydat.instrument as instrument
+from hydat.lazy import lazyImport
+
+# loaded on first use, so building URLs does not import the HTTP client and only processing imports the rest
+download = lazyImport('hydat.download')
+nc = lazyImport('netCDF4')
+np = lazyImport('numpy')
+gis = lazyImport('hydat.gis')
+aggregate = lazyImport('hydat.aggregate')
+
+# base URL of the Daymet THREDDS server; set HYDAT_THREDDS_URL or assign hydat.daymet.THREDDS_URL to use a mirror
+THREDDS_URL = os.environ.get('HYDAT_THREDDS_URL', 'https://thredds.daac.ornl.gov/thredds/')
 TIMESTEP = {"day": 1328, "month": 1345, "year": 1343}
 VARIABLES = {"Minimum Temperature": "tmin", "Maximum Temperature": "tmax", "Precipitation": "prcp",
              "Day Length": "dayl", "Shortwave Radiation": "srad", "Snow-Water Equivalent": "swe",
              "Vapor Pressure": "vp"}
 REGIONS = {"North America": "na", "Hawaii": "hawaii", "Puerto Rico": "puertorico"}
-MONTH_END = np.cumsum(np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]))
-MONTH_END_LEAP = np.cumsum(np.array([31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]))
+MONTH_END = list(itertools.accumulate([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]))
+MONTH_END_LEAP = list(itertools.accumulate([31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]))
 NO_DATA_VALUE = -9999.0  # Daymet no data value
+# output filenames of the yearly processing functions
+OUTPUTS = {'dailySWEAccumulation': 'swe_accum_day_%year%.nc',
+           'montlyAverageDayl': 'dayl_avg_s_%year%.nc',
+           'monthlySWEAccumulation': 'swe_accum_%year%.nc',
+           'monthlySWEMax': 'swe_max_%year%.nc',
+           'monthlyWaterInput': 'water_input_%year%.nc'}
 
 
-def buildDaymetURL(year, variable, timestep='day', region='na', extent=None, stride=1):
+def buildDaymetURL(year, variable, timestep='day', region='na', extent=None, stride=1, time_start=None,
+                   time_end=None):
     """
     Build URL to download DayMet data by DayMet region
     Args:
@@ -25,7 +46,9 @@ def buildDaymetURL(year, variable, timestep='day', region='na', extent=None, str
         timestep: day, month, or year
         region: one of na (North America), hawaii (Hawaii), or puertorico (Puerto Rico)
         extent: list of bounding coordinates [n, s, e, w]
-        stride: time stride (default: 1)
+        stride: time and horizontal stride (default: 1)
+        time_start: first date of daily subsets as 'YYYY-MM-DD' (default: January 1)
+        time_end: last date of daily subsets as 'YYYY-MM-DD' (default: December 31)
 
     Returns:
         url (string) to download data for a region
@@ -35,18 +58,22 @@ def buildDaymetURL(year, variable, timestep='day', region='na', extent=None, str
     checkInputs(extent, region, timestep, variable)
     if extent is not None:
         if timestep == "day":
-            url = "https://thredds.daac.ornl.gov/thredds/ncss/ornldaac/" + str(TIMESTEP[timestep]) + "/" + str(year) + \
+            if time_start is None:
+                time_start = str(year) + "-01-01"
+            if time_end is None:
+                time_end = str(year) + "-12-31"
+            url = THREDDS_URL + "ncss/ornldaac/" + str(TIMESTEP[timestep]) + "/" + str(year) + \
                   "/daymet_v3_" + variable + "_" + str(year) + "_" + region + ".nc4?var=" + variable + "&north=" + \
                   str(extent[0]) + "&west=" + str(extent[3]) + "&east=" + str(extent[2]) + "&south=" + str(extent[1]) + \
-                  "&disableProjSubset=on&horizStride=" + str(stride) + "&time_start=" + str(year) + \
-                  "-01-01T12%3A00%3A00Z&time_end=" + str(year) + "-12-31T12%3A00%3A00Z&timeStride=" + str(stride) + \
+                  "&disableProjSubset=on&horizStride=" + str(stride) + "&time_start=" + time_start + \
+                  "T12%3A00%3A00Z&time_end=" + time_end + "T12%3A00%3A00Z&timeStride=" + str(stride) + \
                   "&accept=netcdf"
         elif timestep == "month":
             if variable == "prcp":
                 sumstat = "monttl"
             else:
                 sumstat = "monavg"
-            url = "https://thredds.daac.ornl.gov/thredds/ncss/ornldaac/" + str(TIMESTEP[timestep]) + \
+            url = THREDDS_URL + "ncss/ornldaac/" + str(TIMESTEP[timestep]) + \
                   "/daymet_v3_" + variable + "_" + sumstat + "_" + str(year) + "_" + region + ".nc4?var=" + variable + "&north=" + \
                   str(extent[0]) + "&west=" + str(extent[3]) + "&east=" + str(extent[2]) + "&south=" + str(extent[1]) + \
                   "&disableProjSubset=on&horizStride=" + str(stride) + "&time_start=" + str(year) + \
@@ -57,14 +84,14 @@ def buildDaymetURL(year, variable, timestep='day', region='na', extent=None, str
                 sumstat = "annttl"
             else:
                 sumstat = "annavg"
-            url = "https://thredds.daac.ornl.gov/thredds/ncss/ornldaac/" + str(TIMESTEP[timestep]) + \
+            url = THREDDS_URL + "ncss/ornldaac/" + str(TIMESTEP[timestep]) + \
                   "/daymet_v3_" + variable + "_" + sumstat + "_" + str(year) + "_" + region + ".nc4?var=" + variable + "&north=" + \
                   str(extent[0]) + "&west=" + str(extent[3]) + "&east=" + str(extent[2]) + "&south=" + str(extent[1]) + \
                   "&disableProjSubset=on&horizStride=" + str(stride) + "&time_start=" + str(year) + \
                   "-01-01T12%3A00%3A00Z&time_end=" + str(year) + "-12-31T12%3A00%3A00Z&timeStride=" + str(stride) + \
                   "&accept=netcdf"
     else:
-        urlbase = 'https://thredds.daac.ornl.gov/thredds/fileServer/ornldaac/' + str(TIMESTEP[timestep]) + '/'
+        urlbase = THREDDS_URL + 'fileServer/ornldaac/' + str(TIMESTEP[timestep]) + '/'
         if timestep == "day":
             url = urlbase + str(year) + '/daymet_v3_' + variable + '_' + str(year) + '_' + region + '.nc4'
         elif timestep == "month":
@@ -124,7 +151,8 @@ def checkVariable(variable):
                          str(list(VARIABLES.values())))
 
 
-def downloadDaymet(fn, year, variable, timestep='day', region='na', extent=None, overwrite=False):
+def downloadDaymet(fn, year, variable, timestep='day', region='na', extent=None, overwrite=False, cache=None,
+                   stride=1, segments=1, checksum=None):
     """
     Downloads Datmet climate data.
     Args:
@@ -134,25 +162,136 @@ def downloadDaymet(fn, year, variable, timestep='day', region='na', extent=None,
         timestep: one of 'day' (default), 'month', or 'year'; not that not all timesteps are available fore all variables
         region: one of 'na' (default), 'hawaii', or 'puertorico'
         extent: list of geographic coordinates (decimal degrees) in the format [north, south, east, west]
-        overwrite: should download overwrite an existing file (default: False)
+        overwrite: should download overwrite an existing file; if False an existing file is kept (default: False)
+        cache: hydat.cache.DownloadCache to serve repeated requests from (default: None)
+        stride: time and horizontal stride of subsets, only used with an extent (default: 1)
+        segments: number of byte ranges of a large file to download in parallel (default: 1)
+        checksum: expected checksum of the file as '<algorithm>:<hex digest>' (default: None)
 
     Returns:
 
     """
-    url = buildDaymetURL(year, variable, timestep, region, extent)
+    url = buildDaymetURL(year, variable, timestep, region, extent, stride)
     if overwrite:
         if os.path.exists(fn):
             os.remove(fn)
-    print(url)
-    wget.download(url, fn)
+    elif os.path.exists(fn):
+        return
+    instrument.event('download', url=url)
+    if cache is not None:
+        cache.fetch(url, fn, lambda url, fn: download.downloadFile(url, fn, segments=segments, checksum=checksum))
+    else:
+        download.downloadFile(url, fn, segments=segments, checksum=checksum)
     return
 
 
+def downloadDaymetBatch(output_dir, years, variables, timesteps=('day',), regions=('na',), extent=None,
+                        overwrite=False, max_workers=4, max_per_host=2, manifest_fn=None, cache=None):
+    """
+    Downloads Daymet climate data for every combination of years, variables, timesteps, and regions using a pool of
+    threads. Combinations that Daymet does not provide (e.g. monthly swe) are skipped and recorded in the manifest.
+    Args:
+        output_dir: directory to save data; files are named after the file in the download URL
+        years: iterable of years for which to download data
+        variables: iterable of variables; see downloadDaymet
+        timesteps: iterable of timesteps (default: ('day',))
+        regions: iterable of regions (default: ('na',))
+        extent: list of geographic coordinates (decimal degrees) in the format [north, south, east, west]
+        overwrite: should download overwrite existing files (default: False)
+        max_workers: maximum number of concurrent downloads (default: 4)
+        max_per_host: maximum number of concurrent downloads from a single host (default: 2)
+        manifest_fn: filename of the JSON job manifest (default: daymet_manifest.json in output_dir)
+        cache: hydat.cache.DownloadCache to serve repeated requests from (default: None)
+
+    Returns:
+        list of manifest records, one per requested file
+
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    if manifest_fn is None:
+        manifest_fn = os.path.join(output_dir, 'daymet_manifest.json')
+    records = []
+    jobs = []
+    for year, variable, timestep, region in itertools.product(years, variables, timesteps, regions):
+        record = {'year': year, 'variable': variable, 'timestep': timestep, 'region': region, 'url': None,
+                  'fn': None, 'status': 'pending', 'bytes': 0, 'seconds': 0.0, 'cached': False, 'error': None}
+        records.append(record)
+        try:
+            record['url'] = buildDaymetURL(year, variable, timestep, region, extent)
+        except ValueError as e:
+            record['status'] = 'skipped'
+            record['error'] = str(e)
+            continue
+        record['fn'] = os.path.join(output_dir, os.path.basename(urllib.parse.urlparse(record['url']).path))
+        if os.path.exists(record['fn']) and not overwrite:
+            record['status'] = 'exists'
+            record['bytes'] = os.path.getsize(record['fn'])
+            continue
+        jobs.append(record)
+
+    fetchRecords(jobs, max_workers, max_per_host, cache)
+
+    with open(manifest_fn, 'w') as f:
+        json.dump(records, f, indent=2)
+    return records
+
+
+def fetchRecords(records, max_workers=4, max_per_host=2, cache=None, retries=0):
+    """
+    Download files on a bounded pool of threads with a limit on concurrent downloads from each host
+    Args:
+        records: list of dictionaries with 'url' and 'fn' keys; status ('downloaded' or 'failed'), bytes, seconds,
+            cached, attempts, and error are set on each record
+        max_workers: maximum number of concurrent downloads (default: 4)
+        max_per_host: maximum number of concurrent downloads from a single host (default: 2)
+        cache: hydat.cache.DownloadCache to serve repeated requests from (default: None)
+        retries: number of times to retry a failed download (default: 0)
+
+    Returns:
+        records
+
+    """
+    host_limits = {}
+    for record in records:
+        host = urllib.parse.urlparse(record['url']).netloc
+        if host not in host_limits:
+            host_limits[host] = threading.Semaphore(max_per_host)
+
+    def fetch(record):
+        with host_limits[urllib.parse.urlparse(record['url']).netloc]:
+            start = time.time()
+            record['attempts'] = 0
+            while True:
+                record['attempts'] += 1
+                try:
+                    if os.path.exists(record['fn']):
+                        os.remove(record['fn'])
+                    if cache is not None:
+                        record['cached'] = cache.fetch(record['url'], record['fn'], download.downloadFile)
+                    else:
+                        download.downloadFile(record['url'], record['fn'])
+                    record['status'] = 'downloaded'
+                    record['bytes'] = os.path.getsize(record['fn'])
+                    record['error'] = None
+                    break
+                except Exception as e:
+                    record['status'] = 'failed'
+                    record['error'] = str(e)
+                    if record['attempts'] > retries:
+                        break
+            record['seconds'] = time.time() - start
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(fetch, records))
+    return records
+
+
 def getMonthEndList(year):
     if leap_year(year):
-        return MONTH_END_LEAP
+        return np.array(MONTH_END_LEAP)
     else:
-        return MONTH_END
+        return np.array(MONTH_END)
 
 
 def leap_year(y):
@@ -166,20 +305,60 @@ def leap_year(y):
         return False
 
 
-def dailySWEAccumulation(year_start, year_end, output_dir, fn_base):
+def dailySWEAccumulation(year_start, year_end, output_dir, fn_base, chunk_days=None, workers=1, storage=None,
+                         incremental=False, dry_run=False):
+    """
+    Calculate the daily change in SWE for a range of years. The change on the first day of each year is calculated
+    from the last day of the previous year.
+    Args:
+        year_start: first year to process
+        year_end: last year to process
+        output_dir: directory to save output files (swe_accum_day_<year>.nc)
+        fn_base: filename of daily Daymet SWE data with %year% in place of the year
+        chunk_days: number of days to read, difference, and write at a time; if None each day is processed
+            individually (default: None)
+        workers: number of processes to spread years across; None uses all cores (default: 1)
+        storage: dictionary of NetCDF chunking and compression options for the output file, passed to
+            hydat.gis.copyNetCDF (layout, chunksizes, zlib, complevel, shuffle) (default: None)
+        incremental: only process years whose output is missing or whose inputs or parameters changed since it was
+            built, as recorded in hydat_manifest.json in output_dir (default: False)
+        dry_run: only return the list of years that would be processed incrementally (default: False)
+
+    Returns:
+        dictionary of {year: output filename or exception}
+
+    """
+    def inputs(year):
+        fns = [fn_base.replace("%year%", str(year))]
+        if year > year_start:
+            fns.append(fn_base.replace("%year%", str(year - 1)))
+        return fns
+
+    return _runIncremental(_dailySWEAccumulationYear, range(year_start, year_end+1),
+                           _outputName(output_dir, 'dailySWEAccumulation'), inputs,
+                           params={'chunk_days': chunk_days, 'storage': storage},
+                           args=(year_start, output_dir, fn_base, chunk_days, storage),
+                           workers=workers, dry_run=dry_run, rebuild_stale=incremental)
+
+
+def _dailySWEAccumulationYear(year, year_start, output_dir, fn_base, chunk_days, storage):
     varname = 'swe'
-    swe_prev = None
     swe = None
-    os.chdir(output_dir)
-    for year in range(year_start, year_end+1):
-        fn = fn_base.replace("%year%", str(year))
-        fn_out = "swe_accum_day_" + str(year) + ".nc"
-        gis.copyNetCDF(fn, fn_out, exclude_data=['swe'])
-        ds_out = nc.Dataset(fn_out, 'r+')
-        ds = nc.Dataset(fn)
-        ndays = ds.variables['swe'].shape[0]
+    if year > year_start:
+        with nc.Dataset(fn_base.replace("%year%", str(year - 1))) as ds_prev:
+            swe = ds_prev[varname][-1, :, :]
+            swe[swe == NO_DATA_VALUE] = np.nan
+    fn = fn_base.replace("%year%", str(year))
+    fn_out = _outputName(output_dir, 'dailySWEAccumulation')(year)
+    gis.copyNetCDF(fn, fn_out, exclude_data=['swe'], **(storage or {}))
+    ds_out = nc.Dataset(fn_out, 'r+')
+    ds = nc.Dataset(fn)
+    ndays = ds.variables['swe'].shape[0]
+    if chunk_days is not None:
+        _differenceDays(ds[varname], ds_out[varname], chunk_days, None if swe is None else np.ma.filled(swe, np.nan))
+    else:
         for day in range(0, ndays):
-            if swe_prev is None:
+            if swe is None:
                 swe_prev = ds[varname][day, :, :]
             else:
                 swe_prev = swe
@@ -187,74 +366,242 @@ def dailySWEAccumulation(year_start, year_end, output_dir, fn_base):
             swe[swe == NO_DATA_VALUE] = np.nan
             ds_out[varname][day, :, :] = np.subtract(swe, swe_prev)
             ds_out[varname][day, :, :][np.isnan(ds_out[varname][day, :, :])] = NO_DATA_VALUE
-            print("day", day)
-        ds_out.close()
-    return
+    instrument.count('files_processed')
+    instrument.count('cells_processed', ds[varname].size)
+    ds.close()
+    ds_out.close()
+    return fn_out
 
 
-def montlyAverageDayl(year_start, year_end, output_dir, dayl_base):
-    varname = 'dayl'
-    daylname = 'daylavg'
-    os.chdir(output_dir)
-    for year in range(year_start, year_end+1):
-        fn_out = "dayl_avg_s_" + str(year) + ".nc"
-        fn_in = dayl_base.replace("%year%", str(year))
-        gis.createMonthlyDaylNetCDF(fn_in, fn_out, daylname)
-        ds_dayl = nc.Dataset(fn_in)
-        month_dayl = np.zeros((12, ds_dayl.variables[varname].shape[1], ds_dayl.variables[varname].shape[2]))
-        month_end_day = getMonthEndList(year)
-        month_end_day[-1] = 365  # Daymet drops data for Dec 31 on leap years
-        day_start = 0
-        for i in range(0, len(month_end_day)):
-            month_dat = ds_dayl[varname][day_start:month_end_day[i], :, :]
-            month_dat[month_dat == NO_DATA_VALUE] = np.nan
-            month_dayl[i, :, :] = np.average(month_dat, axis=0)
-            day_start = month_end_day[i]
-        ds_out = nc.Dataset(fn_out, 'r+')
-        month_dayl[np.isnan(month_dayl)] = NO_DATA_VALUE
-        ds_out[daylname][:] = month_dayl
-        ds_out.close()
-        print(year, "monthly dayl average finished")
-
-
-def monthlySWEAccumulation(year_start, year_end, output_dir, swe_base):
+def _differenceDays(var_in, var_out, chunk_days, prev=None):
+    """
+    Write the day to day difference of a (time, y, x) variable, reading and writing chunk_days at a time
+    Args:
+        var_in: input variable
+        var_out: output variable
+        chunk_days: number of days per block
+        prev: last day preceding the first day of var_in (no data as nan); if None the first day has no change
 
-    varname = 'swe'
-    accumname = 'swe_accum'
-    os.chdir(output_dir)
-    for year in range(year_start, year_end+1):
-        fn_out = "swe_accum_" + str(year) + ".nc"
-        fn_in = swe_base.replace("%year%", str(year))
-        gis.createMonthlySWENetCDF(fn_in, fn_out, accumname)
-        ds_swe = nc.Dataset(fn_in)
-        month_swe = np.zeros((12, ds_swe.variables['swe'].shape[1], ds_swe.variables['swe'].shape[2]))
-        month_end_day = getMonthEndList(year)
-        month_end_day[-1] = 365  # Daymet drops data for Dec 31 on leap years
-        for i in range(0, len(month_end_day)):
-            end_day = month_end_day[i] - 1
-            swe_start = ds_swe[varname][i, :, :]
-            swe_start[swe_start == NO_DATA_VALUE] = np.nan
-            # print(ds_swe[varname].shape, end_day, month_end_day)
-            swe_end = ds_swe[varname][end_day, :, :]
-            swe_end[swe_end == NO_DATA_VALUE] = np.nan
-            month_swe[i, :, :] = np.subtract(swe_end, swe_start)
-        month_swe[np.isnan(month_swe)] = NO_DATA_VALUE
-        ds_out = nc.Dataset(fn_out, 'r+')
-        ds_out[accumname][:] = month_swe
-        ds_out.close()
-        print(year, "monthly SWE accumulation finished")
-
-
-def monthlySWEMax():
-    return
+    Returns:
+        last day of var_in with no data as nan, to carry into the next call
+
+    """
+    ndays = var_in.shape[0]
+    for start in range(0, ndays, chunk_days):
+        stop = min(start + chunk_days, ndays)
+        block = np.ma.filled(var_in[start:stop, :, :].astype(np.result_type(var_in.dtype, np.float32)), np.nan)
+        block[block == NO_DATA_VALUE] = np.nan
+        if prev is None:
+            prev = block[0]
+        diff = np.diff(block, axis=0, prepend=prev[np.newaxis, :, :])
+        diff[np.isnan(diff)] = NO_DATA_VALUE
+        var_out[start:stop, :, :] = diff
+        prev = block[-1]
+    return prev
 
 
-def monthlyWaterInput(year_start, year_end, output_dir, ppt_base, swe_base):
+def _outputName(output_dir, function):
+    return lambda year: os.path.join(output_dir, OUTPUTS[function].replace("%year%", str(year)))
 
-    os.chdir(output_dir)
-    for year in range(year_start, year_end+1):
-        ds_ppt = nc.Dataset(ppt_base.replace("%year%", str(year)))
-        ds_swe = nc.Dataset(swe_base.replace("%year%", str(year)))
-        month = 1
-        ndays = ds_ppt.variables['ppt'].shape[0]
-    return
+
+def _runIncremental(func, years, output, inputs, rebuild_stale=False, dry_run=False, **kwargs):
+    # the public functions take an incremental flag, which hides the incremental module inside them
+    return incremental.runIncremental(func, years, output, inputs, dry_run=dry_run,
+                                      force=not (rebuild_stale or dry_run), **kwargs)
+
+
+def getTiles(ny, nx, tile_size=None):
+    """
+    Split a grid into rectangular tiles
+    Args:
+        ny: number of rows in the grid
+        nx: number of columns in the grid
+        tile_size: tile size as an integer or (rows, columns) tuple; if None the whole grid is one tile (default: None)
+
+    Returns:
+        list of (row slice, column slice) tuples
+
+    """
+    if tile_size is None:
+        tile_size = (ny, nx)
+    elif np.isscalar(tile_size):
+        tile_size = (tile_size, tile_size)
+    tiles = []
+    for y in range(0, ny, tile_size[0]):
+        for x in range(0, nx, tile_size[1]):
+            tiles.append((slice(y, min(y + tile_size[0], ny)), slice(x, min(x + tile_size[1], nx))))
+    return tiles
+
+
+def montlyAverageDayl(year_start, year_end, output_dir, dayl_base, tile_size=None, workers=1, storage=None,
+                      incremental=False, dry_run=False):
+    """
+    Calculate monthly average day length for a range of years
+    Args:
+        year_start: first year to process
+        year_end: last year to process
+        output_dir: directory to save output files (dayl_avg_s_<year>.nc)
+        dayl_base: filename of daily Daymet day length data with %year% in place of the year
+        tile_size: process the grid in tiles of this many rows and columns (integer or tuple) to bound memory use;
+            if None the whole grid is processed at once (default: None)
+        workers: number of processes to spread years across; None uses all cores (default: 1)
+        storage: dictionary of NetCDF chunking and compression options for the output file, passed to
+            hydat.gis.copyNetCDF (layout, chunksizes, zlib, complevel, shuffle) (default: None)
+        incremental: only process years whose output is missing or whose inputs or parameters changed since it was
+            built, as recorded in hydat_manifest.json in output_dir (default: False)
+        dry_run: only return the list of years that would be processed incrementally (default: False)
+
+    Returns:
+        dictionary of {year: output filename or exception}
+
+    """
+    return _runIncremental(_monthlyAverageDaylYear, range(year_start, year_end+1),
+                           _outputName(output_dir, 'montlyAverageDayl'),
+                           lambda year: [dayl_base.replace("%year%", str(year))],
+                           params={'storage': storage},
+                           args=(output_dir, dayl_base, tile_size, storage),
+                           workers=workers, dry_run=dry_run, rebuild_stale=incremental)
+
+
+def _monthlyAverageDaylYear(year, output_dir, dayl_base, tile_size, storage):
+    fn_out = _outputName(output_dir, 'montlyAverageDayl')(year)
+    fn_in = dayl_base.replace("%year%", str(year))
+    gis.createMonthlyDaylNetCDF(fn_in, fn_out, 'daylavg', **(storage or {}))
+    aggregate.writeTiles(fn_out, aggregate.aggregateTiles(fn_in, 'dayl', ['mean'], year, tile_size=tile_size),
+                         {'mean': 'daylavg'})
+    return fn_out
+
+
+def monthlySWEAccumulation(year_start, year_end, output_dir, swe_base, tile_size=None, workers=1, storage=None,
+                           incremental=False, dry_run=False):
+    """
+    Calculate monthly SWE accumulation for a range of years
+    Args:
+        year_start: first year to process
+        year_end: last year to process
+        output_dir: directory to save output files (swe_accum_<year>.nc)
+        swe_base: filename of daily Daymet SWE data with %year% in place of the year
+        tile_size: process the grid in tiles of this many rows and columns (integer or tuple) to bound memory use;
+            if None the whole grid is processed at once (default: None)
+        workers: number of processes to spread years across; None uses all cores (default: 1)
+        storage: dictionary of NetCDF chunking and compression options for the output file, passed to
+            hydat.gis.copyNetCDF (layout, chunksizes, zlib, complevel, shuffle) (default: None)
+        incremental: only process years whose output is missing or whose inputs or parameters changed since it was
+            built, as recorded in hydat_manifest.json in output_dir (default: False)
+        dry_run: only return the list of years that would be processed incrementally (default: False)
+
+    Returns:
+        dictionary of {year: output filename or exception}
+
+    """
+    return _runIncremental(_monthlySWEAccumulationYear, range(year_start, year_end+1),
+                           _outputName(output_dir, 'monthlySWEAccumulation'),
+                           lambda year: [swe_base.replace("%year%", str(year))],
+                           params={'storage': storage},
+                           args=(output_dir, swe_base, tile_size, storage),
+                           workers=workers, dry_run=dry_run, rebuild_stale=incremental)
+
+
+def _monthlySWEAccumulationYear(year, output_dir, swe_base, tile_size, storage):
+    fn_out = _outputName(output_dir, 'monthlySWEAccumulation')(year)
+    fn_in = swe_base.replace("%year%", str(year))
+    gis.createMonthlySWENetCDF(fn_in, fn_out, 'swe_accum', **(storage or {}))
+    aggregate.writeTiles(fn_out, aggregate.aggregateTiles(fn_in, 'swe', ['delta'], year, tile_size=tile_size),
+                         {'delta': 'swe_accum'})
+    return fn_out
+
+
+def monthlySWEMax(year_start, year_end, output_dir, swe_base, tile_size=None, workers=1, storage=None,
+                  incremental=False, dry_run=False):
+    """
+    Calculate monthly maximum SWE for a range of years
+    Args:
+        year_start: first year to process
+        year_end: last year to process
+        output_dir: directory to save output files (swe_max_<year>.nc)
+        swe_base: filename of daily Daymet SWE data with %year% in place of the year
+        tile_size: process the grid in tiles of this many rows and columns (integer or tuple) to bound memory use;
+            if None the whole grid is processed at once (default: None)
+        workers: number of processes to spread years across; None uses all cores (default: 1)
+        storage: dictionary of NetCDF chunking and compression options for the output file, passed to
+            hydat.gis.copyNetCDF (layout, chunksizes, zlib, complevel, shuffle) (default: None)
+        incremental: only process years whose output is missing or whose inputs or parameters changed since it was
+            built, as recorded in hydat_manifest.json in output_dir (default: False)
+        dry_run: only return the list of years that would be processed incrementally (default: False)
+
+    Returns:
+        dictionary of {year: output filename or exception}
+
+    """
+    return _runIncremental(_monthlySWEMaxYear, range(year_start, year_end+1),
+                           _outputName(output_dir, 'monthlySWEMax'),
+                           lambda year: [swe_base.replace("%year%", str(year))],
+                           params={'storage': storage},
+                           args=(output_dir, swe_base, tile_size, storage),
+                           workers=workers, dry_run=dry_run, rebuild_stale=incremental)
+
+
+def _monthlySWEMaxYear(year, output_dir, swe_base, tile_size, storage):
+    fn_in = swe_base.replace("%year%", str(year))
+    fn_out = _outputName(output_dir, 'monthlySWEMax')(year)
+    aggregate.createStatistics(fn_in, fn_out, {'max': 'swe_max'}, 12, storage)
+    aggregate.writeTiles(fn_out, aggregate.aggregateTiles(fn_in, 'swe', ['max'], year, tile_size=tile_size),
+                         {'max': 'swe_max'})
+    return fn_out
+
+
+def monthlyWaterInput(year_start, year_end, output_dir, ppt_base, swe_base, tile_size=None, workers=1,
+                      storage=None, incremental=False, dry_run=False):
+    """
+    Calculate monthly water input (rain plus snowmelt) for a range of years as monthly precipitation minus the
+    monthly change in SWE. The change in SWE for January is calculated from the last day of the previous year.
+    Args:
+        year_start: first year to process
+        year_end: last year to process
+        output_dir: directory to save output files (water_input_<year>.nc)
+        ppt_base: filename of daily Daymet precipitation data with %year% in place of the year
+        swe_base: filename of daily Daymet SWE data with %year% in place of the year
+        tile_size: process the grid in tiles of this many rows and columns (integer or tuple) to bound memory use;
+            if None the whole grid is processed at once (default: None)
+        workers: number of processes to spread years across; None uses all cores (default: 1)
+        storage: dictionary of NetCDF chunking and compression options for the output file, passed to
+            hydat.gis.copyNetCDF (layout, chunksizes, zlib, complevel, shuffle) (default: None)
+        incremental: only process years whose output is missing or whose inputs or parameters changed since it was
+            built, as recorded in hydat_manifest.json in output_dir (default: False)
+        dry_run: only return the list of years that would be processed incrementally (default: False)
+
+    Returns:
+        dictionary of {year: output filename or exception}
+
+    """
+    def inputs(year):
+        fns = [ppt_base.replace("%year%", str(year)), swe_base.replace("%year%", str(year))]
+        if year > year_start:
+            fns.append(swe_base.replace("%year%", str(year - 1)))
+        return fns
+
+    return _runIncremental(_monthlyWaterInputYear, range(year_start, year_end+1),
+                           _outputName(output_dir, 'monthlyWaterInput'), inputs,
+                           params={'storage': storage},
+                           args=(year_start, output_dir, ppt_base, swe_base, tile_size, storage),
+                           workers=workers, dry_run=dry_run, rebuild_stale=incremental)
+
+
+def _monthlyWaterInputYear(year, year_start, output_dir, ppt_base, swe_base, tile_size, storage):
+    fn_ppt = ppt_base.replace("%year%", str(year))
+    fn_swe = swe_base.replace("%year%", str(year))
+    fn_prev = swe_base.replace("%year%", str(year - 1)) if year > year_start else None
+    fn_out = _outputName(output_dir, 'monthlyWaterInput')(year)
+    ppt = aggregate.aggregateTiles(fn_ppt, 'prcp', ['sum'], year, tile_size=tile_size)
+    swe = aggregate.aggregateTiles(fn_swe, 'swe', ['diffsum'], year, tile_size=tile_size, fn_prev=fn_prev)
+    aggregate.createStatistics(fn_ppt, fn_out, {'water_input': 'water_input'}, 12, storage)
+    aggregate.writeTiles(fn_out, _waterInputTiles(ppt, swe), {'water_input': 'water_input'})
+    return fn_out
+
+
+def _waterInputTiles(ppt, swe):
+    # monthly precipitation minus the monthly change in SWE of each tile
+    for (rows, cols, ppt_tile), (swe_rows, swe_cols, swe_tile) in zip(ppt, swe):
+        if (rows, cols) != (swe_rows, swe_cols):
+            raise ValueError("precipitation and SWE data are not on the same grid")
+        yield rows, cols, {'water_input': ppt_tile['sum'] - swe_tile['diffsum']}
@@ -0,0 +1,177 @@
+import os
+import json
+import shutil
+import hashlib
+import http.client
+import threading
+import urllib.error
+import urllib.request
+import concurrent.futures
+import hydat.instrument as instrument
+
+BLOCK_SIZE = 1024 ** 2
+MIN_SEGMENT_SIZE = 16 * 1024 ** 2  # files smaller than two segments are downloaded as a single stream
+
+
+def downloadFile(url, fn, resume=True, segments=1, checksum=None, expected_size=None, retries=3, timeout=60):
+    """
+    Download a file over HTTP(S). Data is written to <fn>.part and renamed to fn only after the size and checksum are
+    verified. An interrupted download is resumed with HTTP Range requests when the server supports them.
+    Args:
+        url: URL of the file
+        fn: filename to save the file
+        resume: continue from an existing <fn>.part (default: True)
+        segments: number of byte ranges to download in parallel when the server reports the file size and accepts
+            ranges (default: 1)
+        checksum: expected checksum as '<algorithm>:<hex digest>', e.g. 'sha256:ab12...' (default: None)
+        expected_size: expected size in bytes (default: None, use the size reported by the server if any)
+        retries: number of times to reconnect after a dropped connection (default: 3)
+        timeout: socket timeout in seconds (default: 60)
+
+    Returns:
+        fn
+
+    """
+    part = fn + '.part'
+    size, ranges = probe(url, timeout)
+    if expected_size is None:
+        expected_size = size
+    if not resume:
+        for stale in [part, part + '.segments']:
+            if os.path.exists(stale):
+                os.remove(stale)
+    segmented = os.path.exists(part + '.segments')  # an interrupted segmented download must finish as one
+    with instrument.stage('download', url=url):
+        if ranges and size is not None and (segmented or (segments > 1 and size >= 2 * MIN_SEGMENT_SIZE)):
+            _downloadSegments(url, part, size, segments, retries, timeout)
+        else:
+            _downloadStream(url, part, size, retries, timeout)
+        try:
+            verify(part, expected_size, checksum)
+        except IOError:
+            os.remove(part)
+            raise
+        instrument.count('bytes_downloaded', os.path.getsize(part))
+        instrument.count('files_downloaded')
+    os.replace(part, fn)
+    return fn
+
+
+def probe(url, timeout=60):
+    """
+    Ask the server for the size of a file and whether it accepts byte ranges
+    Args:
+        url: URL of the file
+        timeout: socket timeout in seconds (default: 60)
+
+    Returns:
+        tuple of size in bytes (None if unknown) and True if byte ranges are accepted
+
+    """
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, method='HEAD'), timeout=timeout) as response:
+            length = response.headers.get('Content-Length')
+            ranges = response.headers.get('Accept-Ranges', '').lower() == 'bytes'
+            return (int(length) if length is not None else None), ranges
+    except urllib.error.HTTPError as e:
+        if e.code in [403, 405, 501]:  # HEAD not allowed, fall back to a plain download
+            return None, False
+        raise
+
+
+def verify(fn, expected_size=None, checksum=None):
+    """
+    Verify the size and checksum of a file
+    Args:
+        fn: filename
+        expected_size: expected size in bytes (default: None)
+        checksum: expected checksum as '<algorithm>:<hex digest>' (default: None)
+
+    Returns:
+
+    """
+    if expected_size is not None and os.path.getsize(fn) != expected_size:
+        raise IOError("Downloaded " + str(os.path.getsize(fn)) + " bytes but expected " + str(expected_size))
+    if checksum is not None:
+        algorithm, digest = checksum.split(':', 1)
+        hasher = hashlib.new(algorithm)
+        with open(fn, 'rb') as f:
+            for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+                hasher.update(block)
+        if hasher.hexdigest().lower() != digest.lower():
+            raise IOError("Checksum mismatch for " + fn + ": expected " + digest + ", got " + hasher.hexdigest())
+
+
+def _open(url, start=None, end=None, timeout=60):
+    headers = {}
+    if start is not None:
+        headers['Range'] = 'bytes=' + str(start) + '-' + ('' if end is None else str(end))
+    return urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=timeout)
+
+
+def _downloadStream(url, part, size, retries, timeout):
+    for attempt in range(retries + 1):
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        if size is not None and offset == size:
+            return
+        try:
+            try:
+                response = _open(url, offset if offset > 0 else None, timeout=timeout)
+            except urllib.error.HTTPError as e:
+                if e.code == 416 and offset > 0:  # requested range starts at the end, part is already complete
+                    return
+                raise
+            with response:
+                mode = 'ab' if response.status == 206 else 'wb'  # server ignored the range, start over
+                with open(part, mode) as f:
+                    shutil.copyfileobj(response, f, BLOCK_SIZE)
+            if size is None or os.path.getsize(part) >= size:
+                return
+        except (urllib.error.URLError, http.client.HTTPException, OSError) as e:
+            if isinstance(e, urllib.error.HTTPError) or attempt == retries:
+                raise
+
+
+def _downloadSegments(url, part, size, segments, retries, timeout):
+    state_fn = part + '.segments'
+    state = None
+    if os.path.exists(state_fn) and os.path.exists(part):
+        with open(state_fn) as f:
+            state = json.load(f)
+        if state['size'] != size:
+            state = None
+    if state is None:
+        step = -(-size // segments)
+        state = {'size': size, 'segments': [[start, min(start + step, size), 0] for start in range(0, size, step)]}
+        with open(part, 'wb') as f:
+            f.truncate(size)
+    lock = threading.Lock()
+
+    def save():
+        with lock:
+            with open(state_fn + '.tmp', 'w') as f:
+                json.dump(state, f)
+            os.replace(state_fn + '.tmp', state_fn)
+
+    def fetch(segment):
+        for attempt in range(retries + 1):
+            start, end, done = segment
+            if start + done >= end:
+                return
+            try:
+                with _open(url, start + done, end - 1, timeout) as response, open(part, 'r+b') as f:
+                    if response.status != 206:
+                        raise IOError("Server did not honor the byte range request")
+                    f.seek(start + done)
+                    for block in iter(lambda: response.read(BLOCK_SIZE), b''):
+                        f.write(block)
+                        segment[2] += len(block)
+                save()
+            except (urllib.error.URLError, http.client.HTTPException, OSError):
+                save()
+                if attempt == retries:
+                    raise
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(state['segments'])) as executor:
+        list(executor.map(fetch, state['segments']))
+    os.remove(state_fn)
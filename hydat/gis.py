@@ -1,9 +1,78 @@
 import netCDF4 as nc
 import numpy as np
-import gdal
+import hydat.instrument as instrument
+from hydat.lazy import lazyImport
 
+# GDAL is only loaded by the raster functions
+gdal = lazyImport('gdal')
+osr = lazyImport('osr')
 
-def copyNetCDF(fn_src, fn_dst, exclude_vars=[], exclude_data=[]):
+
+LAYOUTS = {'timeseries': 16, 'map': 1024}  # y/x chunk size of each layout preset
+
+
+def getChunkSizes(dimensions, shape, layout=None, chunksizes=None, ntime=None):
+    """
+    Choose chunk sizes for a NetCDF variable
+    Args:
+        dimensions: tuple of variable dimension names
+        shape: tuple of current dimension lengths; 0 for an empty unlimited dimension
+        layout: 'timeseries' (whole years of a small block of pixels per chunk, fast per-pixel reads) or 'map' (one
+            time step of a large block of pixels per chunk, fast per-map reads) (default: None)
+        chunksizes: explicit (time, y, x) chunk sizes, overrides layout (default: None)
+        ntime: number of time steps to assume for the time dimension instead of its current length (default: None)
+
+    Returns:
+        tuple of chunk sizes, or None to use the library default; only (time, y, x) variables are chunked
+
+    """
+    if tuple(dimensions) != ('time', 'y', 'x'):
+        return None
+    if ntime is None:
+        ntime = shape[0] if shape[0] > 0 else 366
+    if chunksizes is not None:
+        chunks = chunksizes
+    elif layout == 'timeseries':
+        chunks = (ntime, LAYOUTS[layout], LAYOUTS[layout])
+    elif layout == 'map':
+        chunks = (1, LAYOUTS[layout], LAYOUTS[layout])
+    elif layout is None:
+        return None
+    else:
+        raise ValueError("'" + str(layout) + "' is an invalid layout. Must be one of " + str(list(LAYOUTS.keys())))
+    return (max(1, min(chunks[0], ntime)), max(1, min(chunks[1], shape[1])), max(1, min(chunks[2], shape[2])))
+
+
+def getStorage(dimensions, shape, layout=None, chunksizes=None, zlib=False, complevel=4, shuffle=True, ntime=None):
+    """
+    Build the chunking and compression keyword arguments for netCDF4.Dataset.createVariable
+    Args:
+        dimensions: tuple of variable dimension names
+        shape: tuple of current dimension lengths
+        layout: chunk layout preset, see getChunkSizes (default: None)
+        chunksizes: explicit (time, y, x) chunk sizes (default: None)
+        zlib: compress the variable (default: False)
+        complevel: zlib compression level, 1-9 (default: 4)
+        shuffle: apply the HDF5 shuffle filter before compression (default: True)
+        ntime: number of time steps to assume for the time dimension (default: None)
+
+    Returns:
+        dictionary of keyword arguments
+
+    """
+    kwargs = {}
+    if len(dimensions) == 0:
+        return kwargs
+    chunks = getChunkSizes(dimensions, shape, layout, chunksizes, ntime)
+    if chunks is not None:
+        kwargs['chunksizes'] = chunks
+    if zlib:
+        kwargs.update({'zlib': True, 'complevel': complevel, 'shuffle': shuffle})
+    return kwargs
+
+
+def copyNetCDF(fn_src, fn_dst, exclude_vars=[], exclude_data=[], layout=None, chunksizes=None, zlib=False,
+               complevel=4, shuffle=True, metadata_only=False, chunk_bytes=64 * 1024 ** 2):
     """
     Creates a copy of a NetCDF dataset
     Args:
@@ -11,11 +80,20 @@ def copyNetCDF(fn_src, fn_dst, exclude_vars=[], exclude_data=[]):
         fn_dst: filename to save copied dataset
         exclude_vars: list of variables to exclude during copy
         exclude_data: list of data to exclude during copy; if a variable is excluded its data is automatically excluded
+        layout: chunk layout of (time, y, x) variables, 'timeseries' or 'map' (default: None)
+        chunksizes: explicit (time, y, x) chunk sizes, overrides layout (default: None)
+        zlib: compress variables (default: False)
+        complevel: zlib compression level, 1-9 (default: 4)
+        shuffle: apply the HDF5 shuffle filter before compression (default: True)
+        metadata_only: copy attributes, dimensions, variable definitions, and the data of coordinate variables only;
+            data of variables along the time or an unlimited dimension are not copied (default: False)
+        chunk_bytes: approximate number of bytes copied at a time for large variables (default: 64 MB)
 
     Returns:
 
     """
     with nc.Dataset(fn_src) as src, nc.Dataset(fn_dst, "w") as dst:
+        unlimited = [name for name, dimension in src.dimensions.items() if dimension.isunlimited()]
         # copy global attributes all at once via dictionary
         exclude = ['_NCProperties']
         setdict = {i:src.__dict__[i] for i in src.__dict__ if i not in exclude}  # don't copy NCProperties, it throws an error
@@ -27,99 +105,334 @@ def copyNetCDF(fn_src, fn_dst, exclude_vars=[], exclude_data=[]):
         # copy all file data except for the excluded
         for name, variable in src.variables.items():
             if name not in exclude_vars:
-                x = dst.createVariable(name, variable.datatype, variable.dimensions)
+                storage = getStorage(variable.dimensions, variable.shape, layout, chunksizes, zlib, complevel, shuffle)
+                # the fill value can only be set when the variable is created
+                x = dst.createVariable(name, variable.datatype, variable.dimensions,
+                                       fill_value=variable.__dict__.get('_FillValue', None), **storage)
                 # copy variable attributes all at once via dictionary
+                dst[name].setncatts({i: src[name].__dict__[i] for i in src[name].__dict__ if i != '_FillValue'})
                 if name not in exclude_data:
-                    dst[name][:] = src[name][:]
-                dst[name].setncatts(src[name].__dict__)
+                    if not metadata_only or not any(d == 'time' or d in unlimited for d in variable.dimensions):
+                        copyVariableData(variable, dst[name], chunk_bytes)
 
 
-def createMonthlyDaylNetCDF(fn_src, fn_dst, varname):
-    copyNetCDF(fn_src, fn_dst, exclude_vars=['dayl', 'time', varname])
+def copyVariableData(src, dst, chunk_bytes=64 * 1024 ** 2):
+    """
+    Copy the data of a NetCDF variable in blocks along its first dimension so memory use is bounded by chunk_bytes
+    Args:
+        src: source variable
+        dst: destination variable with the same dimensions
+        chunk_bytes: approximate number of bytes to copy at a time (default: 64 MB)
+
+    Returns:
+
+    """
+    if len(src.shape) == 0 or src.shape[0] == 0:
+        dst[...] = src[...]
+        return
+    record_bytes = max(1, int(np.prod(src.shape[1:])) * src.dtype.itemsize) if src.dtype != str else 1
+    step = max(1, chunk_bytes // record_bytes)
+    for start in range(0, src.shape[0], step):
+        stop = min(start + step, src.shape[0])
+        dst[start:stop] = src[start:stop]
+
+
+def createMonthlyDaylNetCDF(fn_src, fn_dst, varname, layout=None, chunksizes=None, zlib=False, complevel=4,
+                            shuffle=True):
+    copyNetCDF(fn_src, fn_dst, exclude_vars=['dayl', 'time', varname], layout=layout, chunksizes=chunksizes,
+               zlib=zlib, complevel=complevel, shuffle=shuffle, metadata_only=True)
     ds = nc.Dataset(fn_dst, 'r+')
     ds.createVariable('time', np.float64, ('time',))
-    ds.createVariable(varname, np.float32, ('time', 'y', 'x'))
+    ds.createVariable(varname, np.float32, ('time', 'y', 'x'),
+                      **getStorage(('time', 'y', 'x'), (12, len(ds.dimensions['y']), len(ds.dimensions['x'])), layout,
+                                   chunksizes, zlib, complevel, shuffle, ntime=12))
     ds.close()
 
 
-def createMonthlySWENetCDF(fn_src, fn_dst, varname):
-    copyNetCDF(fn_src, fn_dst, exclude_vars=['swe', 'time', varname])
+def createMonthlySWENetCDF(fn_src, fn_dst, varname, layout=None, chunksizes=None, zlib=False, complevel=4,
+                           shuffle=True):
+    copyNetCDF(fn_src, fn_dst, exclude_vars=['swe', 'time', varname], layout=layout, chunksizes=chunksizes,
+               zlib=zlib, complevel=complevel, shuffle=shuffle, metadata_only=True)
     ds = nc.Dataset(fn_dst, 'r+')
     ds.createVariable('time', np.float64, ('time',))
-    ds.createVariable(varname, np.float32, ('time', 'y', 'x'))
+    ds.createVariable(varname, np.float32, ('time', 'y', 'x'),
+                      **getStorage(('time', 'y', 'x'), (12, len(ds.dimensions['y']), len(ds.dimensions['x'])), layout,
+                                   chunksizes, zlib, complevel, shuffle, ntime=12))
     ds.close()
     return
 
 
-def indexRaster(src, dst, is_netcdf=False, var_name=None, no_data=-9999.0):
+def createPeriodNetCDF(fn_src, fn_dst, varnames, exclude_vars=(), ntime=12, layout=None, chunksizes=None,
+                       zlib=False, complevel=4, shuffle=True):
+    """
+    Create a NetCDF file for period (e.g. monthly) summaries of a daily dataset
+    Args:
+        fn_src: filename of the daily dataset used as a template
+        fn_dst: filename of the new dataset
+        varnames: names of the (time, y, x) float32 variables to create
+        exclude_vars: variables of the template not to copy; time and varnames are always excluded
+        ntime: number of periods (default: 12)
+        layout, chunksizes, zlib, complevel, shuffle: chunking and compression options, see copyNetCDF
+
+    Returns:
+
+    """
+    copyNetCDF(fn_src, fn_dst, exclude_vars=list(exclude_vars) + ['time', 'time_bnds'] + list(varnames),
+               layout=layout, chunksizes=chunksizes, zlib=zlib, complevel=complevel, shuffle=shuffle,
+               metadata_only=True)
+    ds = nc.Dataset(fn_dst, 'r+')
+    ds.createVariable('time', np.float64, ('time',))
+    for varname in varnames:
+        ds.createVariable(varname, np.float32, ('time', 'y', 'x'), fill_value=-9999.0,
+                          **getStorage(('time', 'y', 'x'), (ntime, len(ds.dimensions['y']), len(ds.dimensions['x'])),
+                                       layout, chunksizes, zlib, complevel, shuffle, ntime=ntime))
+    ds.close()
+
+
+def openRaster(src, is_netcdf=False, var_name=None):
+    """
+    Open a raster dataset with GDAL
+    Args:
+        src: filename of the raster
+        is_netcdf: src is a NetCDF file (default: False)
+        var_name: NetCDF variable to open (default: None)
+
+    Returns:
+        gdal dataset
+
+    """
     if is_netcdf:
         ds = gdal.Open("NETCDF:" + src + ":" + var_name)
     else:
         ds = gdal.Open(src)
+    if ds is None:
+        raise IOError("Unable to open raster " + src)
+    return ds
+
+
+def transformCoordinates(xs, ys, src_srs, dst_srs):
+    """
+    Transform arrays of coordinates between spatial reference systems
+    Args:
+        xs: x coordinates (longitude for geographic coordinates)
+        ys: y coordinates (latitude for geographic coordinates)
+        src_srs: spatial reference of the input coordinates, as WKT or a user input string such as 'EPSG:4326'
+        dst_srs: spatial reference of the output coordinates, as WKT or a user input string
+
+    Returns:
+        tuple of x and y coordinate arrays
 
-    band = ds.GetRasterBand(1).ReadAsArray()
-
-    idx = np.arange(0, ds.RasterXSize*ds.RasterYSize).reshape((ds.RasterYSize, ds.RasterXSize))
-    print(idx.shape, band.shape)
-    idx[band == no_data] = no_data
-    writeArrayAsRaster(dst, idx, ds.RasterYSize, ds.RasterXSize, ds.GetGeoTransform(), ds.GetProjection(),
-                       nodata=no_data, nan=no_data)
-
-    # if ds is not None:
-    #     print(ds.GetProjection())
-    #     geot = ds.GetGeoTransform()
-    #     proj = ds.GetProjection()
-    #     # print("min x: ", geot[0], "max x:", geot[0] + ds.RasterXSize*geot[1], "min y: ", geot[3] + ds.RasterYSize*geot[5], "max y:", geot[3])
-    #     minx = geot[0]-0.0*geot[1]
-    #     maxy = geot[3]-0.5*geot[5]
-    #     extent = (minx, maxy + ds.RasterYSize*geot[5], minx + ds.RasterXSize*geot[1], maxy)
-    #     gdal.Warp(fn_out, fn, dstSRS='EPSG:5070', outputBounds=extent, outputBoundsSRS=proj, width=ds.RasterXSize, height=ds.RasterYSize)
-    #     # gdal.Warp(fn_out, fn, dstSRS='EPSG:5070', width=ds.RasterXSize, height=ds.RasterYSize)
-    # else:
-    #     print("error opening netcdf")
-
-    print('done')
+    """
+    srs = []
+    for definition in [src_srs, dst_srs]:
+        ref = osr.SpatialReference()
+        ref.SetFromUserInput(definition)
+        if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+            ref.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)  # always x/longitude first
+        srs.append(ref)
+    xs = np.asarray(xs, dtype=np.float64).ravel()
+    ys = np.asarray(ys, dtype=np.float64).ravel()
+    if xs.size == 0 or srs[0].IsSame(srs[1]):
+        return xs, ys
+    transform = osr.CoordinateTransformation(srs[0], srs[1])
+    points = np.array(transform.TransformPoints(np.column_stack((xs, ys)).tolist()))
+    return points[:, 0], points[:, 1]
+
+
+def indexRaster(src, dst, is_netcdf=False, var_name=None, no_data=-9999.0, block_rows=None, compress=None):
+    """
+    Write a raster holding the flat (row-major) index of each pixel of src, and no_data where src has no data. The
+    raster is processed in strips of rows, so memory use does not depend on its size.
+    Args:
+        src: filename of the raster to index
+        dst: output filename
+        is_netcdf: src is a NetCDF file (default: False)
+        var_name: NetCDF variable to index (default: None)
+        no_data: no data value of src and the output (default: -9999)
+        block_rows: number of rows per strip (default: None, the block height of src, at least 256)
+        compress: compression of the output; see getCreationOptions (default: None)
+
+    Returns:
+
+    """
+    ds = openRaster(src, is_netcdf, var_name)
+    rows, cols = ds.RasterYSize, ds.RasterXSize
+    band = ds.GetRasterBand(1)
+    if block_rows is None:
+        block_rows = max(band.GetBlockSize()[1], 256)
+    datatype, dtype = getIndexType(rows * cols)
+    out = _createRaster(dst, rows, cols, 1, ds.GetGeoTransform(), ds.GetProjection(), no_data, datatype, 'GTiff',
+                        getCreationOptions(compress=compress))
+    out_band = out.GetRasterBand(1)
+    for row in range(0, rows, block_rows):
+        nrow = min(block_rows, rows - row)
+        idx = np.arange(row * cols, (row + nrow) * cols, dtype=dtype).reshape((nrow, cols))
+        idx[band.ReadAsArray(0, row, cols, nrow) == no_data] = no_data
+        out_band.WriteArray(idx, 0, row)
+        instrument.count('cells_written', idx.size)
+    out = None
+    # reprojecting to EPSG:5070 is done with hydat.reproject.buildWarpIndex and warpNetCDF
     return
 
 
-def writeArrayAsRaster(path, array, rows, cols, geot, srs, nodata=-9999.0, nan=-9999.0, datatype=gdal.GDT_Float32,
-                       drivername='GTiff'):
+def getIndexType(count):
+    """
+    Choose the smallest integer type that holds pixel indices
+    Args:
+        count: number of pixels
+
+    Returns:
+        tuple of GDAL data type and NumPy dtype; Int32 up to 2^31 - 1 pixels, otherwise Int64 (Float64, exact up to
+        2^53, with GDAL versions before 3.5)
+
     """
-    Write array to a raster dataset
+    if count <= np.iinfo(np.int32).max:
+        return gdal.GDT_Int32, np.int32
+    if hasattr(gdal, 'GDT_Int64'):
+        return gdal.GDT_Int64, np.int64
+    return gdal.GDT_Float64, np.float64
+
+
+def getCreationOptions(drivername='GTiff', tiled=True, compress=None, bigtiff='IF_SAFER', block_size=256, options=None):
+    """
+    Build GDAL creation options
+    Args:
+        drivername: name of the GDAL driver; tiling, compression, and BigTIFF options only apply to 'GTiff'
+            (default: 'GTiff')
+        tiled: write tiles instead of strips (default: True)
+        compress: compression, e.g. 'DEFLATE', 'LZW', or 'ZSTD' (default: None, uncompressed)
+        bigtiff: 'YES', 'NO', 'IF_NEEDED', or 'IF_SAFER' (default: 'IF_SAFER')
+        block_size: tile width and height in pixels, a multiple of 16 (default: 256)
+        options: additional 'KEY=VALUE' creation options (default: None)
+
+    Returns:
+        list of creation option strings
+
+    """
+    creation = []
+    if drivername == 'GTiff':
+        if tiled:
+            creation += ['TILED=YES', 'BLOCKXSIZE=' + str(block_size), 'BLOCKYSIZE=' + str(block_size)]
+        if compress is not None:
+            creation.append('COMPRESS=' + compress)
+        if bigtiff is not None:
+            creation.append('BIGTIFF=' + bigtiff)
+    if options is not None:
+        creation += list(options)
+    return creation
+
+
+def writeArrayAsRaster(path, array, rows, cols, geot, srs, nodata=-9999.0, nan=-9999.0, datatype=None,
+                       drivername='GTiff', tiled=True, compress=None, bigtiff='IF_SAFER', block_size=256, options=None):
+    """
+    Write array to a raster dataset. Values equal to nan and NaNs are replaced with nodata in place, so array is
+    modified; all bands are written in one call.
 
     Args:
         path: output file for raster
-        array: array containing data
+        array: array containing data, (rows, cols) or (bands, rows, cols)
         rows: number of rows in array
         cols: number of columns in array
         geot: affine geotransformation for the output raster
         srs: spatial reference for the output raster (default: None)
         nodata: no data value for the output raster (default: -9999)
         nan: value in array that should be written as nodata (default: -9999)
-        datatype: gdal data type of output raster (default: GDT_Float32)
+        datatype: gdal data type of output raster (default: None, GDT_Float32)
         drivername: Name of GDAL driver to use to create raster (default: 'GTiff')
+        tiled: see getCreationOptions (default: True)
+        compress: see getCreationOptions (default: None)
+        bigtiff: see getCreationOptions (default: 'IF_SAFER')
+        block_size: see getCreationOptions (default: 256)
+        options: additional creation options (default: None)
 
     Returns:
         None
 
     """
+    bands = array.shape[0] if array.ndim == 3 else 1
+    ds = _createRaster(path, rows, cols, bands, geot, srs, nodata, datatype, drivername,
+                       getCreationOptions(drivername, tiled, compress, bigtiff, block_size, options))
+    _replaceNodata(array, nodata, nan)
+    if array.ndim == 3:
+        ds.WriteArray(array)
+    else:
+        ds.GetRasterBand(1).WriteArray(array)
+    ds = None
+    instrument.count('cells_written', array.size)
+    return None
+
+
+def writeBlocksAsRaster(path, blocks, bands, rows, cols, geot, srs, nodata=-9999.0, nan=-9999.0,
+                        datatype=None, drivername='GTiff', tiled=True, compress=None, bigtiff='IF_SAFER',
+                        block_size=256, options=None):
+    """
+    Write bands produced one block at a time to a raster dataset, so a large multi-band stack never has to be held in
+    memory. Blocks are modified in place like in writeArrayAsRaster.
+
+    Args:
+        path: output file for raster
+        blocks: iterable of (rows, cols) arrays (one band each) or (n, rows, cols) arrays (n bands each), in band order
+        bands: total number of bands
+        rows: number of rows
+        cols: number of columns
+        geot: affine geotransformation for the output raster
+        srs: spatial reference for the output raster
+        nodata: no data value for the output raster (default: -9999)
+        nan: value in blocks that should be written as nodata (default: -9999)
+        datatype: gdal data type of output raster (default: None, GDT_Float32)
+        drivername: Name of GDAL driver to use to create raster (default: 'GTiff')
+        tiled: see getCreationOptions (default: True)
+        compress: see getCreationOptions (default: None)
+        bigtiff: see getCreationOptions (default: 'IF_SAFER')
+        block_size: see getCreationOptions (default: 256)
+        options: additional creation options (default: None)
+
+    Returns:
+        None
+
+    """
+    ds = _createRaster(path, rows, cols, bands, geot, srs, nodata, datatype, drivername,
+                       getCreationOptions(drivername, tiled, compress, bigtiff, block_size, options))
+    band = 0
+    for block in blocks:
+        _replaceNodata(block, nodata, nan)
+        if block.ndim == 2:
+            block = block[np.newaxis]
+        if band + block.shape[0] > bands:
+            ds = None
+            raise ValueError("blocks contain more than " + str(bands) + " bands")
+        for i in range(block.shape[0]):
+            ds.GetRasterBand(band + i + 1).WriteArray(block[i])
+        band += block.shape[0]
+        instrument.count('cells_written', block.size)
+    ds = None
+    if band != bands:
+        raise ValueError("blocks contain " + str(band) + " of " + str(bands) + " bands")
+    return None
+
+
+def _createRaster(path, rows, cols, bands, geot, srs, nodata, datatype, drivername, options):
+    if datatype is None:
+        datatype = gdal.GDT_Float32
     driver = gdal.GetDriverByName(drivername)
-    bands = 1
-    multi = False
-    if len(array.shape) == 3:
-        bands = array.shape[0]
-        multi = True
-    ds = driver.Create(path, xsize=cols, ysize=rows, bands=bands, eType=datatype)
-    ds.SetProjection(srs)
+    ds = driver.Create(path, xsize=cols, ysize=rows, bands=bands, eType=datatype, options=options)
+    if ds is None:
+        raise IOError("could not create " + path)
+    if srs is not None:
+        ds.SetProjection(srs)
     ds.SetGeoTransform(geot)
-    array = np.where((array==np.nan) | (array==nan), nodata, array)
     for band in range(bands):
-        print('writing band', band+1, 'of', bands)
-        if multi:
-            ds.GetRasterBand(band+1).WriteArray(array[band,:,:])
-        else:
-            ds.GetRasterBand(band + 1).WriteArray(array)
-        ds.GetRasterBand(band+1).SetNoDataValue(nodata)
-        ds.GetRasterBand(band+1).FlushCache()
-    ds = None
-    return None
+        ds.GetRasterBand(band + 1).SetNoDataValue(nodata)
+    return ds
+
+
+def _replaceNodata(array, nodata, nan):
+    if np.issubdtype(array.dtype, np.floating):
+        mask = np.isnan(array)
+        if nan != nodata:
+            mask |= array == nan
+    elif nan != nodata:
+        mask = array == nan
+    else:
+        return
+    np.putmask(array, mask, nodata)
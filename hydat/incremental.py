@@ -0,0 +1,171 @@
+import os
+import json
+import hashlib
+import hydat.runner as runner
+
+MANIFEST_NAME = 'hydat_manifest.json'
+
+
+def fileState(fn, hash_file=True):
+    """
+    Describe the state of a file for dependency tracking
+    Args:
+        fn: filename
+        hash_file: include the SHA-256 of the file contents (default: True)
+
+    Returns:
+        dictionary of size, mtime, and sha256 (None if not hashed), or None if the file does not exist
+
+    """
+    if not os.path.exists(fn):
+        return None
+    stat = os.stat(fn)
+    state = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': None}
+    if hash_file:
+        state['sha256'] = hashFile(fn)
+    return state
+
+
+def hashFile(fn, block_size=8 * 1024 ** 2):
+    sha = hashlib.sha256()
+    with open(fn, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class BuildManifest:
+    """
+    Record of the inputs and parameters each output was built from, used to rebuild only outputs that are missing or
+    out of date. An input is unchanged if its size and modification time match the record, or if they do not but its
+    contents still hash to the recorded value.
+    """
+    def __init__(self, fn, hash_inputs=True):
+        """
+        Args:
+            fn: filename of the JSON manifest
+            hash_inputs: record and compare SHA-256 hashes of inputs (default: True)
+
+        """
+        self.fn = fn
+        self.hash_inputs = hash_inputs
+        self.entries = {}
+        self.changed = set()
+        if os.path.exists(fn):
+            with open(fn) as f:
+                self.entries = json.load(f)
+
+    def isStale(self, output, inputs, params=None):
+        """
+        Check if an output must be rebuilt
+        Args:
+            output: output filename; part of a file may be identified by appending '::' and a label
+            inputs: list of input filenames
+            params: JSON serializable parameters the output was built with (default: None)
+
+        Returns:
+            True if the output is missing, was never recorded, was built with different parameters or inputs, or any
+            input changed
+
+        """
+        entry = self.entries.get(self.key(output))
+        if entry is None or not os.path.exists(output.split('::')[0]):
+            return True
+        if entry['params'] != _normalize(params) or sorted(entry['inputs']) != sorted(self.key(fn) for fn in inputs):
+            return True
+        for fn in inputs:
+            recorded = entry['inputs'][self.key(fn)]
+            current = fileState(fn, hash_file=False)
+            if current is None:
+                return True
+            if current['size'] == recorded['size'] and current['mtime'] == recorded['mtime']:
+                continue
+            if recorded['sha256'] is None or current['size'] != recorded['size'] or \
+                    hashFile(fn) != recorded['sha256']:
+                return True
+        return False
+
+    def key(self, fn):
+        return os.path.abspath(fn.split('::')[0]) + ('::' + fn.split('::')[1] if '::' in fn else '')
+
+    def record(self, output, inputs, params=None):
+        """
+        Record the inputs and parameters an output was built from
+        Args:
+            output: output filename; part of a file may be identified by appending '::' and a label
+            inputs: list of input filenames
+            params: JSON serializable parameters (default: None)
+
+        Returns:
+
+        """
+        self.entries[self.key(output)] = {
+            'inputs': {self.key(fn): fileState(fn, self.hash_inputs) for fn in inputs},
+            'params': _normalize(params)}
+        self.changed.add(self.key(output))
+
+    def save(self):
+        """
+        Write recorded entries to the manifest, merging with entries written by other jobs since it was loaded
+
+        Returns:
+
+        """
+        entries = {}
+        if os.path.exists(self.fn):
+            with open(self.fn) as f:
+                entries = json.load(f)
+        entries.update({key: self.entries[key] for key in self.changed})
+        with open(self.fn + '.tmp', 'w') as f:
+            json.dump(entries, f, indent=1)
+        os.replace(self.fn + '.tmp', self.fn)
+        self.entries = entries
+        self.changed = set()
+
+
+def _normalize(params):
+    # round trip through JSON so tuples and lists compare equal to their recorded values
+    return json.loads(json.dumps(params))
+
+
+def runIncremental(func, years, output, inputs, params=None, args=(), kwargs=None, workers=1, manifest_fn=None,
+                   dry_run=False, force=False):
+    """
+    Run a per-year function through hydat.runner.runYears for only the years whose output is missing or out of date,
+    and record what each successful year was built from
+    Args:
+        func: module level function called as func(year, *args, **kwargs)
+        years: iterable of years
+        output: function returning the output filename for a year
+        inputs: function returning the list of input filenames for a year
+        params: JSON serializable parameters that affect the output (default: None)
+        args: additional positional arguments passed to func
+        kwargs: additional keyword arguments passed to func
+        workers: number of worker processes (default: 1)
+        manifest_fn: filename of the manifest (default: hydat_manifest.json next to the first output)
+        dry_run: only list the years that would be rebuilt (default: False)
+        force: rebuild every year; inputs are recorded by size and modification time only, without hashing
+            (default: False)
+
+    Returns:
+        list of years that would be rebuilt if dry_run, otherwise {year: result or exception} for the rebuilt years
+
+    """
+    years = list(years)
+    if len(years) == 0:
+        return [] if dry_run else {}
+    if manifest_fn is None:
+        manifest_fn = os.path.join(os.path.dirname(os.path.abspath(output(years[0]))), MANIFEST_NAME)
+    manifest = BuildManifest(manifest_fn, hash_inputs=not force)
+    if force:
+        stale = years
+    else:
+        stale = [year for year in years if manifest.isStale(output(year), inputs(year), params)]
+    if dry_run:
+        return stale
+    results = runner.runYears(func, stale, args, kwargs, workers)
+    for year, result in results.items():
+        if not isinstance(result, Exception):
+            manifest.record(output(year), inputs(year), params)
+    manifest.save()
+    return results
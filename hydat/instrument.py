@@ -0,0 +1,247 @@
+import time
+import logging
+import threading
+
+logger = logging.getLogger('hydat')
+_active = None  # instrumentation receiving reports; None disables reporting
+_local = threading.local()
+
+
+class Instrumentation:
+    """
+    Receiver of progress events, counters, and stage timings. Subclass and override the methods of interest; the
+    default implementations ignore reports. Methods may be called from several threads at once.
+
+    Reports used by hydat:
+        events: 'download' (url), 'failed' (year, error)
+        counters: 'bytes_downloaded', 'files_downloaded', 'files_processed', 'cells_processed', 'cells_written',
+            'cells_read', 'cache_hits', 'cache_misses'
+        stages: 'download' (url) and one per yearly processing function, e.g. 'monthlySWEAccumulationYear' (year)
+    """
+    def event(self, name, fields):
+        """
+        Args:
+            name: event name
+            fields: dictionary of event details
+
+        """
+        pass
+
+    def count(self, name, value):
+        """
+        Args:
+            name: counter name
+            value: amount added to the counter
+
+        """
+        pass
+
+    def timing(self, name, seconds, fields, counts):
+        """
+        Args:
+            name: stage name
+            seconds: wall time of the stage
+            fields: dictionary of stage details
+            counts: dictionary of counters added while the stage ran, e.g. cells_processed
+
+        """
+        pass
+
+
+class Callbacks(Instrumentation):
+    """
+    Instrumentation that forwards reports to functions, e.g. to feed a job monitor
+    """
+    def __init__(self, on_event=None, on_count=None, on_timing=None):
+        """
+        Args:
+            on_event: called as on_event(name, fields) (default: None)
+            on_count: called as on_count(name, value) (default: None)
+            on_timing: called as on_timing(name, seconds, fields, counts) (default: None)
+
+        """
+        self.on_event = on_event
+        self.on_count = on_count
+        self.on_timing = on_timing
+
+    def event(self, name, fields):
+        if self.on_event is not None:
+            self.on_event(name, fields)
+
+    def count(self, name, value):
+        if self.on_count is not None:
+            self.on_count(name, value)
+
+    def timing(self, name, seconds, fields, counts):
+        if self.on_timing is not None:
+            self.on_timing(name, seconds, fields, counts)
+
+
+class LogInstrumentation(Instrumentation):
+    """
+    Instrumentation that writes events and stage timings to the 'hydat' logger
+    """
+    def __init__(self, level=logging.INFO):
+        self.level = level
+
+    def event(self, name, fields):
+        logger.log(self.level, '%s %s', name, _format(fields))
+
+    def timing(self, name, seconds, fields, counts):
+        rates = {key + '_per_second': value / seconds for key, value in counts.items() if seconds > 0}
+        logger.log(self.level, '%s finished in %.3f s %s', name, seconds, _format(dict(fields, **rates)))
+
+
+class Recorder(Instrumentation):
+    """
+    Instrumentation that accumulates counters and per-stage totals for scraping
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.stages = {}
+        self.events = {}
+
+    def event(self, name, fields):
+        with self.lock:
+            self.events[name] = self.events.get(name, 0) + 1
+
+    def count(self, name, value):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def timing(self, name, seconds, fields, counts):
+        with self.lock:
+            stage = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'counts': {}})
+            stage['calls'] += 1
+            stage['seconds'] += seconds
+            for key, value in counts.items():
+                stage['counts'][key] = stage['counts'].get(key, 0) + value
+
+    def summary(self):
+        """
+        Summarize what was recorded
+
+        Returns:
+            dictionary of counters, event counts, and per stage calls, seconds, counts, and rates (counts per second)
+
+        """
+        with self.lock:
+            stages = {}
+            for name, stage in self.stages.items():
+                stages[name] = {'calls': stage['calls'], 'seconds': stage['seconds'], 'counts': dict(stage['counts']),
+                                'rates': {key + '_per_second': value / stage['seconds']
+                                          for key, value in stage['counts'].items() if stage['seconds'] > 0}}
+            return {'counters': dict(self.counters), 'events': dict(self.events), 'stages': stages}
+
+
+class Buffer(Instrumentation):
+    """
+    Instrumentation that keeps reports so they can be replayed into another instrumentation, e.g. to return reports
+    made in a worker process to the parent
+    """
+    def __init__(self):
+        self.reports = []
+
+    def event(self, name, fields):
+        self.reports.append(('event', (name, fields)))
+
+    def count(self, name, value):
+        self.reports.append(('count', (name, value)))
+
+    def timing(self, name, seconds, fields, counts):
+        self.reports.append(('timing', (name, seconds, fields, counts)))
+
+    def replay(self, instrumentation):
+        for method, args in self.reports:
+            getattr(instrumentation, method)(*args)
+
+
+class Stage:
+    """
+    Context manager timing a stage; counters reported while it is open are attached to its timing
+    """
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+        self.counts = {}
+        self.start = None
+
+    def __enter__(self):
+        stack = getattr(_local, 'stages', None)
+        if stack is None:
+            stack = _local.stages = []
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.start
+        _local.stages.remove(self)
+        if _active is not None:
+            self.fields['failed'] = exc_type is not None
+            _active.timing(self.name, seconds, self.fields, self.counts)
+        return False
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+def setInstrumentation(instrumentation):
+    """
+    Install the instrumentation that receives reports from hydat in this process
+    Args:
+        instrumentation: Instrumentation, or None to disable reporting
+
+    Returns:
+        the previously installed instrumentation
+
+    """
+    global _active
+    previous = _active
+    _active = instrumentation
+    return previous
+
+
+def getInstrumentation():
+    return _active
+
+
+def event(name, **fields):
+    if _active is not None:
+        _active.event(name, fields)
+
+
+def count(name, value=1):
+    if _active is not None:
+        _active.count(name, value)
+        for stage in getattr(_local, 'stages', ()):
+            stage.counts[name] = stage.counts.get(name, 0) + value
+
+
+def stage(name, **fields):
+    """
+    Time a stage when instrumentation is installed
+    Args:
+        name: stage name
+        **fields: stage details
+
+    Returns:
+        context manager
+
+    """
+    if _active is None:
+        return _NULL_STAGE
+    return Stage(name, fields)
+
+
+def _format(fields):
+    return ' '.join(str(key) + '=' + str(value) for key, value in fields.items())
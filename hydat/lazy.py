@@ -0,0 +1,30 @@
+import sys
+import types
+import importlib
+
+
+class LazyModule(types.ModuleType):
+    """
+    Placeholder for a module that is imported on first attribute access. Once imported, the attributes of the module
+    are copied onto the placeholder, so later lookups cost the same as on the module itself.
+    """
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__name__)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+
+def lazyImport(name):
+    """
+    Import a module when it is first used instead of now, so heavy dependencies (GDAL, netCDF4, NumPy) are only loaded
+    by code that needs them
+    Args:
+        name: full name of the module, e.g. 'netCDF4' or 'hydat.gis'
+
+    Returns:
+        the module if it is already imported, otherwise a LazyModule
+
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
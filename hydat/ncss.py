@@ -0,0 +1,161 @@
+import os
+import datetime
+import numpy as np
+import netCDF4 as nc
+import hydat.daymet as daymet
+
+
+def planTiles(year, extent, tile_degrees=None, days_per_tile=None, stride=1):
+    """
+    Split a Daymet daily subset request into spatial and temporal tiles
+    Args:
+        year: year of the request
+        extent: list of bounding coordinates [n, s, e, w]
+        tile_degrees: maximum width and height of a spatial tile in decimal degrees; if None the extent is not split
+            (default: None)
+        days_per_tile: maximum number of days in a tile; rounded down to a multiple of stride; if None the year is not
+            split (default: None)
+        stride: time and horizontal stride of the request (default: 1)
+
+    Returns:
+        list of tile dictionaries with extent, time_start, and time_end
+
+    """
+    daymet.checkExtent(extent)
+    if extent is None:
+        raise ValueError("an extent is required to plan subset tiles")
+    north, south, east, west = extent
+    lats = _edges(south, north, tile_degrees)
+    lons = _edges(west, east, tile_degrees)
+    if stride != 1 and (len(lats) > 2 or len(lons) > 2):
+        raise ValueError("spatial tiles cannot be aligned when stride is greater than 1; split by time only")
+    ndays = 365  # Daymet drops Dec 31 on leap years
+    if days_per_tile is None:
+        days_per_tile = ndays
+    days_per_tile = max(stride, days_per_tile - days_per_tile % stride)
+    jan1 = datetime.date(year, 1, 1)
+    tiles = []
+    for start in range(0, ndays, days_per_tile):
+        end = min(start + days_per_tile, ndays) - 1
+        for i in range(len(lats) - 1):
+            for j in range(len(lons) - 1):
+                tiles.append({'extent': [lats[i + 1], lats[i], lons[j + 1], lons[j]],
+                              'time_start': (jan1 + datetime.timedelta(days=start)).isoformat(),
+                              'time_end': (jan1 + datetime.timedelta(days=end)).isoformat(),
+                              'index': (start // days_per_tile, i, j)})
+    return tiles
+
+
+def _edges(low, high, size):
+    if size is None or high - low <= size:
+        return [low, high]
+    n = int(np.ceil((high - low) / float(size)))
+    return [low + (high - low) * k / n for k in range(n)] + [high]
+
+
+def downloadDaymetTiled(fn, year, variable, extent, region='na', tile_degrees=5.0, days_per_tile=None, stride=1,
+                        tile_dir=None, max_workers=4, max_per_host=2, retries=3, keep_tiles=False, cache=None):
+    """
+    Download a large Daymet daily subset as concurrent tile requests and mosaic the tiles into one NetCDF file.
+    Tiles already present in tile_dir are not downloaded again, so a failed run can be repeated to fetch only the
+    missing tiles.
+    Args:
+        fn: filename to save the mosaic
+        year: year for which to download data
+        variable: Daymet variable; see downloadDaymet
+        extent: list of geographic coordinates (decimal degrees) in the format [north, south, east, west]
+        region: one of 'na' (default), 'hawaii', or 'puertorico'
+        tile_degrees: maximum width and height of a spatial tile in decimal degrees (default: 5)
+        days_per_tile: maximum number of days in a tile (default: None, whole year)
+        stride: time and horizontal stride (default: 1)
+        tile_dir: directory to save tiles (default: <fn>_tiles)
+        max_workers: maximum number of concurrent downloads (default: 4)
+        max_per_host: maximum number of concurrent downloads from a single host (default: 2)
+        retries: number of times to retry a failed tile (default: 3)
+        keep_tiles: keep tile files after the mosaic is written (default: False)
+        cache: hydat.cache.DownloadCache to serve repeated requests from (default: None)
+
+    Returns:
+        list of tile records
+
+    """
+    if tile_dir is None:
+        tile_dir = fn + '_tiles'
+    if not os.path.exists(tile_dir):
+        os.makedirs(tile_dir)
+    records = []
+    for tile in planTiles(year, extent, tile_degrees, days_per_tile, stride):
+        record = dict(tile)
+        record['url'] = daymet.buildDaymetURL(year, variable, 'day', region, tile['extent'], stride,
+                                              tile['time_start'], tile['time_end'])
+        record['fn'] = os.path.join(tile_dir, variable + '_' + str(year) + '_' +
+                                    '_'.join(str(i) for i in tile['index']) + '.nc')
+        record['status'] = 'exists' if os.path.exists(record['fn']) else 'pending'
+        records.append(record)
+    daymet.fetchRecords([record for record in records if record['status'] == 'pending'], max_workers, max_per_host,
+                        cache, retries)
+    failed = [record for record in records if record['status'] == 'failed']
+    if len(failed) > 0:
+        raise IOError(str(len(failed)) + " of " + str(len(records)) + " tiles failed; run again to retry them. " +
+                      "First error: " + str(failed[0]['error']))
+    mosaicTiles([record['fn'] for record in records], fn)
+    if not keep_tiles:
+        for record in records:
+            os.remove(record['fn'])
+        if len(os.listdir(tile_dir)) == 0:
+            os.rmdir(tile_dir)
+    return records
+
+
+def mosaicTiles(fns, fn_out, decimals=3):
+    """
+    Mosaic NetCDF subsets of the same grid into one file with the layout of a single subset request. Tiles are
+    placed by their x, y, and time coordinates; cells no tile covers are set to the fill value.
+    Args:
+        fns: tile filenames
+        fn_out: output filename
+        decimals: decimals coordinates are rounded to when matching tiles (default: 3)
+
+    Returns:
+
+    """
+    tiles = [nc.Dataset(fn) for fn in fns]
+    try:
+        coords = {}
+        for dim in ['time', 'y', 'x']:
+            values = np.unique(np.concatenate([np.round(ds[dim][:].astype(np.float64), decimals) for ds in tiles]))
+            coords[dim] = values[::-1] if dim == 'y' and tiles[0]['y'][0] > tiles[0]['y'][-1] else values
+        template = tiles[0]
+        with nc.Dataset(fn_out, 'w') as dst:
+            dst.setncatts({i: template.__dict__[i] for i in template.__dict__ if i != '_NCProperties'})
+            for name, dimension in template.dimensions.items():
+                if name == 'time':
+                    dst.createDimension(name, None)
+                elif name in coords:
+                    dst.createDimension(name, coords[name].size)
+                else:
+                    dst.createDimension(name, len(dimension))
+            for name, variable in template.variables.items():
+                out = dst.createVariable(name, variable.datatype, variable.dimensions,
+                                         fill_value=variable.__dict__.get('_FillValue', None))
+                out.setncatts({i: variable.__dict__[i] for i in variable.__dict__ if i != '_FillValue'})
+                if name in coords:
+                    out[:] = coords[name]
+            for ds in tiles:
+                index = {dim: _placement(coords[dim], np.round(ds[dim][:].astype(np.float64), decimals))
+                         for dim in coords}
+                for name, variable in ds.variables.items():
+                    if name in coords or len(variable.dimensions) == 0:
+                        continue
+                    dst[name][tuple(index.get(dim, slice(None)) for dim in variable.dimensions)] = variable[:]
+    finally:
+        for ds in tiles:
+            ds.close()
+
+
+def _placement(values, tile_values):
+    # tiles of one grid occupy a contiguous run of the mosaic coordinates
+    start = int(np.flatnonzero(values == tile_values[0])[0])
+    if not np.array_equal(values[start:start + tile_values.size], tile_values):
+        raise ValueError("tile coordinates are not aligned with the mosaic grid")
+    return slice(start, start + tile_values.size)
@@ -0,0 +1,166 @@
+import os
+import numpy as np
+import netCDF4 as nc
+import hydat.gis as gis
+
+
+def buildPointIndex(src, xs, ys, ids=None, fn_index=None, is_netcdf=False, var_name=None, srs='EPSG:4326'):
+    """
+    Map point coordinates to pixels of a raster grid. The lookup table can be saved and reused for every grid that
+    shares the same geotransform.
+    Args:
+        src: filename of a raster on the grid (e.g. a PRISM grid, the output of indexRaster, or a Daymet NetCDF file)
+        xs: x coordinates of the points (longitude by default)
+        ys: y coordinates of the points (latitude by default)
+        ids: identifiers of the points, e.g. station IDs (default: 0 to number of points - 1)
+        fn_index: filename to save the lookup table (.npz) (default: None)
+        is_netcdf: src is a NetCDF file (default: False)
+        var_name: NetCDF variable to open (default: None)
+        srs: spatial reference of the point coordinates (default: 'EPSG:4326')
+
+    Returns:
+        dictionary of point index arrays; ids, x, y, row, col, and pixel (flat grid index, -1 outside the grid)
+
+    """
+    ds = gis.openRaster(src, is_netcdf, var_name)
+    geot = ds.GetGeoTransform()
+    proj = ds.GetProjection()
+    nrows = ds.RasterYSize
+    ncols = ds.RasterXSize
+    ds = None
+    if proj:
+        x, y = gis.transformCoordinates(xs, ys, srs, proj)
+    else:
+        x = np.asarray(xs, dtype=np.float64).ravel()
+        y = np.asarray(ys, dtype=np.float64).ravel()
+    if ids is None:
+        ids = np.arange(x.size)
+    col = np.floor((x - geot[0]) / geot[1]).astype(np.int64)
+    row = np.floor((y - geot[3]) / geot[5]).astype(np.int64)
+    inside = (row >= 0) & (row < nrows) & (col >= 0) & (col < ncols)
+    pixel = np.where(inside, row * ncols + col, -1)
+    index = {'ids': np.asarray(ids), 'x': x, 'y': y, 'row': np.where(inside, row, -1),
+             'col': np.where(inside, col, -1), 'pixel': pixel, 'geotransform': np.array(geot),
+             'shape': np.array([nrows, ncols])}
+    if fn_index is not None:
+        np.savez(fn_index, **index)
+    return index
+
+
+def loadPointIndex(fn_index):
+    """
+    Load a lookup table saved by buildPointIndex
+    Args:
+        fn_index: filename of the lookup table
+
+    Returns:
+        dictionary of point index arrays
+
+    """
+    with np.load(fn_index, allow_pickle=False) as f:
+        return {key: f[key] for key in f.files}
+
+
+def selectPoints(index, ids):
+    """
+    Select points from a lookup table by identifier
+    Args:
+        index: point index dictionary
+        ids: identifiers of the points to select
+
+    Returns:
+        point index dictionary containing only the selected points, in the order of ids
+
+    """
+    lookup = {point_id: i for i, point_id in enumerate(index['ids'].tolist())}
+    try:
+        selected = np.array([lookup[point_id] for point_id in ids], dtype=np.int64)
+    except KeyError as e:
+        raise KeyError("Point " + str(e) + " is not in the index")
+    subset = dict(index)
+    for key in ['ids', 'x', 'y', 'row', 'col', 'pixel']:
+        subset[key] = index[key][selected]
+    return subset
+
+
+def extractPointSeries(stack, index, ids=None, nodata=-9999.0):
+    """
+    Extract time series for points from a (pixel, time) stack such as the output of hydat.utils.monthlyGridsToNumpy
+    Args:
+        stack: stack array or .npy filename; a stack saved with compact_nodata is matched to grid pixels through its
+            _pixels.npy file
+        index: point index dictionary or filename from buildPointIndex
+        ids: identifiers of the points to extract (default: all points)
+        nodata: value returned for points outside the grid or without data (default: -9999)
+
+    Returns:
+        (point, time) array
+
+    """
+    if not isinstance(index, dict):
+        index = loadPointIndex(index)
+    if ids is not None:
+        index = selectPoints(index, ids)
+    pixels = None
+    if not isinstance(stack, np.ndarray):
+        pixels_fn = stack[:-4] + '_pixels.npy'
+        if os.path.exists(pixels_fn):
+            pixels = np.load(pixels_fn)
+        stack = np.load(stack, mmap_mode='r')
+    rows = index['pixel']
+    if pixels is not None:
+        stored = np.searchsorted(pixels, rows)
+        stored[stored == pixels.size] = 0
+        rows = np.where((rows >= 0) & (pixels[stored] == rows), stored, -1)
+    valid = rows >= 0
+    series = np.full((rows.size, stack.shape[1]), nodata, dtype=stack.dtype)
+    order = np.argsort(rows[valid])  # gather rows in file order
+    series[np.flatnonzero(valid)[order]] = stack[rows[valid][order]]
+    return series
+
+
+def extractNetCDFSeries(fn, var_name, index, ids=None, chunk_days=32, nodata=-9999.0):
+    """
+    Extract time series for points from a (time, y, x) NetCDF variable, e.g. daily Daymet data. Each grid row
+    containing points is read separately, from its first to its last point, so memory use depends on the number of
+    points and not on how far apart they are.
+    Args:
+        fn: NetCDF filename
+        var_name: variable to extract
+        index: point index dictionary or filename from buildPointIndex, built on the same grid
+        ids: identifiers of the points to extract (default: all points)
+        chunk_days: number of time steps to read at a time; None reads all of them at once (default: 32)
+        nodata: value returned for points outside the grid or without data (default: -9999)
+
+    Returns:
+        (point, time) array
+
+    """
+    if not isinstance(index, dict):
+        index = loadPointIndex(index)
+    if ids is not None:
+        index = selectPoints(index, ids)
+    with nc.Dataset(fn) as ds:
+        var = ds[var_name]
+        ntime = var.shape[0]
+        rows = index['row'].copy()
+        cols = index['col']
+        valid = rows >= 0
+        if 'y' in ds.variables and ds['y'].size > 1 and ds['y'][1] > ds['y'][0]:
+            rows[valid] = var.shape[1] - 1 - rows[valid]  # GDAL reports south-up grids flipped
+        series = np.full((rows.size, ntime), nodata, dtype=np.float64)
+        if not np.any(valid):
+            return series
+        if chunk_days is None:
+            chunk_days = ntime
+        dtype = np.result_type(var.dtype, np.float32)
+        points = np.flatnonzero(valid)
+        points = points[np.argsort(rows[points], kind='stable')]
+        strips, first = np.unique(rows[points], return_index=True)
+        for row, in_row in zip(strips, np.split(points, first[1:])):
+            c0, c1 = cols[in_row].min(), cols[in_row].max() + 1
+            for start in range(0, ntime, chunk_days):
+                stop = min(start + chunk_days, ntime)
+                strip = np.ma.filled(var[start:stop, row, c0:c1].astype(dtype), nodata)
+                series[in_row, start:stop] = strip[:, cols[in_row] - c0].T
+    return series
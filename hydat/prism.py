@@ -1,8 +1,17 @@
 import datetime
 import os
 import ftplib
+import queue
 import zipfile
-import wget
+import concurrent.futures
+import hydat.instrument as instrument
+from hydat.lazy import lazyImport
+
+download = lazyImport('hydat.download')  # loaded on first download
+
+FTP_HOST = 'prism.nacse.org'
+FTP_USER = 'anonymous'
+FTP_PASSWORD = 'email@email.com'
 
 
 class PRISMDownloader:
@@ -55,15 +64,17 @@ class PRISMDownloader:
             else:
                 raise Exception('A valid year must be specified')
 
-    def changeCWD_FTP(self):
+    def buildFTPDirectory(self):
         if self.normals:
             wd = 'normals_' + self.res + '/' + self.var
         elif self.day == '':
             wd = 'monthly/' + self.var + '/' + self.year
         else:
             wd = 'daily/' + self.var + '/' + self.year
+        return wd
 
-        self.ftp.cwd(wd)
+    def changeCWD_FTP(self):
+        self.ftp.cwd(self.buildFTPDirectory())
 
     def downloadFTP(self, var, dirname=None, res='4km', year=None, month=None, day=None, normals=False, extract=True,
                     remove_zip=True, overwrite=True):
@@ -82,14 +93,17 @@ class PRISMDownloader:
             self.extract(os.getcwd() + '/' + self.fn, dirname, remove_zip)
 
     def downloadWebServices(self, fn, var, res='4km', year=None, month=None, day=None, normals=False, overwrite=True,
-                            extract=True, extract_dir=None, remove_zip=True):
+                            extract=True, extract_dir=None, remove_zip=True, cache=None):
         self.setProperties(var, res, year, month, day, normals)
         self.buildURL()
         if overwrite:
             if os.path.exists(fn):
                 os.remove(fn)
-        print(self.url)
-        wget.download(self.url, fn)
+        instrument.event('download', url=self.url)
+        if cache is not None:
+            cache.fetch(self.url, fn, download.downloadFile)
+        else:
+            download.downloadFile(self.url, fn)
         if extract:
             self.extract(fn, extract_dir, remove_zip)
 
@@ -108,8 +122,8 @@ class PRISMDownloader:
             raise FileExistsError('The file {} does not exist')
 
     def login(self):
-        self.ftp = ftplib.FTP('prism.nacse.org')
-        self.ftp.login('anonymous', 'email@email.com')
+        self.ftp = ftplib.FTP(FTP_HOST)
+        self.ftp.login(FTP_USER, FTP_PASSWORD)
 
     def setDay(self, day):
         if day is None:
@@ -191,3 +205,173 @@ class PRISMDownloader:
                     self.is_historical = True
                 else:
                     self.is_historical = False
+
+
+class PRISMFTPPool:
+    """
+    Pool of authenticated FTP sessions used to download PRISM files in parallel. Sessions are reused between files
+    and replaced when they drop. Files are retrieved by absolute server path and written to explicit local paths, so
+    the pool never changes the working directory of the server session or of the process.
+    """
+    def __init__(self, size=4, host=FTP_HOST, user=FTP_USER, password=FTP_PASSWORD, port=21, timeout=60, retries=3):
+        self.size = size
+        self.host = host
+        self.user = user
+        self.password = password
+        self.port = port
+        self.timeout = timeout
+        self.retries = retries
+        self.sessions = queue.Queue()
+        for i in range(size):
+            self.sessions.put(None)  # sessions are opened lazily when first used
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def acquire(self):
+        ftp = self.sessions.get()
+        if ftp is None:
+            try:
+                ftp = self.connect()
+            except BaseException:
+                self.release(None)  # give the slot back so other downloads do not wait for it forever
+                raise
+        return ftp
+
+    def close(self):
+        while not self.sessions.empty():
+            ftp = self.sessions.get()
+            if ftp is not None:
+                try:
+                    ftp.quit()
+                except ftplib.all_errors:
+                    ftp.close()
+
+    def connect(self):
+        ftp = ftplib.FTP()
+        ftp.connect(self.host, self.port, timeout=self.timeout)
+        ftp.login(self.user, self.password)
+        return ftp
+
+    def release(self, ftp):
+        self.sessions.put(ftp)
+
+    def retrieve(self, path, fn):
+        """
+        Download a single file
+        Args:
+            path: path of the file on the server, relative to the server root
+            fn: local filename to save the file
+
+        Returns:
+            fn
+
+        """
+        tmp = fn + '.part'
+        instrument.event('download', url='ftp://' + self.host + '/' + path.lstrip('/'))
+        for attempt in range(self.retries + 1):
+            ftp = None
+            try:
+                ftp = self.acquire()
+                try:
+                    f = open(tmp, 'wb')
+                except OSError as e:
+                    self.release(ftp)  # the session is still good
+                    ftp = None
+                    raise _LocalFileError(e)
+                with instrument.stage('download', url='ftp://' + self.host + '/' + path.lstrip('/')):
+                    with f:
+                        ftp.retrbinary('RETR /' + path.lstrip('/'), lambda block: _write(f, block))
+                    instrument.count('bytes_downloaded', os.path.getsize(tmp))
+                    instrument.count('files_downloaded')
+                self.release(ftp)
+                ftp = None  # back in the pool, so no handler below may close or release it again
+                try:
+                    os.replace(tmp, fn)
+                except OSError as e:
+                    raise _LocalFileError(e)
+                return fn
+            except _LocalFileError as e:
+                # writing the local file failed, so retrying would fail the same way
+                if ftp is not None:  # the transfer was interrupted, leaving the session in an unknown state
+                    ftp.close()
+                    self.release(None)
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise e.error
+            except ftplib.error_perm:
+                if ftp is not None:  # otherwise acquire already gave the slot back
+                    self.release(ftp)
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+            except ftplib.all_errors:
+                # connecting failed, or the session dropped or timed out; discard it and try again on a new one
+                if ftp is not None:
+                    ftp.close()
+                    self.release(None)
+                if attempt == self.retries:
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+                    raise
+
+    def downloadMonthly(self, jobs, res='4km', extract=True, remove_zip=True):
+        """
+        Download monthly PRISM files in parallel, one worker per pooled session
+        Args:
+            jobs: iterable of (var, year, month, dirname) tuples; historical years are downloaded once per year
+            res: resolution, 800m or 4km (default: 4km)
+            extract: extract downloaded zip files into dirname (default: True)
+            remove_zip: remove zip files after extraction (default: True)
+
+        Returns:
+            dictionary of {(var, year, month): filename or exception}
+
+        """
+        tasks = {}
+        filenames = set()
+        for var, year, month, dirname in jobs:
+            downloader = PRISMDownloader()
+            downloader.setProperties(var, res, year, month, None, False)
+            downloader.buildFTPFilename()
+            fn = os.path.join(dirname, downloader.fn)
+            if fn not in filenames:  # historical years share one file for all months
+                filenames.add(fn)
+                tasks[(var, year, month)] = (downloader.buildFTPDirectory() + '/' + downloader.fn, fn)
+
+        def fetch(task):
+            path, fn = task
+            self.retrieve(path, fn)
+            if extract:
+                downloader = PRISMDownloader()
+                downloader.extract(fn, os.path.dirname(fn), remove_zip)
+            return fn
+
+        results = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.size) as executor:
+            futures = {executor.submit(fetch, task): key for key, task in tasks.items()}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    results[futures[future]] = future.result()
+                except Exception as e:
+                    results[futures[future]] = e
+        return results
+
+
+class _LocalFileError(Exception):
+    """
+    Wraps an OSError raised by a local file while downloading, so it is not retried like a dropped FTP session
+    """
+    def __init__(self, error):
+        super().__init__(error)
+        self.error = error
+
+
+def _write(f, block):
+    try:
+        f.write(block)
+    except OSError as e:
+        raise _LocalFileError(e)
@@ -0,0 +1,246 @@
+import os
+import json
+import hashlib
+import numpy as np
+import netCDF4 as nc
+import hydat.gis as gis
+import hydat.daymet as daymet
+import hydat.instrument as instrument
+from hydat.lazy import lazyImport
+
+osr = lazyImport('osr')
+
+METHODS = ['nearest', 'bilinear']
+
+
+def buildWarpIndex(src, dst_srs='EPSG:5070', is_netcdf=False, var_name=None, method='nearest', resolution=None,
+                   bounds=None, block_rows=256, cache_dir=None):
+    """
+    Compute the source pixels (and weights) of every pixel of a reprojected grid once, so whole (time, y, x) cubes on
+    the source grid can be warped with array gathers instead of a gdal.Warp call per time step and variable. By default
+    the target grid covers the reprojected extent of the source with as many rows and columns as the source.
+    Args:
+        src: filename of a raster on the source grid (e.g. a Daymet NetCDF file)
+        dst_srs: spatial reference of the target grid, as WKT or a user input string (default: 'EPSG:5070')
+        is_netcdf: src is a NetCDF file (default: False)
+        var_name: NetCDF variable to open (default: None)
+        method: 'nearest' or 'bilinear' (default: 'nearest')
+        resolution: pixel size of the target grid in target units, a number or (x, y) tuple (default: None)
+        bounds: (xmin, ymin, xmax, ymax) of the target grid in target units (default: None)
+        block_rows: number of target rows transformed at a time (default: 256)
+        cache_dir: directory to cache the index in; the index is reused while the source grid, the target grid, and
+            the method are unchanged (default: None)
+
+    Returns:
+        dictionary of index arrays; index ((pixels, 1) or (pixels, 4) flat source pixel, -1 outside the source),
+        weight (same shape), and the geotransform, projection, and shape of the target and the source grids
+
+    """
+    if method not in METHODS:
+        raise ValueError("'" + method + "' is an invalid method. Must be one of " + str(METHODS))
+    ds = gis.openRaster(src, is_netcdf, var_name)
+    src_geot = ds.GetGeoTransform()
+    src_proj = ds.GetProjection()
+    src_rows = ds.RasterYSize
+    src_cols = ds.RasterXSize
+    ds = None
+    if not src_proj:
+        raise ValueError(src + " has no spatial reference")
+    dst_proj = _toWkt(dst_srs)
+    fn_cache = None
+    if cache_dir is not None:
+        key = json.dumps([list(src_geot), src_proj, src_rows, src_cols, dst_proj, method, resolution, bounds],
+                         default=str)
+        fn_cache = os.path.join(cache_dir, 'warp_' + hashlib.sha256(key.encode()).hexdigest()[:16] + '.npz')
+        if os.path.exists(fn_cache):
+            return loadWarpIndex(fn_cache)
+
+    if bounds is None:
+        bounds = _transformBounds(src_geot, src_rows, src_cols, src_proj, dst_proj)
+    xmin, ymin, xmax, ymax = bounds
+    if resolution is None:
+        xres, yres = (xmax - xmin) / src_cols, (ymax - ymin) / src_rows
+    elif np.isscalar(resolution):
+        xres, yres = resolution, resolution
+    else:
+        xres, yres = resolution
+    rows = int(np.ceil(round((ymax - ymin) / yres, 6)))
+    cols = int(np.ceil(round((xmax - xmin) / xres, 6)))
+    geot = (xmin, xres, 0.0, ymax, 0.0, -yres)
+
+    npix = 1 if method == 'nearest' else 4
+    dtype = np.int32 if src_rows * src_cols <= np.iinfo(np.int32).max else np.int64
+    index = np.empty((rows * cols, npix), dtype=dtype)
+    weight = np.empty((rows * cols, npix), dtype=np.float32)
+    xs = geot[0] + (np.arange(cols) + 0.5) * geot[1]
+    for row in range(0, rows, block_rows):
+        nrow = min(block_rows, rows - row)
+        ys = geot[3] + (np.arange(row, row + nrow) + 0.5) * geot[5]
+        x, y = gis.transformCoordinates(np.tile(xs, nrow), np.repeat(ys, cols), dst_proj, src_proj)
+        # fractional source column and row of each target pixel center
+        fc = (x - src_geot[0]) / src_geot[1]
+        fr = (y - src_geot[3]) / src_geot[5]
+        block = slice(row * cols, (row + nrow) * cols)
+        if method == 'nearest':
+            index[block, 0] = _flatIndex(np.floor(fr), np.floor(fc), src_rows, src_cols)
+            weight[block, 0] = 1.0
+        else:
+            fc -= 0.5
+            fr -= 0.5
+            c0 = np.floor(fc)
+            r0 = np.floor(fr)
+            dc = fc - c0
+            dr = fr - r0
+            for i, (r, c, w) in enumerate([(r0, c0, (1 - dr) * (1 - dc)), (r0, c0 + 1, (1 - dr) * dc),
+                                           (r0 + 1, c0, dr * (1 - dc)), (r0 + 1, c0 + 1, dr * dc)]):
+                index[block, i] = _flatIndex(r, c, src_rows, src_cols)
+                weight[block, i] = np.where(index[block, i] >= 0, w, 0.0)
+    warp = {'index': index, 'weight': weight, 'geotransform': np.array(geot), 'projection': np.array(dst_proj),
+            'shape': np.array([rows, cols]), 'src_geotransform': np.array(src_geot),
+            'src_projection': np.array(src_proj), 'src_shape': np.array([src_rows, src_cols])}
+    if fn_cache is not None:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        np.savez(fn_cache, **warp)
+    return warp
+
+
+def loadWarpIndex(fn):
+    """
+    Load an index saved by buildWarpIndex
+    Args:
+        fn: filename of the index (.npz)
+
+    Returns:
+        dictionary of index arrays
+
+    """
+    with np.load(fn, allow_pickle=False) as f:
+        return {key: f[key] for key in f.files}
+
+
+def _toWkt(definition):
+    ref = osr.SpatialReference()
+    ref.SetFromUserInput(definition)
+    return ref.ExportToWkt()
+
+
+def _transformBounds(geot, rows, cols, src_proj, dst_proj, samples=101):
+    # sample the edges of the source grid, since straight edges are curved in the target projection
+    steps = np.linspace(0.0, 1.0, samples)
+    c = np.concatenate([steps, steps, np.zeros(samples), np.ones(samples)]) * cols
+    r = np.concatenate([np.zeros(samples), np.ones(samples), steps, steps]) * rows
+    x, y = gis.transformCoordinates(geot[0] + c * geot[1] + r * geot[2], geot[3] + c * geot[4] + r * geot[5],
+                                    src_proj, dst_proj)
+    return x.min(), y.min(), x.max(), y.max()
+
+
+def _flatIndex(rows, cols, nrows, ncols):
+    inside = (rows >= 0) & (rows < nrows) & (cols >= 0) & (cols < ncols)
+    return np.where(inside, rows * ncols + cols, -1)
+
+
+def warpArray(cube, warp, nodata=daymet.NO_DATA_VALUE, block_rows=256):
+    """
+    Warp a cube on the source grid of an index to its target grid
+    Args:
+        cube: (time, y, x) or (y, x) array; values equal to nodata or nan have no data
+        warp: index dictionary or filename from buildWarpIndex
+        nodata: no data value of the cube and the output (default: -9999)
+        block_rows: number of target rows gathered at a time (default: 256)
+
+    Returns:
+        float32 array of (time, rows, cols) or (rows, cols) on the target grid; with bilinear weights, pixels with some
+        source pixels missing are interpolated from the rest
+
+    """
+    if not isinstance(warp, dict):
+        warp = loadWarpIndex(warp)
+    cube = np.asarray(cube)
+    if cube.shape[-2:] != tuple(warp['src_shape']):
+        raise ValueError("cube is not on the source grid of the index")
+    values = _gather(cube.reshape((-1, cube.shape[-2] * cube.shape[-1])), warp['index'], warp['weight'], nodata,
+                     block_rows * int(warp['shape'][1]))
+    return values.reshape(cube.shape[:-2] + tuple(warp['shape']))
+
+
+def _gather(flat, index, weight, nodata, block_pixels):
+    # flat is (time, source pixels); returns (time, target pixels), gathered block_pixels target pixels at a time
+    out = np.empty((flat.shape[0], index.shape[0]), dtype=np.float32)
+    for start in range(0, index.shape[0], block_pixels):
+        block = slice(start, min(start + block_pixels, index.shape[0]))
+        out[:, block] = _gatherBlock(flat, index[block], weight[block], nodata)
+    return out
+
+
+def _gatherBlock(flat, index, weight, nodata):
+    # sums the weighted source pixels one neighbour at a time, so no (time, pixels, neighbours) array is built
+    total = np.zeros((flat.shape[0], index.shape[0]), dtype=np.float32)
+    weights = np.zeros_like(total)
+    for k in range(index.shape[1]):
+        values = flat[:, np.maximum(index[:, k], 0)].astype(np.float32)
+        valid = (index[:, k] >= 0) & ~np.isnan(values) & (values != nodata)
+        if index.shape[1] == 1:
+            values[~valid] = nodata
+            return values
+        values[~valid] = 0.0
+        values *= weight[:, k]
+        total += values
+        weights += valid * weight[:, k]
+    out = np.full(total.shape, nodata, dtype=np.float32)
+    np.divide(total, weights, out=out, where=weights > 0)
+    return out
+
+
+def warpNetCDF(fn_in, var_name, fn_out, warp, chunk_days=8, nodata=daymet.NO_DATA_VALUE, compress=None,
+               block_rows=256):
+    """
+    Warp a (time, y, x) NetCDF variable, e.g. a year of daily Daymet data, to a multi-band GeoTIFF with one band per
+    time step. The index is computed once; each block of time steps costs one read of the window of source rows and
+    columns the target grid needs, gathered block_rows target rows at a time.
+    Args:
+        fn_in: NetCDF filename
+        var_name: variable to warp
+        fn_out: output filename
+        warp: index dictionary or filename from buildWarpIndex, built on the grid of fn_in
+        chunk_days: number of time steps to read and warp at a time (default: 8)
+        nodata: no data value of the variable and the output (default: -9999)
+        compress: compression of the output; see hydat.gis.getCreationOptions (default: None)
+        block_rows: number of target rows gathered at a time (default: 256)
+
+    Returns:
+
+    """
+    if not isinstance(warp, dict):
+        warp = loadWarpIndex(warp)
+    nrows, ncols = warp['src_shape']
+    with nc.Dataset(fn_in) as ds:
+        var = ds[var_name]
+        if var.shape[1:] != (nrows, ncols):
+            raise ValueError(fn_in + " is not on the source grid of the index")
+        index = warp['index']
+        rows = index // ncols
+        cols = index % ncols
+        if 'y' in ds.variables and ds['y'].size > 1 and ds['y'][1] > ds['y'][0]:
+            rows = nrows - 1 - rows  # GDAL reports south-up grids flipped
+        used = index >= 0
+        if np.any(used):
+            r0, r1 = rows[used].min(), rows[used].max() + 1
+            c0, c1 = cols[used].min(), cols[used].max() + 1
+        else:
+            r0, r1, c0, c1 = 0, 1, 0, 1
+        # index into the window that is read
+        window = np.where(used, (rows - r0) * (c1 - c0) + (cols - c0), -1)
+
+        def blocks():
+            for start in range(0, var.shape[0], chunk_days):
+                stop = min(start + chunk_days, var.shape[0])
+                block = np.ma.filled(var[start:stop, r0:r1, c0:c1].astype(np.float32), nodata)
+                out = _gather(block.reshape((stop - start, -1)), window, warp['weight'], nodata,
+                              block_rows * int(warp['shape'][1]))
+                instrument.count('cells_processed', block.size)
+                yield out.reshape((stop - start,) + tuple(warp['shape']))
+
+        gis.writeBlocksAsRaster(fn_out, blocks(), var.shape[0], int(warp['shape'][0]), int(warp['shape'][1]),
+                                tuple(warp['geotransform']), str(warp['projection']), nodata=nodata, nan=nodata,
+                                compress=compress)
@@ -0,0 +1,86 @@
+import os
+import concurrent.futures
+import hydat.instrument as instrument
+
+
+def runYears(func, years, args=(), kwargs=None, workers=1):
+    """
+    Run a function once per year, optionally spreading the years across a pool of processes. A failure in one year
+    is reported and returned without stopping the remaining years. Each year is timed as an instrumentation stage
+    named after func; reports made in worker processes are passed on to the instrumentation of this process.
+    Args:
+        func: module level function called as func(year, *args, **kwargs)
+        years: iterable of years
+        args: additional positional arguments passed to func
+        kwargs: additional keyword arguments passed to func
+        workers: number of worker processes; 1 runs in the calling process, None uses all available cores
+            (default: 1)
+
+    Returns:
+        dictionary of {year: return value of func or the exception raised for that year}
+
+    """
+    if kwargs is None:
+        kwargs = {}
+    if workers is None:
+        workers = os.cpu_count()
+    years = list(years)
+    results = {}
+    name = func.__name__.lstrip('_')
+    if workers == 1 or len(years) <= 1:
+        for year in years:
+            try:
+                with instrument.stage(name, year=year):
+                    results[year] = func(year, *args, **kwargs)
+            except Exception as e:
+                results[year] = e  # keeps its traceback, which is logged below
+    else:
+        instrumented = instrument.getInstrumentation() is not None
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(years))) as executor:
+            if instrumented:
+                futures = {executor.submit(_runInstrumented, func, name, year, args, kwargs): year for year in years}
+            else:
+                futures = {executor.submit(func, year, *args, **kwargs): year for year in years}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    results[futures[future]] = future.result()
+                except Exception as e:
+                    results[futures[future]] = e
+                    continue
+                if instrumented:
+                    results[futures[future]], reports = results[futures[future]]
+                    reports.replay(instrument.getInstrumentation())
+    results = {year: results[year] for year in sorted(results)}
+    for year in results:
+        if isinstance(results[year], Exception):
+            instrument.event('failed', year=year, error=repr(results[year]))
+            instrument.logger.warning('%s failed: %r', year, results[year], exc_info=results[year])
+    return results
+
+
+def _runInstrumented(func, name, year, args, kwargs):
+    # runs in a worker process; reports are buffered and returned with the result
+    reports = instrument.Buffer()
+    instrument.setInstrumentation(reports)
+    try:
+        with instrument.stage(name, year=year):
+            result = func(year, *args, **kwargs)
+    except Exception as e:
+        instrument.logger.exception('%s failed', year)  # the traceback is lost when the exception is returned
+        result = e
+    finally:
+        instrument.setInstrumentation(None)
+    return result, reports
+
+
+def failedYears(results):
+    """
+    List the years that failed in the results of runYears
+    Args:
+        results: dictionary returned by runYears
+
+    Returns:
+        sorted list of years
+
+    """
+    return sorted(year for year, result in results.items() if isinstance(result, Exception))
@@ -1,30 +1,44 @@
 import numpy as np
-import gdal
 import os
+import json
 import hydat.prism
+import hydat.incremental as incremental
+import hydat.bil as bil
+import hydat.instrument as instrument
 
 
-def downloadMonthlyPRISM_FTP(start_year, end_year, output_dir, variables=()):
-    downloader = hydat.prism.PRISMDownloader()
-    if not os.path.exists(output_dir):
-        os.mkdir(output_dir)
-    os.chdir(output_dir)
+def downloadMonthlyPRISM_FTP(start_year, end_year, output_dir, variables=(), connections=4, res='4km', extract=True):
+    """
+    Download monthly PRISM data over FTP into output_dir/var/year using a pool of FTP sessions
+    Args:
+        start_year: first year to download
+        end_year: last year to download
+        output_dir: directory to save data
+        variables: PRISM variables to download (ppt, tmin, tmax, tmean)
+        connections: number of concurrent FTP sessions (default: 4)
+        res: resolution, 800m or 4km (default: 4km)
+        extract: extract the downloaded zip files; if False the archives are kept and can be stacked directly with
+            monthlyGridsToNumpy(..., archives=True) (default: True)
+
+    Returns:
+        dictionary of {(var, year, month): filename or exception}
+
+    """
+    jobs = []
     for var in variables:
-        if not os.path.exists(var):
-            os.mkdir(var)
-        os.chdir(var)
         for year in range(start_year, end_year+1):
-            if not os.path.exists(str(year)):
-                os.mkdir(str(year))
-            os.chdir(str(year))
+            year_dir = os.path.join(output_dir, var, str(year))
+            if not os.path.exists(year_dir):
+                os.makedirs(year_dir)
             for month in range(1, 13):
-                downloader.downloadFTP(var, year=year, month=month)
-                if downloader.is_historical:
-                    break
-            os.chdir('../')
-            print(var, year, 'downloaded')
-        os.chdir('../')
-    os.chdir(output_dir)
+                jobs.append((var, year, month, year_dir))
+    with hydat.prism.PRISMFTPPool(connections) as pool:
+        results = pool.downloadMonthly(jobs, res=res, extract=extract)
+    for key, result in sorted(results.items()):
+        if isinstance(result, Exception):
+            instrument.event('failed', var=key[0], year=key[1], month=key[2], error=repr(result))
+            instrument.logger.warning('%s %s %s failed: %r', key[0], key[1], key[2], result)
+    return results
 
 
 def getPRISMFilename(year, month, var, res='4km'):
@@ -37,15 +51,155 @@ def getPRISMFilename(year, month, var, res='4km'):
     return fn
 
 
-def monthlyGridsToNumpy(out_fn, start_year, end_year, in_dir, pvar):
+def getPRISMArchiveName(year, month, var, res='4km'):
+    """
+    Name of the zip archive a monthly PRISM grid is distributed in
+    Args:
+        year: year of the grid
+        month: month of the grid
+        var: PRISM variable (ppt, tmin, tmax, tmean)
+        res: resolution, 800m or 4km (default: 4km)
+
+    Returns:
+        archive filename; grids before 1981 are distributed in one archive per year
+
+    """
+    downloader = hydat.prism.PRISMDownloader()
+    downloader.setProperties(var, res, year, month, None, False)
+    downloader.buildFTPFilename()
+    return downloader.fn
+
+
+def getPRISMPath(in_dir, year, month, var, res='4km', archives=False):
+    """
+    Path GDAL opens a monthly PRISM grid from
+    Args:
+        in_dir: directory containing a subdirectory of grids for each year
+        year: year of the grid
+        month: month of the grid
+        var: PRISM variable (ppt, tmin, tmax, tmean)
+        res: resolution, 800m or 4km (default: 4km)
+        archives: read the grid from the downloaded zip archive through /vsizip/ instead of an extracted .bil
+            (default: False)
+
+    Returns:
+        path of the grid
+
+    """
+    fn = getPRISMFilename(year, month, var, res)
+    if archives:
+        return '/vsizip/' + in_dir + '/' + str(year) + '/' + getPRISMArchiveName(year, month, var, res) + '/' + fn
+    return in_dir + '/' + str(year) + '/' + fn
+
+
+def monthlyGridsToNumpy(out_fn, start_year, end_year, in_dir, pvar, dtype=np.float32, compact_nodata=False,
+                        nodata=-9999.0, resume=True, incremental=False, dry_run=False, archives=False):
+    """
+    Stack monthly PRISM grids into a (pixels, months) array saved as a .npy file. Each grid is written into a memory
+    mapped file as it is read, so the stack never has to fit in memory. Extracted .bil grids are memory mapped with
+    hydat.bil and copied straight into their output column; grids in archives are read with GDAL. The array is stored
+    in column-major order so each month is contiguous on disk; np.load returns it with the same shape and values.
+    Args:
+        out_fn: output .npy filename (.npy is appended if missing)
+        start_year: first year to stack
+        end_year: last year to stack
+        in_dir: directory containing a subdirectory of grids for each year
+        pvar: PRISM variable (ppt, tmin, tmax, tmean)
+        dtype: data type of the output array (default: float32)
+        compact_nodata: only store pixels that have data in the first grid; the flat grid index of each stored row is
+            saved to <out_fn>_pixels.npy (default: False)
+        nodata: no data value of the grids (default: -9999)
+        resume: continue an interrupted run from its checkpoint (<out_fn>.checkpoint) if present (default: True)
+        incremental: only rewrite the columns of years whose grids changed since the stack was built, as recorded in
+            hydat_manifest.json next to out_fn (default: False)
+        dry_run: only return the list of years that would be rewritten incrementally (default: False)
+        archives: read grids directly from the downloaded zip archives instead of extracted .bil files; the archives
+            are not extracted to disk (default: False)
+
+    Returns:
+        output filename, or the list of years that would be rewritten if dry_run
+
+    """
+    if not out_fn.endswith('.npy'):
+        out_fn += '.npy'
+    pixels_fn = out_fn[:-4] + '_pixels.npy'
+    checkpoint_fn = out_fn + '.checkpoint'
     ncol = (end_year - start_year + 1) * 12
+    years = list(range(start_year, end_year + 1))
+    settings = {'start_year': start_year, 'end_year': end_year, 'in_dir': os.path.abspath(in_dir), 'pvar': pvar,
+                'dtype': np.dtype(dtype).str, 'compact_nodata': compact_nodata, 'archives': archives}
+    manifest = _openManifest(out_fn, hash_inputs=incremental or dry_run)
+
+    def sources(year):
+        return [getPRISMPath(in_dir, year, month, pvar, archives=archives) for month in range(1, 13)]
+
+    def inputs(year):
+        if archives:  # pre-1981 months share one archive
+            return sorted(set(in_dir + '/' + str(year) + '/' + getPRISMArchiveName(year, month, pvar)
+                              for month in range(1, 13)))
+        return sources(year)
+
     out_arr = None
-    for year in range(start_year, end_year + 1):
-        for month in range(0, 12):
-            ds = gdal.Open(in_dir + '/' + str(year) + '/' + getPRISMFilename(year, month + 1, pvar))
-            temp_arr = ds.GetRasterBand(1).ReadAsArray()
-            if out_arr is None:
-                out_arr = np.empty((temp_arr.size, ncol), dtype=np.float)
-            colidx = (year - start_year) * 12 + month
-            out_arr[:, colidx] = temp_arr.flatten()
-    np.save(out_fn, out_arr)
+    pixels = None
+    columns = range(0, ncol)
+    if resume and os.path.exists(checkpoint_fn) and os.path.exists(out_fn):
+        with open(checkpoint_fn) as f:
+            checkpoint = json.load(f)
+        if checkpoint['settings'] == settings:
+            out_arr = np.lib.format.open_memmap(out_fn, mode='r+')
+            if compact_nodata:
+                pixels = np.load(pixels_fn)
+            columns = range(checkpoint['next_col'], ncol)
+    elif (incremental or dry_run) and os.path.exists(out_fn) and not os.path.exists(checkpoint_fn):
+        stale = [year for year in years if manifest.isStale(out_fn + '::' + str(year), inputs(year), settings)]
+        if dry_run:
+            return stale
+        out_arr = np.lib.format.open_memmap(out_fn, mode='r+')
+        if out_arr.shape[1] == ncol and out_arr.dtype == np.dtype(dtype) and \
+                (not compact_nodata or os.path.exists(pixels_fn)):
+            if compact_nodata:
+                pixels = np.load(pixels_fn)
+            years = stale
+            columns = [(year - start_year) * 12 + month for year in stale for month in range(0, 12)]
+        else:
+            out_arr = None  # stack was built with different settings, rebuild it
+    elif dry_run:
+        return years
+    for colidx in columns:
+        year = start_year + colidx // 12
+        month = colidx % 12
+        grid = bil.readGrid(sources(year)[month]).reshape(-1)  # a view of the memory mapped file for .bil grids
+        if out_arr is None:
+            if compact_nodata:
+                pixels = np.flatnonzero(grid != nodata)
+                np.save(pixels_fn, pixels)
+            nrow = grid.size if pixels is None else pixels.size
+            out_arr = np.lib.format.open_memmap(out_fn, mode='w+', dtype=dtype, shape=(nrow, ncol), fortran_order=True)
+        if pixels is None:
+            out_arr[:, colidx] = grid
+        else:
+            out_arr[:, colidx] = grid[pixels]
+        out_arr.flush()
+        instrument.count('files_processed')
+        instrument.count('cells_processed', grid.size)
+        if isinstance(columns, range):
+            _writeCheckpoint(checkpoint_fn, {'settings': settings, 'next_col': colidx + 1})
+    del out_arr
+    if os.path.exists(checkpoint_fn):
+        os.remove(checkpoint_fn)
+    for year in years:
+        manifest.record(out_fn + '::' + str(year), inputs(year), settings)
+    manifest.save()
+    return out_fn
+
+
+def _openManifest(out_fn, hash_inputs):
+    # monthlyGridsToNumpy takes an incremental flag, which hides the incremental module inside it
+    return incremental.BuildManifest(os.path.join(os.path.dirname(os.path.abspath(out_fn)), incremental.MANIFEST_NAME),
+                                     hash_inputs=hash_inputs)
+
+
+def _writeCheckpoint(fn, checkpoint):
+    with open(fn + '.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(fn + '.tmp', fn)
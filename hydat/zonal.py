@@ -0,0 +1,361 @@
+import os
+import json
+import hashlib
+import numpy as np
+import netCDF4 as nc
+import hydat.gis as gis
+import hydat.daymet as daymet
+import hydat.incremental as incremental
+import hydat.instrument as instrument
+from hydat.lazy import lazyImport
+
+ogr = lazyImport('ogr')
+osr = lazyImport('osr')
+
+try:
+    import scipy.sparse as sparse
+except ImportError:  # zone reductions fall back to NumPy
+    sparse = None
+
+STATISTICS = ['mean', 'sum', 'count']
+
+
+def buildZoneWeights(src, zones, field=None, is_netcdf=False, var_name=None, supersample=1, all_touched=False,
+                     block_rows=256, zone_nodata=-9999, cache_dir=None):
+    """
+    Build the sparse pixel to zone weight matrix of a grid. The weight of a pixel in a zone is the fraction of the
+    pixel the zone covers, estimated by rasterizing the zones at supersample times the grid resolution. Zones are
+    rasterized in strips of rows, and a zone raster is read in strips, so memory use does not depend on the grid size.
+    Zones should not overlap; where they do, each subpixel is assigned to the last zone rasterized.
+    Args:
+        src: filename of a raster on the grid (e.g. a PRISM grid, or a Daymet NetCDF file)
+        zones: filename of a polygon vector dataset, or of a raster of integer zone ids on the same grid
+        field: integer or string attribute holding the zone id of each polygon (default: None, the feature ID)
+        is_netcdf: src is a NetCDF file (default: False)
+        var_name: NetCDF variable to open (default: None)
+        supersample: number of subpixels per pixel along each axis; 1 assigns each pixel to the zone containing its
+            center (default: 1)
+        all_touched: assign every pixel touched by a polygon to it; only used when supersample is 1 (default: False)
+        block_rows: number of grid rows rasterized at a time (default: 256)
+        zone_nodata: value of a zone raster outside all zones (default: -9999)
+        cache_dir: directory to cache the weights in; weights are reused while the grid, the zones, and the options
+            are unchanged (default: None)
+
+    Returns:
+        dictionary of weight arrays; ids (zone identifiers), zone (index into ids), pixel (flat grid index), weight,
+        and the geotransform, projection, and shape of the grid
+
+    """
+    ds = gis.openRaster(src, is_netcdf, var_name)
+    geot = ds.GetGeoTransform()
+    proj = ds.GetProjection()
+    nrows = ds.RasterYSize
+    ncols = ds.RasterXSize
+    ds = None
+    fn_cache = None
+    if cache_dir is not None:
+        key = json.dumps([list(geot), proj, nrows, ncols, os.path.abspath(zones),
+                          incremental.fileState(zones, hash_file=False), field, supersample, all_touched,
+                          zone_nodata], sort_keys=True, default=str)
+        fn_cache = os.path.join(cache_dir, 'zones_' + hashlib.sha256(key.encode()).hexdigest()[:16] + '.npz')
+        if os.path.exists(fn_cache):
+            return loadZoneWeights(fn_cache)
+
+    if _isRaster(zones):
+        ids, strips = _readZoneRaster(zones, nrows, ncols, block_rows, zone_nodata)
+        supersample = 1
+    else:
+        ids, strips = _rasterizeZones(zones, field, geot, proj, nrows, ncols, supersample, all_touched, block_rows)
+    nzones = max(len(ids), 1)
+    pixel, zone, weight = [], [], []
+    for row, codes in strips:
+        nrow = codes.shape[0] // supersample
+        # flat grid index of every subpixel of the strip
+        flat = np.arange(row * ncols, (row + nrow) * ncols, dtype=np.int64).reshape((nrow, 1, ncols, 1))
+        flat = np.broadcast_to(flat, (nrow, supersample, ncols, supersample)).reshape(codes.shape)
+        inside = codes >= 0
+        keys, counts = np.unique(flat[inside] * nzones + codes[inside], return_counts=True)
+        pixel.append(keys // nzones)
+        zone.append(keys % nzones)
+        weight.append(counts / float(supersample ** 2))
+    weights = {'ids': np.asarray(ids), 'pixel': np.concatenate(pixel), 'zone': np.concatenate(zone),
+               'weight': np.concatenate(weight), 'geotransform': np.array(geot), 'projection': np.array(proj),
+               'shape': np.array([nrows, ncols])}
+    if fn_cache is not None:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        np.savez(fn_cache, **weights)
+    return weights
+
+
+def loadZoneWeights(fn):
+    """
+    Load weights saved by buildZoneWeights
+    Args:
+        fn: filename of the weights (.npz)
+
+    Returns:
+        dictionary of weight arrays
+
+    """
+    with np.load(fn, allow_pickle=False) as f:
+        return {key: f[key] for key in f.files}
+
+
+def _isRaster(fn):
+    try:
+        gdal = gis.gdal
+        ds = gdal.OpenEx(fn, gdal.OF_RASTER) if hasattr(gdal, 'OpenEx') else gdal.Open(fn)
+    except RuntimeError:
+        return False
+    return ds is not None
+
+
+def _readZoneRaster(fn, nrows, ncols, block_rows, zone_nodata):
+    ds = gis.openRaster(fn)
+    if ds.RasterYSize != nrows or ds.RasterXSize != ncols:
+        raise ValueError(fn + " is not on the grid (" + str(nrows) + " rows, " + str(ncols) + " columns)")
+    band = ds.GetRasterBand(1)
+    values = set()
+    for row in range(0, nrows, block_rows):
+        strip = band.ReadAsArray(0, row, ncols, min(block_rows, nrows - row))
+        values.update(np.unique(strip[strip != zone_nodata]).tolist())
+    ids = np.array(sorted(values))
+
+    def strips():
+        for row in range(0, nrows, block_rows):
+            strip = band.ReadAsArray(0, row, ncols, min(block_rows, nrows - row))
+            codes = np.searchsorted(ids, strip)
+            codes[strip == zone_nodata] = -1
+            yield row, codes
+
+    return ids, strips()
+
+
+def _rasterizeZones(fn, field, geot, proj, nrows, ncols, supersample, all_touched, block_rows):
+    src = ogr.Open(fn)
+    if src is None:
+        raise IOError("Unable to open vector dataset " + fn)
+    layer = src.GetLayer()
+    # copy the polygons to memory with their position as the burned value, reprojected to the grid
+    mem = ogr.GetDriverByName('Memory').CreateDataSource('zones')
+    grid_srs = None
+    if proj:
+        grid_srs = osr.SpatialReference()
+        grid_srs.ImportFromWkt(proj)
+    zones = mem.CreateLayer('zones', grid_srs, ogr.wkbMultiPolygon)
+    zones.CreateField(ogr.FieldDefn('zone', ogr.OFTInteger))
+    transform = None
+    if grid_srs is not None and layer.GetSpatialRef() is not None and not layer.GetSpatialRef().IsSame(grid_srs):
+        src_srs = layer.GetSpatialRef()
+        if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+            src_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            grid_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        transform = osr.CoordinateTransformation(src_srs, grid_srs)
+    ids = []
+    for feature in layer:
+        geometry = feature.GetGeometryRef()
+        if geometry is None:
+            continue
+        geometry = geometry.Clone()
+        if transform is not None:
+            geometry.Transform(transform)
+        out = ogr.Feature(zones.GetLayerDefn())
+        out.SetGeometry(geometry)
+        out.SetField('zone', len(ids))
+        zones.CreateFeature(out)
+        ids.append(feature.GetFID() if field is None else feature.GetField(field))
+    options = ['ATTRIBUTE=zone']
+    if all_touched and supersample == 1:
+        options.append('ALL_TOUCHED=TRUE')
+
+    def strips():
+        gdal = gis.gdal
+        driver = gdal.GetDriverByName('MEM')
+        layer = mem.GetLayer(0)  # keeps the memory dataset alive while strips are rasterized
+        for row in range(0, nrows, block_rows):
+            nrow = min(block_rows, nrows - row)
+            ds = driver.Create('', ncols * supersample, nrow * supersample, 1, gdal.GDT_Int32)
+            ds.SetGeoTransform((geot[0] + row * geot[2], geot[1] / supersample, geot[2] / supersample,
+                                geot[3] + row * geot[5], geot[4] / supersample, geot[5] / supersample))
+            if proj:
+                ds.SetProjection(proj)
+            band = ds.GetRasterBand(1)
+            band.Fill(-1)
+            gdal.RasterizeLayer(ds, [1], layer, options=options)
+            codes = band.ReadAsArray()
+            ds = None
+            yield row, codes
+
+    return ids, strips()
+
+
+class _ZoneReducer:
+    """
+    Reduces blocks of (time, pixel) values to zones with the weights of the pixels that are read
+    """
+    def __init__(self, weights, columns, ncols, nzones):
+        """
+        Args:
+            weights: dictionary of weight arrays
+            columns: column of each weight in the blocks that will be reduced, -1 where the pixel is not read
+            ncols: number of columns of the blocks
+            nzones: number of zones
+
+        """
+        keep = columns >= 0
+        self.columns = columns[keep]
+        self.zone = weights['zone'][keep]
+        self.weight = weights['weight'][keep].astype(np.float64)
+        self.nzones = nzones
+        self.matrix = None
+        if sparse is not None:
+            self.matrix = sparse.csr_matrix((self.weight, (self.zone, self.columns)), shape=(nzones, ncols))
+        else:
+            order = np.argsort(self.zone, kind='stable')
+            self.columns = self.columns[order]
+            self.zone = self.zone[order]
+            self.weight = self.weight[order]
+            self.zones, self.starts = np.unique(self.zone, return_index=True)
+
+    def reduce(self, block):
+        """
+        Args:
+            block: (time, column) array with no data as nan
+
+        Returns:
+            tuple of (time, zone) weighted sums and weights of valid pixels
+
+        """
+        valid = ~np.isnan(block)
+        filled = np.where(valid, block, 0.0)
+        if self.matrix is not None:
+            sums = np.asarray(self.matrix @ filled.T).T
+            counts = np.asarray(self.matrix @ valid.T.astype(np.float64)).T
+        else:
+            sums = np.zeros((block.shape[0], self.nzones))
+            counts = np.zeros((block.shape[0], self.nzones))
+            if self.zones.size:
+                sums[:, self.zones] = np.add.reduceat(filled[:, self.columns] * self.weight, self.starts, axis=1)
+                counts[:, self.zones] = np.add.reduceat(valid[:, self.columns] * self.weight, self.starts, axis=1)
+        return sums, counts
+
+
+def _statistics(sums, counts, stats, nodata):
+    out = {}
+    empty = counts == 0
+    for stat in stats:
+        if stat == 'mean':
+            values = np.divide(sums, counts, out=np.zeros(sums.shape), where=~empty)
+        elif stat == 'sum':
+            values = sums.copy()
+        else:
+            values = counts.copy()
+        if stat != 'count':
+            values[empty] = nodata
+        out[stat] = values.T  # (zone, time) like point series
+    return out
+
+
+def _checkStats(stats):
+    for stat in stats:
+        if stat not in STATISTICS:
+            raise ValueError("'" + stat + "' is an invalid statistic. Must be one of " + str(STATISTICS))
+
+
+def zonalNetCDF(fn, var_name, weights, stats=('mean',), chunk_days=32, nodata=daymet.NO_DATA_VALUE):
+    """
+    Reduce a (time, y, x) NetCDF variable, e.g. daily Daymet data, to zone statistics with one sparse matrix product per
+    block of time steps. Only the window of rows and columns containing the zones is read. Values equal to the Daymet
+    no data value or masked are left out of the statistics.
+    Args:
+        fn: NetCDF filename
+        var_name: variable to reduce
+        weights: weight dictionary or filename from buildZoneWeights, built on the same grid
+        stats: statistics to compute; 'mean' (weighted by coverage), 'sum' (coverage weighted sum), and 'count'
+            (covered pixels with data) (default: ('mean',))
+        chunk_days: number of time steps to read at a time (default: 32)
+        nodata: value of mean and sum for zones without data (default: -9999)
+
+    Returns:
+        dictionary of {statistic: (zone, time) array}
+
+    """
+    _checkStats(stats)
+    if not isinstance(weights, dict):
+        weights = loadZoneWeights(weights)
+    nzones = weights['ids'].size
+    with nc.Dataset(fn) as ds:
+        var = ds[var_name]
+        ntime, nrows, ncols = var.shape
+        if (nrows, ncols) != tuple(weights['shape']):
+            raise ValueError(fn + " is not on the grid of the weights")
+        rows = weights['pixel'] // ncols
+        cols = weights['pixel'] % ncols
+        if 'y' in ds.variables and ds['y'].size > 1 and ds['y'][1] > ds['y'][0]:
+            rows = nrows - 1 - rows  # GDAL reports south-up grids flipped
+        out = {stat: np.full((nzones, ntime), nodata, dtype=np.float64) for stat in stats}
+        if rows.size == 0:
+            return out
+        r0, r1 = rows.min(), rows.max() + 1
+        c0, c1 = cols.min(), cols.max() + 1
+        reducer = _ZoneReducer(weights, (rows - r0) * (c1 - c0) + (cols - c0), (r1 - r0) * (c1 - c0), nzones)
+        for start in range(0, ntime, chunk_days):
+            stop = min(start + chunk_days, ntime)
+            block = np.ma.filled(var[start:stop, r0:r1, c0:c1].astype(np.float64), np.nan)
+            block[block == daymet.NO_DATA_VALUE] = np.nan
+            block = block.reshape((stop - start, -1))
+            for stat, values in _statistics(*reducer.reduce(block), stats, nodata).items():
+                out[stat][:, start:stop] = values
+            instrument.count('cells_processed', block.size)
+    return out
+
+
+def zonalStack(stack, weights, stats=('mean',), chunk_months=120, nodata=daymet.NO_DATA_VALUE):
+    """
+    Reduce a (pixel, time) stack such as the output of hydat.utils.monthlyGridsToNumpy to zone statistics with one
+    sparse matrix product per block of time steps. Values equal to nodata or nan are left out of the statistics.
+    Args:
+        stack: stack array or .npy filename; a stack saved with compact_nodata is matched to grid pixels through its
+            _pixels.npy file
+        weights: weight dictionary or filename from buildZoneWeights, built on the grid of the stack
+        stats: statistics to compute, see zonalNetCDF (default: ('mean',))
+        chunk_months: number of time steps to read at a time (default: 120)
+        nodata: no data value of the stack, and value of mean and sum for zones without data (default: -9999)
+
+    Returns:
+        dictionary of {statistic: (zone, time) array}
+
+    """
+    _checkStats(stats)
+    if not isinstance(weights, dict):
+        weights = loadZoneWeights(weights)
+    nzones = weights['ids'].size
+    pixels = None
+    if not isinstance(stack, np.ndarray):
+        pixels_fn = stack[:-4] + '_pixels.npy'
+        if os.path.exists(pixels_fn):
+            pixels = np.load(pixels_fn)
+        stack = np.load(stack, mmap_mode='r')
+    rows = weights['pixel']
+    if pixels is not None:
+        stored = np.searchsorted(pixels, rows)
+        stored[stored == pixels.size] = 0
+        rows = np.where(pixels[stored] == rows, stored, -1)
+    # read each stack row once, in file order
+    read, columns = np.unique(rows, return_inverse=True)
+    columns = columns.reshape(-1)
+    if read.size and read[0] < 0:
+        read = read[1:]
+        columns = columns - 1
+    reducer = _ZoneReducer(weights, columns, read.size, nzones)
+    ntime = stack.shape[1]
+    out = {stat: np.full((nzones, ntime), nodata, dtype=np.float64) for stat in stats}
+    for start in range(0, ntime, chunk_months):
+        stop = min(start + chunk_months, ntime)
+        block = np.array(stack[read, start:stop], dtype=np.float64).T
+        block[block == nodata] = np.nan
+        for stat, values in _statistics(*reducer.reduce(block), stats, nodata).items():
+            out[stat][:, start:stop] = values
+        instrument.count('cells_processed', block.size)
+    return out
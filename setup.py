@@ -23,6 +23,8 @@ setup(name='hydat',
       license='GPLv3',
       packages=['hydat'],
       install_requires=[
-            'wget', 'gdal', 'numpy', 'netCDF4'],
+            'gdal', 'numpy', 'netCDF4'],
+      extras_require={'yaml': ['pyyaml'], 'zonal': ['scipy']},
+      entry_points={'console_scripts': ['hydat=hydat.cli:main']},
       include_package_data=True,
       zip_safe=False)